@@ -0,0 +1,195 @@
+from multiprocessing import Pool, shared_memory
+import warnings
+
+import numpy as np
+import pandas as pd
+import patsy
+
+from crash_modeling_tools import compute_empirical_bayes, compute_spf, \
+    top_k_indices
+from nb_regression import fit_nb_arrays
+
+# arrays of the bootstrap sample, set in every worker process (see
+# attach_shared_data())
+SHARED_DATA = {}
+
+
+def attach_shared_data(name, shape, setup):
+    """
+    Parameters:
+    @name {string} name of the shared memory block
+    @shape {tuple} shape of the stacked site array
+    @setup {dict} the fitted parameters used by every replicate
+    Initialize a worker process: map the stacked site array (counts,
+    offset, segment lengths and design matrix) from the shared memory block
+    without copying it.
+    """
+    block = shared_memory.SharedMemory(name=name)
+    SHARED_DATA['block'] = block
+    SHARED_DATA['sites'] = np.ndarray(shape, dtype=np.float64,
+                                      buffer=block.buf)
+    SHARED_DATA.update(setup)
+
+
+def run_replicates(args):
+    """
+    Parameters:
+    @args {tuple} the first and last (excluded) replicate numbers
+    Return:
+    @params {numpy array} the coefficients and alpha of every replicate,
+    missing for the coefficients that are not identified in the replicate
+    @top {numpy array} the sites in the top k of every replicate
+    @converged {numpy array} whether the fit of every replicate converged
+    Run a range of bootstrap replicates. Replicate r draws its sites with
+    its own generator seeded with (seed, r), so the results do not depend
+    on the number of worker processes. The sites are ranked on the spf and
+    eb results of crash_modeling_tools, without the offset. A coefficient
+    that is not identified in a replicate (e.g. a level absent from the
+    sample, or without any crash) is left missing, and the sites that use
+    it are not ranked. The warnings of the fits are not issued: they are
+    reported by the returned flags.
+    """
+    start, stop = args
+    sites = SHARED_DATA['sites']
+    y, offset, lengths, X = sites[:, 0], sites[:, 1], sites[:, 2], sites[:, 3:]
+    n_sites = len(y)
+    k = SHARED_DATA['k']
+
+    params = np.empty((stop - start, X.shape[1] + 1))
+    top = np.full((stop - start, k), -1, dtype=np.int64)
+    converged = np.zeros(stop - start, dtype=bool)
+    for i, r in enumerate(range(start, stop)):
+        # resample the sites and refit the model from the full-data fit
+        rng = np.random.default_rng([SHARED_DATA['seed'], r])
+        sample = rng.integers(0, n_sites, n_sites)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            fit = fit_nb_arrays(y[sample], X[sample], offset[sample],
+                                start_params=SHARED_DATA['start_params'],
+                                start_alpha=SHARED_DATA['start_alpha'])
+        params[i, :-1] = np.where(fit.degenerate, np.nan, fit.params)
+        params[i, -1] = fit.alpha
+        converged[i] = fit.converged
+
+        # recompute the eb safety and arp of every site, as the ranking
+        spf = compute_spf(fit, X)
+        eb = compute_empirical_bayes(fit, None, lengths, y, spf)
+        values = eb[SHARED_DATA['by']].to_numpy(copy=True)
+        values[np.any(X[:, fit.degenerate] != 0, axis=1)] = np.nan
+        ranked = top_k_indices(values, k)
+        top[i, :len(ranked)] = ranked
+
+    return params, top, converged
+
+
+def bootstrap_nb(formula, data, offset, segment_lengths, n_boot=1000, k=10,
+                 by='ARP', level=0.95, n_jobs=1, seed=0):
+    """
+    Parameters:
+    @formula {string} model formula, e.g. 'tot_acc_ct~log_aadt+C(curve)'
+    @data {pd dataframe} one row per site
+    @offset {pd series} offset term of every site
+    @segment_lengths {pd series} vector of segment lengths
+    @n_boot {int} number of bootstrap replicates
+    @k {int} number of top sites counted in every replicate
+    @by {string} ranking criterion, 'ARP' or 'Safety'
+    @level {float} level of the percentile intervals
+    @n_jobs {int} number of worker processes
+    @seed {int} seed of the replicates
+    Return:
+    @intervals {pd dataframe} estimate and percentile interval of every
+    coefficient and of alpha, and the number of replicates they are
+    computed from (n_replicates)
+    @frequency {pd series} share of the converged replicates in which each
+    site is in the top k, indexed like data
+    @replicates {pd dataframe} coefficients and alpha of every replicate
+    (missing for the coefficients that are not identified in it), and
+    whether its fit converged
+    Bootstrap the nb model, the eb safety and the arp ranking: every
+    replicate resamples the sites with replacement, refits the model (warm
+    started from the fit on all sites, see nb_regression) and ranks all the
+    sites on the refitted model, like calc_accid_reduc_potential() and
+    estimate_empirical_bayes(). The replicates whose fit did not converge
+    are left out of the intervals and of the frequencies, and a
+    RuntimeWarning gives their number and the number of replicates with
+    coefficients that are not identified (see run_replicates()). The
+    replicates run on a process pool; the site arrays are passed to the
+    workers through shared memory.
+    """
+    y, X = patsy.dmatrices(formula, data, return_type='dataframe')
+    names = list(X.columns) + ['alpha']
+    offset = pd.Series(np.asarray(offset, dtype=np.float64),
+                       index=data.index).loc[y.index].values
+    lengths = pd.Series(np.asarray(segment_lengths, dtype=np.float64),
+                        index=data.index).loc[y.index].values
+
+    # fit the model on all sites
+    fit = fit_nb_arrays(y.values[:, 0], X.values, offset)
+    setup = {'start_params': fit.params, 'start_alpha': fit.alpha, 'k': k,
+             'by': by, 'seed': seed}
+
+    # stack the site arrays in a shared memory block
+    sites = np.column_stack((y.values[:, 0], offset, lengths, X.values))
+    block = shared_memory.SharedMemory(create=True, size=sites.nbytes)
+    try:
+        np.ndarray(sites.shape, dtype=np.float64, buffer=block.buf)[:] = sites
+        chunks = np.linspace(0, n_boot, min(n_boot, 4 * n_jobs) + 1)
+        chunks = [(int(a), int(b)) for a, b in zip(chunks[:-1], chunks[1:])]
+
+        if n_jobs > 1:
+            pool = Pool(n_jobs, initializer=attach_shared_data,
+                        initargs=(block.name, sites.shape, setup))
+            try:
+                results = pool.map(run_replicates, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            attach_shared_data(block.name, sites.shape, setup)
+            try:
+                results = [run_replicates(chunk) for chunk in chunks]
+            finally:
+                SHARED_DATA.pop('sites')
+                SHARED_DATA.pop('block').close()
+    finally:
+        block.close()
+        block.unlink()
+
+    params = np.vstack([result[0] for result in results])
+    top = np.vstack([result[1] for result in results])
+    converged = np.concatenate([result[2] for result in results])
+
+    # report the replicates left out and those with missing coefficients
+    n_failed = np.sum(~converged)
+    n_degenerate = np.sum(np.isnan(params[converged]).any(axis=1))
+    if n_failed or n_degenerate:
+        warnings.warn('%d of %d bootstrap replicates did not converge and '
+                      'are left out, %d have coefficients that are not '
+                      'identified' % (n_failed, n_boot, n_degenerate),
+                      RuntimeWarning)
+
+    # percentile intervals of the coefficients and alpha, over the
+    # converged replicates where they are identified
+    tail = 100 * (1 - level) / 2
+    kept = params[converged]
+    n_replicates = np.sum(~np.isnan(kept), axis=0)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lower = np.nanpercentile(kept, tail, axis=0)
+        upper = np.nanpercentile(kept, 100 - tail, axis=0)
+    intervals = pd.DataFrame({'estimate': np.append(fit.params, fit.alpha),
+                              'lower': lower, 'upper': upper,
+                              'n_replicates': n_replicates},
+                             index=names, columns=['estimate', 'lower',
+                                                   'upper', 'n_replicates'])
+
+    # share of the converged replicates in which each site is in the top k
+    top = top[converged]
+    counts = np.bincount(top[top >= 0], minlength=len(y))
+    frequency = pd.Series(counts / float(max(len(top), 1)), index=y.index,
+                          name='top_k_frequency')
+
+    replicates = pd.DataFrame(params, columns=names)
+    replicates['converged'] = converged
+
+    return intervals, frequency, replicates
@@ -0,0 +1,87 @@
+from bootstrap import *
+import numpy as np
+import pandas as pd
+import unittest
+
+
+class BootstrapTester(unittest.TestCase):
+    """
+    The bootstrap is run with a small number of replicates on the I-90 test
+    dataset.
+    """
+
+    # load in a standard dataset
+    crash_data_path = '../data/unit_test_data/crash_data_final_90_test.csv'
+    crash_data = pd.read_csv(crash_data_path)
+    crash_data = crash_data.dropna()
+    crash_data['log_aadt'] = crash_data.log_avg_aadt.astype(np.float64)
+    offset_term = np.log(crash_data['seg_lng'] * 3)
+    formula = 'tot_acc_ct~log_aadt+lanewid+avg_grad+C(curve)'
+
+    def test_bootstrap_nb(self):
+        """
+        Check the shapes of the results and that the intervals hold the
+        estimates of the fit on all sites.
+        """
+        intervals, frequency, replicates = bootstrap_nb(
+            self.formula, self.crash_data, self.offset_term,
+            self.crash_data['seg_lng'], n_boot=50, k=10)
+
+        self.assertTrue(list(intervals.index)[-1] == 'alpha')
+        self.assertTrue(replicates.shape == (50, len(intervals) + 1))
+        self.assertTrue(replicates.converged.all())
+        self.assertTrue((intervals.n_replicates == 50).all())
+        self.assertTrue(((intervals.lower <= intervals.estimate) &
+                         (intervals.estimate <= intervals.upper)).all())
+
+        # every replicate puts exactly k sites in the top k
+        self.assertTrue(frequency.index.equals(self.crash_data.index))
+        self.assertTrue(np.isclose(frequency.sum(), 10))
+        self.assertTrue(frequency.max() <= 1)
+
+    def test_bootstrap_nb_separation(self):
+        """
+        With the formula of the project, the surface type B coefficient is
+        never identified (its only site is either not drawn or has no
+        crash): it should get no interval, and its site should never be
+        ranked, while the other coefficients get their intervals.
+        """
+        formula = self.formula + '+C(surf_typ)'
+        with self.assertWarns(RuntimeWarning):
+            intervals, frequency, replicates = bootstrap_nb(
+                formula, self.crash_data, self.offset_term,
+                self.crash_data['seg_lng'], n_boot=20, k=10)
+
+        n_converged = replicates.converged.sum()
+        self.assertTrue(n_converged > 0)
+        self.assertTrue(intervals.n_replicates['C(surf_typ)[T.B]'] == 0)
+        self.assertTrue(replicates['C(surf_typ)[T.B]'].isnull().all())
+
+        identified = intervals.drop('C(surf_typ)[T.B]')
+        self.assertTrue((identified.n_replicates == n_converged).all())
+        self.assertTrue(((identified.lower <= identified.estimate) &
+                         (identified.estimate <= identified.upper)).all())
+
+        surface_b = (self.crash_data.surf_typ == 'B').values
+        self.assertTrue((frequency[surface_b] == 0).all())
+        self.assertTrue(np.isclose(frequency.sum(), 10))
+
+    def test_bootstrap_nb_parallel(self):
+        """
+        The replicates are seeded one by one, so the results should not
+        depend on the number of worker processes.
+        """
+        serial = bootstrap_nb(self.formula, self.crash_data,
+                              self.offset_term, self.crash_data['seg_lng'],
+                              n_boot=20, by='Safety', n_jobs=1, seed=3)
+        parallel = bootstrap_nb(self.formula, self.crash_data,
+                                self.offset_term, self.crash_data['seg_lng'],
+                                n_boot=20, by='Safety', n_jobs=2, seed=3)
+
+        self.assertTrue(serial[0].equals(parallel[0]))
+        self.assertTrue(serial[1].equals(parallel[1]))
+        self.assertTrue(serial[2].equals(parallel[2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import os
+import re
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from crash_modeling_tools import draw_nb_cis_and_pis, predict_nb
+from design_compiler import get_design_compiler
+
+# number of values of a numerical predictor on its grid
+GRID_POINTS = 100
+
+
+def get_predictors(nb_model, data):
+    """
+    Parameters:
+    @nb_model {statsmodels genmod} nb regression model fit from a formula
+    @data {pd dataframe} the raw predictor variables
+    Return:
+    @predictors {list} the variables of data used by the model formula, in
+    the order of the formula
+    """
+    compiler = get_design_compiler(nb_model, data)
+    if compiler is None:
+        raise ValueError('the model was not fit from a formula')
+
+    predictors = []
+    for factor, kind, categories, variable in compiler.factors:
+        for name in re.findall(r'[A-Za-z_]\w*', factor.code):
+            if name in data.columns and name not in predictors:
+                predictors.append(name)
+    return predictors
+
+
+def make_ci_pi_grids(nb_model, data, predictors=None, n_points=GRID_POINTS):
+    """
+    Parameters:
+    @nb_model {statsmodels genmod} nb regression model fit from a formula
+    @data {pd dataframe} the raw predictor variables of the sites, used for
+    the ranges and reference values of the predictors
+    @predictors {list} the predictors to vary (default: all of the model)
+    @n_points {int} number of values of a numerical predictor
+    Return:
+    @grids {list} one (predictor, x values, categorical, prediction) tuple
+    per predictor, where categorical tells whether the x values are the
+    levels of the predictor and prediction holds mu_hat and the ci/pi bounds
+    at every x value
+    Each predictor is varied across its range (its levels for a categorical
+    predictor) with the others held at their reference values: the median
+    of the numerical predictors and the most frequent level of the others.
+    The grids of all the predictors are stacked and predicted at once (see
+    crash_modeling_tools.predict_nb()).
+    """
+    variables = get_predictors(nb_model, data)
+    if predictors is None:
+        predictors = variables
+    compiler = get_design_compiler(nb_model, data)
+    categorical = set(variable for factor, kind, categories, variable
+                      in compiler.factors if kind == 'categorical')
+
+    # reference value and x values of every variable of the model
+    reference = {}
+    x_values = {}
+    for var in variables:
+        column = data[var]
+        if var in categorical or column.dtype == bool or \
+                not pd.api.types.is_numeric_dtype(column):
+            categorical.add(var)
+            reference[var] = column.mode().iloc[0]
+            x_values[var] = np.array(sorted(column.dropna().unique()))
+        else:
+            reference[var] = column.median()
+            x_values[var] = np.linspace(column.min(), column.max(), n_points)
+    grids = [(var, x_values[var], var in categorical) for var in predictors]
+
+    # stack the grids of all the predictors, with the other variables at
+    # their reference values
+    sizes = np.array([len(x) for var, x, levels in grids])
+    stops = np.cumsum(sizes)
+    stacked = dict((var, np.repeat(np.array([value]), sizes.sum()))
+                   for var, value in reference.items())
+    for (var, x, levels), stop in zip(grids, stops):
+        stacked[var] = stacked[var].astype(np.result_type(stacked[var], x))
+        stacked[var][stop - len(x):stop] = x
+
+    prediction = predict_nb(nb_model, pd.DataFrame(stacked))
+
+    return [(var, x, levels,
+             prediction.iloc[stop - len(x):stop].reset_index(drop=True))
+            for (var, x, levels), stop in zip(grids, stops)]
+
+
+def render_ci_pi_figure(args):
+    """
+    Parameters:
+    @args {tuple} file name, predictor, x values, categorical and
+    prediction of one figure (see make_ci_pi_grids())
+    Return:
+    @seconds {float} time taken to draw and save the figure
+    Draw and save one figure on the Agg backend, outside of pyplot, so that
+    figures can be rendered in worker processes without a display.
+    """
+    start = time.time()
+    file_name, var, x, categorical, prediction = args
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    if not categorical:
+        draw_nb_cis_and_pis(fig, x, prediction, var)
+    else:
+        # the levels of a categorical predictor are evenly spaced
+        positions = np.arange(len(x))
+        ax = draw_nb_cis_and_pis(fig, positions, prediction, var)
+        ax.set_xticks(positions)
+        ax.set_xticklabels([str(level) for level in x])
+    fig.savefig(file_name)
+
+    return time.time() - start
+
+
+def render_ci_pi_plots(nb_model, data, folder='.', predictors=None,
+                       n_points=GRID_POINTS, n_jobs=1,
+                       prefix='nb_cis_and_pis_'):
+    """
+    Parameters:
+    @nb_model {statsmodels genmod} nb regression model fit from a formula
+    @data {pd dataframe} the raw predictor variables of the sites
+    @folder {string} folder of the saved figures
+    @predictors {list} the predictors to plot (default: all of the model)
+    @n_points {int} number of values of a numerical predictor
+    @n_jobs {int} number of worker processes
+    @prefix {string} start of the file names, followed by the predictor
+    Return:
+    @timing {pd dataframe} file name and rendering time (seconds) of every
+    predictor
+    @grid_seconds {float} time taken by the predictions of all the grids
+    Plot mu and the CIs for mu and the PIs for m and y of every predictor of
+    a model (see make_ci_pi_grids()) into one .png figure per predictor. All
+    the grids are predicted first; the figures are then rendered on a
+    process pool, without a display.
+    """
+    start = time.time()
+    grids = make_ci_pi_grids(nb_model, data, predictors, n_points)
+    grid_seconds = time.time() - start
+
+    tasks = []
+    for var, x, categorical, prediction in grids:
+        file_name = os.path.join(folder, '%s%s.png' % (
+            prefix, re.sub(r'\W+', '_', var)))
+        tasks.append((file_name, var, x, categorical, prediction))
+
+    if n_jobs > 1:
+        pool = Pool(n_jobs)
+        try:
+            seconds = pool.map(render_ci_pi_figure, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        seconds = [render_ci_pi_figure(task) for task in tasks]
+
+    timing = pd.DataFrame({'predictor': [grid[0] for grid in grids],
+                           'file': [task[0] for task in tasks],
+                           'seconds': seconds},
+                          columns=['predictor', 'file', 'seconds'])
+    return timing, grid_seconds
@@ -0,0 +1,84 @@
+from ci_pi_plots import *
+from crash_modeling_tools import predict_nb
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import statsmodels.api as sm
+import statsmodels.formula.api as smf
+import tempfile
+import unittest
+
+
+class CIPIPlotsTester(unittest.TestCase):
+    """
+    The plots are made for a model fit on the I-90 test dataset.
+    """
+
+    # load in a standard dataset and fit a nb regression model
+    crash_data_path = '../data/unit_test_data/crash_data_final_90_test.csv'
+    crash_data = pd.read_csv(crash_data_path)
+    crash_data = crash_data.dropna()
+    crash_data['log_aadt'] = crash_data.log_avg_aadt.astype(np.float64)
+    offset_term = np.log(crash_data['seg_lng'] * 3)
+    mod_nb = smf.glm('tot_acc_ct~log_aadt+lanewid+avg_grad+C(curve)+\
+                     C(surf_typ)', data=crash_data, offset=offset_term,
+                     family=sm.families.NegativeBinomial()).fit()
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_make_ci_pi_grids(self):
+        """
+        Every predictor should be varied with the others at their reference
+        values, and predicted as a single site would be.
+        """
+        grids = make_ci_pi_grids(self.mod_nb, self.crash_data, n_points=20)
+        self.assertTrue([grid[0] for grid in grids] ==
+                        ['log_aadt', 'lanewid', 'avg_grad', 'curve',
+                         'surf_typ'])
+
+        var, x, categorical, prediction = grids[0]
+        self.assertFalse(categorical)
+        self.assertTrue(len(x) == 20 and len(prediction) == 20)
+        self.assertTrue(np.isclose(x[-1], self.crash_data.log_aadt.max()))
+
+        # mu_hat should grow with aadt, the other predictors being fixed
+        self.assertTrue(np.all(np.diff(prediction['mu_hat']) *
+                               self.mod_nb.params['log_aadt'] > 0))
+
+        # a single site at the last grid value
+        site = pd.DataFrame({'log_aadt': [x[-1]],
+                             'lanewid': [self.crash_data.lanewid.median()],
+                             'avg_grad': [self.crash_data.avg_grad.median()],
+                             'curve': [self.crash_data.curve.mode()[0]],
+                             'surf_typ': [self.crash_data.surf_typ.mode()[0]]})
+        self.assertTrue(np.allclose(predict_nb(self.mod_nb, site).values[0],
+                                    prediction.values[-1]))
+
+        var, x, categorical, prediction = grids[4]
+        self.assertTrue(categorical)
+        self.assertTrue(list(x) ==
+                        sorted(self.crash_data.surf_typ.unique()))
+
+    def test_render_ci_pi_plots(self):
+        """
+        There should be one figure file per predictor, in one process or in
+        several.
+        """
+        for n_jobs in [1, 2]:
+            timing, grid_seconds = render_ci_pi_plots(
+                self.mod_nb, self.crash_data, self.folder,
+                predictors=['lanewid', 'curve'], n_jobs=n_jobs)
+            self.assertTrue(list(timing.predictor) == ['lanewid', 'curve'])
+            self.assertTrue((timing.seconds > 0).all() and grid_seconds > 0)
+            for file_name in timing.file:
+                self.assertTrue(os.path.getsize(file_name) > 0)
+                os.remove(file_name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,22 @@ from scipy.stats import norm
 import statsmodels.api as sm
 import statsmodels.formula.api as smf
 
+from design_compiler import get_design_compiler
+
+# number of rows of a design matrix processed at once by the prediction
+# functions
+PREDICTION_CHUNKSIZE = 65536
+
+# normal quantile of the 95% confidence and prediction intervals
+Z_975 = norm.ppf(0.975)
+
+# columns of the table returned by the batched prediction functions
+PREDICTION_COLUMNS = ['mu_hat', 'var_eta_hat', 'LB CI mu', 'UB CI mu',
+                      'LB PI m', 'UB PI m', 'LB PI y', 'UB PI y']
+
+# columns of the table returned by compute_empirical_bayes()
+EB_COLUMNS = ['SPF', 'Weight', 'Safety', 'ARP', 'Var Safety', 'Var ARP']
+
 
 def show_summary_stats(data, cat_var_indices=[9999]):
     """
@@ -41,9 +57,16 @@ def compute_spf(nb_model, predictors):
     @spf {numpy y} values of the spf
     Compute the values of the safety performance function (spf)
     using a negative binomial regression model computed via
-    the statsmodels package and a given set of predictors
+    the statsmodels package and a given set of predictors. For a model fit
+    from a formula, the design matrix is built by the compiled design of
+    the model (see design_compiler) instead of nb_model.predict().
     """
-    spf = nb_model.predict(predictors)
+    if get_design_compiler(nb_model, predictors) is None:
+        return nb_model.predict(predictors)
+
+    spf = calc_mu_hat_nb(nb_model, predictors, raw=True)[:, 0]
+    if isinstance(predictors, pd.DataFrame):
+        spf = pd.Series(spf, index=predictors.index)
 
     return spf
 
@@ -62,12 +85,13 @@ def compute_alpha(nb_model):
     return alpha
 
 
-def compute_eb_weights(nb_model, predictors, segment_lengths):
+def compute_eb_weights(nb_model, predictors, segment_lengths, spf=None):
     """
     Parameters:
     @nb_model {statsmodels genmod} negative binomial (nb) regression model
     @predictors {pd dataframe} set of predictor variables
     @segment_lengths {pd series} vector of segment lengths
+    @spf {numpy array} precomputed values of the spf (optional)
     Return:
     @w {numpy array} weight parameter values
     Compute the weights to be used in the empirical bayes (eb) method.
@@ -80,7 +104,8 @@ def compute_eb_weights(nb_model, predictors, segment_lengths):
     alpha = compute_alpha(nb_model)
 
     # compute the safety performance function
-    spf = compute_spf(nb_model, predictors)
+    if spf is None:
+        spf = compute_spf(nb_model, predictors)
 
     # compute the weight factor
     # w_i 1/(1+spf_i/(alpha*L_i^gamma)), take gamma=1
@@ -91,24 +116,26 @@ def compute_eb_weights(nb_model, predictors, segment_lengths):
 
 
 def estimate_empirical_bayes(nb_model, predictors, segment_lengths,
-                             observed_crash_ct):
+                             observed_crash_ct, spf=None):
     """
     Parameters:
     @nb_model {statsmodels genmod} negative binomial (nb) regression model
     @predictors {pd dataframe} set of predictor variables
     @segment_lengths {pd series} vector of segment lengths
     @observed_crash_ct {pd series} vector of observed crash counts
+    @spf {numpy array} precomputed values of the spf (optional)
     Return:
     @pi {pd dataframe} vector of eb estimtes (safety values)
     Compute and return the estimates from the empirical bayes method.
     The estimates (pi) are a weighted combination of the predicted
     number of crashes and observed number of crashes at each site.
     """
-    # compute the vector of weights
-    w = compute_eb_weights(nb_model, predictors, segment_lengths)
-
     # compute the safety performance function
-    spf = compute_spf(nb_model, predictors)
+    if spf is None:
+        spf = compute_spf(nb_model, predictors)
+
+    # compute the vector of weights
+    w = compute_eb_weights(nb_model, predictors, segment_lengths, spf)
 
     # compute the safety (i.e., expected crash count at each site as weighted
     # sum of predicted and observed crash count)
@@ -122,24 +149,26 @@ def estimate_empirical_bayes(nb_model, predictors, segment_lengths,
 
 
 def calc_accid_reduc_potential(nb_model, predictors, segment_lengths,
-                               observed_crash_ct):
+                               observed_crash_ct, spf=None):
     """
     Parameters:
     @nb_model {statsmodels genmod} negative binomial (nb) regression model
     @predictors {pd dataframe} set of predictor variables
     @segment_lengths {pd series} vector of segment lengths
     @observed_crash_ct {pd series} vector of observed crash counts
+    @spf {numpy array} precomputed values of the spf (optional)
     Return:
     @arp {pd dataframe} vector of arp values
     Caluclates and returns the value of accident reduction potential (arp)
     at each site. arp is a measure used to rank sites for prioritizing
     safety treatments.
     """
-    # compute the vector of weights
-    w = compute_eb_weights(nb_model, predictors, segment_lengths)
-
     # compute the safety performance function
-    spf = compute_spf(nb_model, predictors)
+    if spf is None:
+        spf = compute_spf(nb_model, predictors)
+
+    # compute the vector of weights
+    w = compute_eb_weights(nb_model, predictors, segment_lengths, spf)
 
     # compute the accident reduction potential
     arp = (1-w)*(observed_crash_ct-spf)
@@ -150,61 +179,442 @@ def calc_accid_reduc_potential(nb_model, predictors, segment_lengths,
     return arp
 
 
-def calc_var_eta_hat(model, data):
+def compute_empirical_bayes(nb_model, predictors, segment_lengths,
+                            observed_crash_ct, spf=None):
+    """
+    Parameters:
+    @nb_model {statsmodels genmod} negative binomial (nb) regression model
+    @predictors {pd dataframe} set of predictor variables (ignored if spf is
+    given)
+    @segment_lengths {pd series} vector of segment lengths
+    @observed_crash_ct {pd series} vector of observed crash counts
+    @spf {numpy array} precomputed values of the spf (optional), e.g. to
+    screen several years of counts with the same predictions
+    Return:
+    @eb {pd dataframe} spf, weights, eb safety, arp and their variances
+    (see EB_COLUMNS)
+    Compute all the results of the empirical bayes (eb) method in one pass:
+    the spf is predicted at most once and the weights are shared by the
+    safety and the arp. The variance of the eb safety is (1-w)*safety; since
+    the spf is taken as known, arp = safety-spf has the same variance.
+    """
+    # compute the safety performance function
+    if spf is None:
+        spf = compute_spf(nb_model, predictors)
+    spf = np.asarray(spf, dtype=np.float64)
+    lengths = np.asarray(segment_lengths, dtype=np.float64)
+    observed = np.asarray(observed_crash_ct, dtype=np.float64)
+
+    # w_i 1/(1+spf_i/(alpha*L_i^gamma)), take gamma=1
+    w = 1/(1+(spf/(compute_alpha(nb_model)*lengths)))
+
+    # compute the safety, the arp and the variance of the safety
+    safety = w*spf+(1-w)*observed
+    arp = (1-w)*(observed-spf)
+    var_safety = (1-w)*safety
+
+    # keep the index of the observed counts, e.g. the segment ids
+    index = getattr(observed_crash_ct, 'index', None)
+    eb = pd.DataFrame(dict(zip(EB_COLUMNS, [spf, w, safety, arp, var_safety,
+                                            var_safety])),
+                      columns=EB_COLUMNS, index=index)
+
+    return eb
+
+
+def top_k_indices(values, k):
+    """
+    Parameters:
+    @values {numpy array} vector of values to rank, e.g. the arp
+    @k {int} number of sites to keep
+    Return:
+    @top {numpy array} positions of the k largest values, from the largest
+    This function selects the k largest values with a partial selection
+    (numpy partition) instead of sorting the whole vector; only the selected
+    values are sorted. Ties are broken by position, so the first site wins,
+    and missing values are never selected.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    valid = np.flatnonzero(~np.isnan(values))
+
+    if k <= 0:
+        valid = valid[:0]
+    elif k < len(valid):
+        # find the k-th largest value and keep the values above it, then
+        # fill up with the first sites equal to it
+        kth = np.partition(values[valid], len(valid) - k)[len(valid) - k]
+        above = valid[values[valid] > kth]
+        ties = valid[values[valid] == kth][:k - len(above)]
+        valid = np.concatenate((above, ties))
+
+    # sort the selected sites by decreasing value, then by position
+    return valid[np.lexsort((valid, -values[valid]))]
+
+
+def rank_hotspots(results, k=10, by='ARP', group_by=None):
+    """
+    Parameters:
+    @results {pd dataframe} one row per site with the ranking criterion,
+    e.g. the output of compute_empirical_bayes() joined with the route
+    @k {int} number of sites to keep (per group)
+    @by {string} the column to rank on, e.g. 'ARP' or 'Safety'
+    @group_by {string or list} column(s) defining groups (e.g. the route or
+    the county) ranked separately (optional)
+    Return:
+    @hotspots {pd dataframe} the top k rows of results, sorted by decreasing
+    criterion, with their rank in the 'Rank' column
+    Rank the sites of a network to prioritize safety treatments. The arp of
+    the eb method (equal to the excess crashes, safety-spf) is the default
+    criterion. Only the top k sites are sorted (see top_k_indices()).
+    """
+    values = results[by].values
+    if group_by is None:
+        top = top_k_indices(values, k)
+        ranks = np.arange(1, len(top) + 1)
+    else:
+        # rank every group on its own
+        tops = []
+        ranks = []
+        groups = results.groupby(group_by, sort=True).indices
+        for key in groups:
+            rows = groups[key]
+            top = rows[top_k_indices(values[rows], k)]
+            tops.append(top)
+            ranks.append(np.arange(1, len(top) + 1))
+        top = np.concatenate(tops) if tops else np.array([], dtype=int)
+        ranks = np.concatenate(ranks) if ranks else np.array([], dtype=int)
+
+    hotspots = results.iloc[top].copy()
+    hotspots['Rank'] = ranks
+
+    return hotspots
+
+
+def rank_hotspots_streaming(batches, k=10, by='ARP', group_by=None):
+    """
+    Parameters:
+    @batches {iterable} dataframes of sites (e.g. the eb results of the
+    network read segment batch by segment batch)
+    @k {int} number of sites to keep (per group)
+    @by {string} the column to rank on, e.g. 'ARP' or 'Safety'
+    @group_by {string or list} column(s) defining groups ranked separately
+    (optional)
+    Return:
+    @hotspots {pd dataframe} the same table as rank_hotspots() on all the
+    batches at once
+    Keep a bounded top k while reading the sites batch by batch, so that a
+    statewide screening never holds or sorts the whole network. The current
+    top k is put before every new batch, so the ties are broken in favour of
+    the sites read first.
+    """
+    hotspots = None
+    for batch in batches:
+        if hotspots is not None:
+            batch = pd.concat([hotspots.drop('Rank', axis=1), batch])
+        hotspots = rank_hotspots(batch, k, by, group_by)
+
+    return hotspots
+
+
+def screen_sliding_windows(nb_model, road_inv, begmp, endmp,
+                           observed_crash_ct, spf, window=0.3, step=0.1,
+                           index=None, bbox=None):
+    """
+    Parameters:
+    @nb_model {statsmodels genmod} negative binomial (nb) regression model
+    @road_inv {pd series} route of every segment
+    @begmp {pd series} beginning milepost of every segment
+    @endmp {pd series} ending milepost of every segment
+    @observed_crash_ct {pd series} vector of observed crash counts
+    @spf {numpy array} values of the spf of every segment
+    @window {float} length of the sliding windows (miles)
+    @step {float} distance between the starts of two windows (miles)
+    @index {SpatialIndex} spatial index of the segments, e.g. of their
+    longitude and latitude columns (see spatial_index)
+    @bbox {tuple} (llon, llat, rlon, rlat) corners of the study corridor;
+    when given, only the segments of the index inside the box are screened
+    Return:
+    @windows {pd dataframe} one row per window with its route, mileposts,
+    covered length (seg_lng), observed crash count and the eb results of
+    compute_empirical_bayes()
+    Screen the network with fixed-length sliding windows along every route,
+    as in the Highway Safety Manual. The windows start at the first milepost
+    of the route and move by step; a last window ends at the last milepost,
+    and a route shorter than the window is one window. The crash counts, spf
+    and length of a segment are spread evenly along it, so a window gets the
+    share of each segment it overlaps (a segment of length 0 belongs to the
+    windows [begmp, endmp) holding its milepost). The segments are sorted
+    once and every window is the difference of two values of the per-route
+    cumulative sums, so the whole network is scored in one pass. Segments
+    without a route or a milepost cannot be placed and are left out; without
+    any segment left, there is no window.
+    """
+    road_inv = np.asarray(road_inv)
+    begmp = np.asarray(begmp, dtype=np.float64)
+    endmp = np.asarray(endmp, dtype=np.float64)
+    observed_crash_ct = np.asarray(observed_crash_ct, dtype=np.float64)
+    spf = np.asarray(spf, dtype=np.float64)
+
+    # drop the segments without a route or a milepost
+    valid = pd.notnull(road_inv) & ~np.isnan(begmp) & ~np.isnan(endmp)
+
+    # and those outside the study corridor, found through the spatial index
+    if bbox is not None:
+        if index is None:
+            raise ValueError('a spatial index of the segments is needed to '
+                             'screen a study corridor')
+        inside = np.zeros(len(road_inv), dtype=bool)
+        inside[index.query_bbox(*bbox)] = True
+        valid &= inside
+    road_inv, begmp, endmp = road_inv[valid], begmp[valid], endmp[valid]
+    observed_crash_ct, spf = observed_crash_ct[valid], spf[valid]
+    if len(road_inv) == 0:
+        return pd.DataFrame(columns=['road_inv', 'begmp', 'endmp', 'seg_lng',
+                                     'tot_acc_ct'] + EB_COLUMNS)
+
+    # sort the segments by route and milepost (the segments of a route are
+    # assumed not to overlap)
+    codes, routes = pd.factorize(road_inv, sort=True)
+    order = np.lexsort((endmp, begmp, codes))
+    codes = codes[order]
+    beg = begmp[order]
+    end = endmp[order]
+    lengths = np.maximum(end - beg, 0)
+
+    # cumulative sums of the crashes, spf and length along the segments
+    values = np.column_stack((observed_crash_ct[order], spf[order], lengths))
+    cum = np.vstack((np.zeros(3), np.cumsum(values, axis=0)))
+
+    # first and last milepost of every route
+    first = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    route_beg = beg[first]
+    route_end = np.maximum.reduceat(end, first)
+
+    # number of windows of every route, plus a last window ending at the
+    # last milepost when the steps do not reach it
+    span = route_end - route_beg
+    n_steps = np.where(span > window,
+                       np.floor((span - window) / step + 1e-9) + 1, 1)
+    n_steps = n_steps.astype(np.int64)
+    tail = route_beg + (n_steps - 1) * step + window < route_end - 1e-9
+    n_windows = n_steps + tail
+
+    # start and end of every window
+    route = np.repeat(np.arange(len(first)), n_windows)
+    k = np.arange(route.size) - np.repeat(np.cumsum(n_windows) - n_windows,
+                                          n_windows)
+    start = route_beg[route] + k * step
+    is_tail = tail[route] & (k == n_windows[route] - 1)
+    start[is_tail] = route_end[route][is_tail] - window
+    stop = np.minimum(start + window, route_end[route])
+
+    # shift the mileposts of every route so that one sorted search finds
+    # the segment of each window boundary
+    shift = (np.max(endmp) - np.min(begmp) + window + 1) * np.arange(
+        len(first))
+    keys = beg + shift[codes]
+
+    def cumulative(x):
+        # value of the cumulative sums over [first milepost, x) of the
+        # window route: the last segment starting before x is prorated
+        seg = np.searchsorted(keys, x + shift[route], side='left') - 1
+        share = np.ones(len(x))
+        inside = lengths[seg] > 0
+        share[inside] = (x[inside] - beg[seg][inside]) / \
+            lengths[seg][inside]
+        sums = cum[seg] + values[seg] * np.clip(share, 0, 1)[:, None]
+
+        # nothing of the route lies before its first milepost
+        before = seg < first[route]
+        sums[before] = cum[first[route][before]]
+        return sums
+
+    sums = cumulative(stop) - cumulative(start)
+
+    # apply the eb method to the windows
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eb = compute_empirical_bayes(nb_model, None, sums[:, 2], sums[:, 0],
+                                     spf=sums[:, 1])
+    windows = pd.DataFrame({'road_inv': np.asarray(routes)[route],
+                            'begmp': start, 'endmp': stop,
+                            'seg_lng': sums[:, 2],
+                            'tot_acc_ct': sums[:, 0]})
+
+    return pd.concat([windows, eb], axis=1)
+
+
+def open_design_chunks(model, data, chunksize=PREDICTION_CHUNKSIZE,
+                       raw=None):
     """
     Parameters:
     @model {statsmodels genmod} negative binomial (nb) regression model
-    @data {pd dataframe} set of predictor variables (design matrix)
+    @data {pd dataframe or dict} set of predictor variables (see
+    iter_design_chunks())
+    @chunksize {int} maximum number of rows per chunk
+    @raw {bool} whether data holds the raw predictor variables (see
+    iter_design_chunks())
     Return:
-    @var_eta_hat {pd dataframe} vector of variance values for the
+    @n_rows {int} number of rows of the design matrix
+    @chunks {generator} chunks of the design matrix (see
+    iter_design_chunks())
+    The number of rows is taken from the compiled design, so the raw
+    predictors can also be given as a dict of arrays, as accepted by patsy.
+    """
+    n_params = len(model.params)
+    names = [str(name) for name in
+             getattr(model, 'names', getattr(model.params, 'index', []))]
+
+    compiler = None
+    if raw or (raw is None and isinstance(data, (pd.DataFrame, dict))):
+        compiler = get_design_compiler(model, data)
+    if compiler is not None and raw is None and \
+            isinstance(data, pd.DataFrame):
+        # a design matrix has the coefficient columns, maybe without the
+        # intercept; its columns are put in the order of the coefficients
+        columns = [str(col) for col in data.columns]
+        missing = [name for name in names if name not in columns]
+        if set(columns) <= set(names) and \
+                (not missing or missing == ['Intercept'] == names[:1]):
+            data = data.iloc[:, [columns.index(name) for name in names
+                                 if name in columns]]
+            compiler = None
+    if raw and compiler is None:
+        raise ValueError('the model was not fit from a formula, so a design '
+                         'matrix is needed')
+    if compiler is not None:
+        values = compiler.evaluate(data)
+        n_rows = compiler.count_rows(values, data)
+    else:
+        n_rows = len(data)
+
+    def chunks():
+        for start in range(0, n_rows, chunksize):
+            stop = min(start + chunksize, n_rows)
+            if compiler is not None:
+                design = compiler.build(values, start, stop)
+            elif isinstance(data, pd.DataFrame):
+                design = data.iloc[start:stop].values.astype(np.float64)
+            else:
+                design = np.asarray(data[start:stop], dtype=np.float64)
+
+            # add a column of 1's to the design matrix for beta_0
+            if design.shape[1] == n_params - 1:
+                design = np.column_stack((np.ones(stop - start), design))
+            elif design.shape[1] != n_params:
+                raise ValueError('the design matrix has %d columns for %d '
+                                 'model coefficients' %
+                                 (design.shape[1], n_params))
+
+            yield start, stop, design
+
+    return n_rows, chunks()
+
+
+def iter_design_chunks(model, data, chunksize=PREDICTION_CHUNKSIZE,
+                       raw=None):
+    """
+    Parameters:
+    @model {statsmodels genmod} negative binomial (nb) regression model
+    @data {pd dataframe or dict} set of predictor variables (design matrix),
+    with or without the intercept column, or the raw predictor variables of
+    a model fit from a formula
+    @chunksize {int} maximum number of rows per chunk
+    @raw {bool} whether data holds the raw predictor variables (True) or
+    the design matrix (False); by default, see below
+    Return:
+    @chunks {generator} (start, stop, design) for consecutive row ranges,
+    where design is a float array with one column per model coefficient
+    This function is used to walk through a large design matrix in chunks
+    of fixed size, so that the temporary arrays of the prediction functions
+    do not grow with the number of sites. A column of 1's is added for beta_0
+    when the design matrix has one column fewer than the model coefficients.
+    For a model fit from a formula, a dataframe is taken as the design
+    matrix only if it has a column for every model coefficient (except maybe
+    the intercept) and no other column; its columns are then read by name,
+    in the order of the coefficients. Any other dataframe is taken as the
+    raw predictors: the chunks are then built by the compiled design of the
+    model (see design_compiler), as are the arrays of a dict.
+    """
+    n_rows, chunks = open_design_chunks(model, data, chunksize, raw)
+    return chunks
+
+
+def calc_quadratic_form(design, cov_mat):
+    """
+    Parameters:
+    @design {numpy array} rows of the design matrix
+    @cov_mat {numpy array} variance-covariance matrix of the coefficients
+    Return:
+    @var_eta_hat {numpy array} x*cov*x' for every row x of the design matrix
+    The coefficients with an infinite variance (not identified, see
+    nb_regression.get_covariance()) make the variance of the rows that use
+    them infinite, and are left out of the variance of the other rows.
+    """
+    finite = np.isfinite(np.diag(cov_mat))
+    if finite.all():
+        return np.einsum('ij,ij->i', design.dot(cov_mat), design)
+
+    design = np.asarray(design)
+    kept = design[:, finite]
+    var_eta_hat = np.einsum('ij,ij->i',
+                            kept.dot(cov_mat[np.ix_(finite, finite)]), kept)
+    var_eta_hat[np.any(design[:, ~finite] != 0, axis=1)] = np.inf
+    return var_eta_hat
+
+
+def calc_var_eta_hat(model, data, chunksize=PREDICTION_CHUNKSIZE):
+    """
+    Parameters:
+    @model {statsmodels genmod} negative binomial (nb) regression model
+    @data {pd dataframe} set of predictor variables (design matrix, or raw
+    predictors, see iter_design_chunks())
+    @chunksize {int} number of rows of the design matrix processed at once
+    Return:
+    @var_eta_hat {numpy array} vector of variance values for the
     linear predictor
     This function is used to compute the variance of the linear predictor
     eta_hat, which is used later in calculation of various confidence
-    intervals.
-    """
-    # make a vector of zeros to store the output
-    var_eta_hat = np.zeros([data.shape[0], 1])
-
-    # get the variance-covariance matrix, convert from pd dataframe
-    # to numpy matrix
-    cov_mat = model.normalized_cov_params.as_matrix()
-
-    # add a column of 1's to the design matrix for beta_0
-    data.insert(0, 'intercept', 1)
-
-    # loop through the upper right half of the cov mat
-    for i in range(0, len(model.params)):
-        for j in range(0, i+1):
-            # variance term
-            if (i == j):
-                var_eta_hat = var_eta_hat + cov_mat[i, j] * \
-                    (data[[i]].as_matrix()**2)
-            # covariance term
-            else:
-                var_eta_hat = var_eta_hat + cov_mat[i, j] * 2 * \
-                    data[[i]].as_matrix()*data[[j]].as_matrix()
+    intervals. The variances are the diagonal of X*cov*X', computed row by
+    row as a batched quadratic form over chunks of the design matrix, so the
+    input dataframe is left unchanged.
+    """
+    # get the variance-covariance matrix as a numpy array
+    cov_mat = np.asarray(model.normalized_cov_params, dtype=np.float64)
+
+    # make a vector to store the output
+    n_rows, chunks = open_design_chunks(model, data, chunksize)
+    var_eta_hat = np.zeros([n_rows, 1])
+
+    # var_i = x_i*cov*x_i' for each row x_i of the design matrix
+    for start, stop, design in chunks:
+        var_eta_hat[start:stop, 0] = calc_quadratic_form(design, cov_mat)
 
     return var_eta_hat
 
 
-def calc_mu_hat_nb(nb_model, data):
+def calc_mu_hat_nb(nb_model, data, chunksize=PREDICTION_CHUNKSIZE,
+                   raw=None):
     """
     Parameters:
     @nb_model {statsmodels genmod} negative binomial (nb) regression model
-    @data {pd dataframe} set of predictor variables (design matrix)
+    @data {pd dataframe} set of predictor variables (design matrix, or raw
+    predictors, see iter_design_chunks())
+    @chunksize {int} number of rows of the design matrix processed at once
+    @raw {bool} whether data holds the raw predictor variables (see
+    iter_design_chunks())
     Return:
     @mu_hat_nb {numpy array} vector of values of mu (aka the poisson mean)
     This function is used to compute the value of the Poisson mean at
     varying values of predictors in a given set.
     """
     # make a vector to store the output
-    mu_hat_nb = np.zeros([data.shape[0], 1])
+    n_rows, chunks = open_design_chunks(nb_model, data, chunksize, raw)
+    mu_hat_nb = np.zeros([n_rows, 1])
 
-    # loop over the model coefficients and multiply each one by
-    # the corresponding row in the data frame, add the value
-    # to the running sum
-    for i in range(0, len(nb_model.params)):
-        mu_hat_nb = mu_hat_nb + data[[i]].as_matrix()*nb_model.params[i]
+    # multiply the model coefficients by the rows of the design matrix
+    params = np.asarray(nb_model.params, dtype=np.float64)
+    for start, stop, design in chunks:
+        mu_hat_nb[start:stop, 0] = design.dot(params)
 
     # since the nb regression model uses a log link function, we must
     # exponentiate the final output
@@ -226,18 +636,9 @@ def calc_ci_mu_nb(mu_hat_nb, var_eta_hat):
     95% confidence interval for the Poisson mean as calcuated based on a
     given predictor set.
     """
-    # calcuate the lower bound for the confidence interval for mu
-    lb_ci_mu_nb = mu_hat_nb/np.exp(norm.ppf(0.975)*np.sqrt(var_eta_hat))
-
-    # calcuate the upper bound for the confidence interval for mu
-    ub_ci_mu_nb = mu_hat_nb*np.exp(norm.ppf(0.975)*np.sqrt(var_eta_hat))
-
-    # combine the columns into a two-dimensional matrix
-    mu_ci_matrix = np.column_stack((lb_ci_mu_nb, ub_ci_mu_nb))
-
-    # return the result (i.e., LB and UB as a dataframe)
-    mu_hat_nb_ci = pd.DataFrame(mu_ci_matrix, columns=['LB CI mu', 'UB CI mu'])
-    return mu_hat_nb_ci
+    # the ci for mu does not depend on alpha
+    return select_nb_bounds(0, mu_hat_nb, var_eta_hat,
+                            ['LB CI mu', 'UB CI mu'])
 
 
 def calc_pi_m_nb(nb_model, mu_hat, var_eta_hat):
@@ -256,23 +657,8 @@ def calc_pi_m_nb(nb_model, mu_hat, var_eta_hat):
     95% prediction interval for the Poisson parameter as calcuated based on a
     given predictor set. Alternately, m is known as the safety.
     """
-    # compute alpha (the nb dispersion parameter)
-    alpha = compute_alpha(nb_model)
-
-    # calcuate the lower bound for the prediction interval for m
-    lb_pi_m_nb = np.maximum(0, mu_hat-norm.ppf(0.975)*np.sqrt(mu_hat**2 *
-                            (alpha*(var_eta_hat+1)+var_eta_hat)))
-
-    # calcuate the lower bound for the prediction interval for m
-    ub_pi_m_nb = mu_hat+norm.ppf(0.975)*np.sqrt(mu_hat**2*(alpha *
-                                                (var_eta_hat+1)+var_eta_hat))
-
-    # combine the columns into a two-dimensional matrix
-    m_pi_matrix = np.column_stack((lb_pi_m_nb, ub_pi_m_nb))
-
-    # return the result (i.e., LB and UB as a dataframe)
-    m_nb_pi = pd.DataFrame(m_pi_matrix, columns=['LB PI m', 'UB PI m'])
-    return m_nb_pi
+    return select_nb_bounds(compute_alpha(nb_model), mu_hat, var_eta_hat,
+                            ['LB PI m', 'UB PI m'])
 
 
 def calc_pi_y_nb(nb_model, mu_hat, var_eta_hat):
@@ -291,75 +677,194 @@ def calc_pi_y_nb(nb_model, mu_hat, var_eta_hat):
     95% prediction interval for the predicted response as calcuated based on a
     given predictor set.
     """
-    # compute alpha (the nb dispersion parameter)
-    alpha = compute_alpha(nb_model)
+    return select_nb_bounds(compute_alpha(nb_model), mu_hat, var_eta_hat,
+                            ['LB PI y', 'UB PI y'])
+
 
-    # calcuate the lower bound for the prediction interval for y
-    lb_pi_y_nb = np.zeros(mu_hat.shape[0])
+def calc_nb_bounds(alpha, mu_hat, var_eta_hat):
+    """
+    Parameters:
+    @alpha {float} the nb dispersion parameter
+    @mu_hat {numpy array} vector of values of mu (aka the poisson mean)
+    @var_eta_hat {numpy array} vector of variance values for the linear
+    predictor
+    Return:
+    @bounds {list} lower and upper bounds of the 95% CI for mu, the 95% PI
+    for m and the 95% PI for y, in the order of PREDICTION_COLUMNS
+    This function computes the bounds of calc_ci_mu_nb(), calc_pi_m_nb() and
+    calc_pi_y_nb() at once, sharing the square roots and the exponential
+    between the intervals.
+    """
+    # the ci for mu is symmetric around eta_hat on the log scale
+    ci_factor = np.exp(Z_975*np.sqrt(var_eta_hat))
+
+    # standard deviation of m, used by the pis for m and y
+    sd_m = np.sqrt(mu_hat**2*(alpha*(var_eta_hat+1)+var_eta_hat))
 
-    # calcuate the lower bound for the prediction interval for m
-    ub_pi_y_nb = np.floor(mu_hat+np.sqrt(19)*np.sqrt(mu_hat**2 *
-                          (alpha*(var_eta_hat+1)+var_eta_hat)))
+    return [mu_hat/ci_factor, mu_hat*ci_factor,
+            np.maximum(0, mu_hat-Z_975*sd_m), mu_hat+Z_975*sd_m,
+            np.zeros(len(mu_hat)), np.floor(mu_hat+np.sqrt(19)*sd_m)]
 
-    # combine the columns into a two-dimensional matrix
-    y_pi_matrix = np.column_stack((lb_pi_y_nb, ub_pi_y_nb))
 
-    # return the result (i.e., LB and UB as a dataframe)
-    y_nb_pi = pd.DataFrame(y_pi_matrix, columns=['LB PI y', 'UB PI y'])
-    return y_nb_pi
+def select_nb_bounds(alpha, mu_hat, var_eta_hat, columns):
+    """
+    Parameters:
+    @alpha {float} the nb dispersion parameter
+    @mu_hat {numpy array} vector of values of mu (aka the poisson mean)
+    @var_eta_hat {numpy array} vector of variance values for the linear
+    predictor
+    @columns {list} the bounds to return (see PREDICTION_COLUMNS)
+    Return:
+    @bounds {pd dataframe} the selected bounds computed by calc_nb_bounds()
+    This function is used by calc_ci_mu_nb(), calc_pi_m_nb() and
+    calc_pi_y_nb(), so that all the intervals share the same formulas.
+    """
+    mu_hat = np.ravel(mu_hat).astype(np.float64)
+    var_eta_hat = np.ravel(var_eta_hat).astype(np.float64)
+    bounds = dict(zip(PREDICTION_COLUMNS[2:],
+                      calc_nb_bounds(alpha, mu_hat, var_eta_hat)))
 
+    return pd.DataFrame(dict((col, bounds[col]) for col in columns),
+                        columns=columns)
 
-def plot_and_save_nb_cis_and_pis(data_design, nb_model, mu_hat,
-                                 var_eta_hat, x_axis_range, x_axis_label):
+
+def calc_nb_intervals(nb_model, mu_hat, var_eta_hat):
     """
     Parameters:
-    @data_design {pd dataframe} set of predictor variables (design matrix)
     @nb_model {statsmodels genmod} negative binomial (nb) regression model
-    @mu_hat_nb {numpy array} vector of values of mu (aka the poisson mean)
-    @var_eta_hat {pd dataframe} vector of variance values for the
+    @mu_hat {numpy array} vector of values of mu (aka the poisson mean)
+    @var_eta_hat {numpy array} vector of variance values for the
     linear predictor
-    @x_axis_range {numpy array} specifies numerical range of x-axis
-    @x_axis_label {String} label for x-axis
     Return:
-    @y_nb_pi {pd dataframe}
+    @prediction {pd dataframe} mu_hat, var_eta_hat and the bounds of the
+    95% CI for mu and of the 95% PIs for m and y (see PREDICTION_COLUMNS)
+    This function is used to compute all the intervals of already computed
+    Poisson means in one pass, instead of calling calc_ci_mu_nb(),
+    calc_pi_m_nb() and calc_pi_y_nb() in turn.
+    """
+    mu_hat = np.ravel(mu_hat).astype(np.float64)
+    var_eta_hat = np.ravel(var_eta_hat).astype(np.float64)
+    bounds = calc_nb_bounds(compute_alpha(nb_model), mu_hat, var_eta_hat)
 
-    This function plots mu as as well as the CIs for mu and the PIs for m
-    and y. It also saves the plot as a .png figure.
+    return pd.DataFrame(dict(zip(PREDICTION_COLUMNS,
+                                 [mu_hat, var_eta_hat] + bounds)),
+                        columns=PREDICTION_COLUMNS)
+
+
+def predict_nb(nb_model, data, chunksize=PREDICTION_CHUNKSIZE):
     """
-    # calculate the associated confidence and prediction intervals for mu_hat
-    ci_mu_nb = calc_ci_mu_nb(mu_hat, var_eta_hat)
-    pi_m_nb = calc_pi_m_nb(nb_model, mu_hat, var_eta_hat)
-    pi_y_nb = calc_pi_y_nb(nb_model, mu_hat, var_eta_hat)
+    Parameters:
+    @nb_model {statsmodels genmod} negative binomial (nb) regression model
+    @data {pd dataframe} set of predictor variables (design matrix, or raw
+    predictors, see iter_design_chunks())
+    @chunksize {int} number of rows of the design matrix processed at once
+    Return:
+    @prediction {pd dataframe} mu_hat, var_eta_hat and the bounds of the
+    95% CI for mu and of the 95% PIs for m and y (see PREDICTION_COLUMNS)
+    This function is the batched prediction engine of the nb model. Each
+    chunk of the design matrix is read once to compute the linear predictor,
+    its variance and all the intervals, which are written into preallocated
+    arrays; the extra memory used for a network-wide prediction is bounded
+    by the chunk size.
+    """
+    # allocate one output array per column
+    n_rows, chunks = open_design_chunks(nb_model, data, chunksize)
+    output = [np.empty(n_rows) for col in PREDICTION_COLUMNS]
 
-    # plot mu_hat
-    fig = plt.figure()
+    # get the model quantities once
+    alpha = compute_alpha(nb_model)
+    params = np.asarray(nb_model.params, dtype=np.float64)
+    cov_mat = np.asarray(nb_model.normalized_cov_params, dtype=np.float64)
+
+    for start, stop, design in chunks:
+        # the log link gives mu = exp(x*beta), var_eta = x*cov*x'
+        mu_hat = np.exp(design.dot(params))
+        var_eta_hat = calc_quadratic_form(design, cov_mat)
+        values = [mu_hat, var_eta_hat] + calc_nb_bounds(alpha, mu_hat,
+                                                        var_eta_hat)
+        for out, value in zip(output, values):
+            out[start:stop] = value
+
+    return pd.DataFrame(dict(zip(PREDICTION_COLUMNS, output)),
+                        columns=PREDICTION_COLUMNS)
+
+
+def draw_nb_cis_and_pis(fig, x_axis_range, prediction, x_axis_label):
+    """
+    Parameters:
+    @fig {matplotlib figure} figure to draw on
+    @x_axis_range {numpy array} specifies numerical range of x-axis
+    @prediction {pd dataframe} mu_hat and the ci/pi bounds at every value of
+    the x-axis (see PREDICTION_COLUMNS)
+    @x_axis_label {String} label for x-axis
+    Return:
+    @ax {matplotlib axes} the axes of the plot
+    This function draws mu as well as the CIs for mu and the PIs for m and y
+    on a figure, without using the pyplot state, so that it works with any
+    backend.
+    """
     ax = fig.add_axes([0.1, 0.1, 0.6, 0.75])
-    mu_hat, = plt.plot(x_axis_range, mu_hat)
+    mu_hat, = ax.plot(x_axis_range, prediction['mu_hat'])
 
     # plot the 95% ci for mu
-    lb_ci_mu, = ax.plot(x_axis_range, ci_mu_nb['LB CI mu'], linestyle=':')
-    ub_ci_mu, = ax.plot(x_axis_range, ci_mu_nb['UB CI mu'], linestyle='--')
+    lb_ci_mu, = ax.plot(x_axis_range, prediction['LB CI mu'], linestyle=':')
+    ub_ci_mu, = ax.plot(x_axis_range, prediction['UB CI mu'], linestyle='--')
 
     # plot the 95% pi for m
-    lb_pi_m, = ax.plot(x_axis_range, pi_m_nb['LB PI m'])
-    ub_pi_m, = ax.plot(x_axis_range, pi_m_nb['UB PI m'], linestyle='-.')
+    lb_pi_m, = ax.plot(x_axis_range, prediction['LB PI m'])
+    ub_pi_m, = ax.plot(x_axis_range, prediction['UB PI m'], linestyle='-.')
 
     # plot the 95% pi for y
-    lb_pi_y, = ax.plot(x_axis_range, pi_y_nb['LB PI y'])
-    ub_pi_y, = ax.plot(x_axis_range, pi_y_nb['UB PI y'], linestyle='-')
+    lb_pi_y, = ax.plot(x_axis_range, prediction['LB PI y'])
+    ub_pi_y, = ax.plot(x_axis_range, prediction['UB PI y'], linestyle='-')
 
     # set the plot labels
-    plt.title('95% CIs and PIs for NB Model', fontsize=16)
-    plt.xlabel(x_axis_label, fontsize=14)
-    plt.xlim(np.min(x_axis_range), np.max(x_axis_range))
-    plt.ylabel('Number of Crashes', fontsize=14)
+    ax.set_title('95% CIs and PIs for NB Model', fontsize=16)
+    ax.set_xlabel(x_axis_label, fontsize=14)
+    ax.set_xlim(np.min(x_axis_range), np.max(x_axis_range))
+    ax.set_ylabel('Number of Crashes', fontsize=14)
 
     # create a legend and make it appear outside of the plot space
-    plt.legend([mu_hat, lb_ci_mu, ub_ci_mu, lb_pi_m, ub_pi_m, lb_pi_y,
-                ub_pi_y], ['mu_hat', 'LB CI mu', 'UB CI mu', 'LB PI m',
-                           'UB PI m', 'LB PI y', 'UB PI y'],
-               loc='center left', bbox_to_anchor=(1, 0.5), fontsize=14)
+    ax.legend([mu_hat, lb_ci_mu, ub_ci_mu, lb_pi_m, ub_pi_m, lb_pi_y,
+               ub_pi_y], ['mu_hat', 'LB CI mu', 'UB CI mu', 'LB PI m',
+                          'UB PI m', 'LB PI y', 'UB PI y'],
+              loc='center left', bbox_to_anchor=(1, 0.5), fontsize=14)
 
-    # set the plot size and save
+    # set the plot size
     fig.set_size_inches(10, 6, forward=True)
-    fig.savefig('nb_cis_and_pis.png')
+
+    return ax
+
+
+def plot_and_save_nb_cis_and_pis(data_design, nb_model, mu_hat,
+                                 var_eta_hat, x_axis_range, x_axis_label,
+                                 file_name='nb_cis_and_pis.png'):
+    """
+    Parameters:
+    @data_design {pd dataframe} set of predictor variables (design matrix)
+    @nb_model {statsmodels genmod} negative binomial (nb) regression model
+    @mu_hat_nb {numpy array} vector of values of mu (aka the poisson mean)
+    @var_eta_hat {pd dataframe} vector of variance values for the
+    linear predictor
+    @x_axis_range {numpy array} specifies numerical range of x-axis
+    @x_axis_label {String} label for x-axis
+    @file_name {String} path of the saved figure
+    Return:
+    @y_nb_pi {pd dataframe}
+
+    This function plots mu as as well as the CIs for mu and the PIs for m
+    and y. It also saves the plot as a .png figure. If mu_hat or var_eta_hat
+    is None, all the plotted values are computed from the design matrix in
+    one pass (see predict_nb()). To plot every predictor of a model without
+    a display, see ci_pi_plots.render_ci_pi_plots().
+    """
+    # calculate the associated confidence and prediction intervals for mu_hat
+    if mu_hat is None or var_eta_hat is None:
+        prediction = predict_nb(nb_model, data_design)
+    else:
+        prediction = calc_nb_intervals(nb_model, mu_hat, var_eta_hat)
+
+    # plot and save
+    fig = plt.figure()
+    draw_nb_cis_and_pis(fig, x_axis_range, prediction, x_axis_label)
+    fig.savefig(file_name)
@@ -1,4 +1,5 @@
 from crash_modeling_tools import *
+from spatial_index import SpatialIndex
 import numpy as np
 import os
 import pandas as pd
@@ -136,6 +137,121 @@ class CrashModelingToolsTester(unittest.TestCase):
 
         self.assertTrue(len(np.where(arp != 0)[0]) == len(arp))
 
+    def test_compute_empirical_bayes(self):
+        """
+        The fused eb results should match the weights, safety and arp of the
+        separate functions, with or without a precomputed spf.
+        """
+        eb = compute_empirical_bayes(self.mod_nb, self.data_eb,
+                                     self.segment_lengths,
+                                     self.observed_crash_ct)
+        eb_spf = compute_empirical_bayes(self.mod_nb, None,
+                                         self.segment_lengths,
+                                         self.observed_crash_ct,
+                                         spf=self.spf)
+
+        # check the columns and the results with a precomputed spf
+        self.assertTrue(list(eb.columns) == EB_COLUMNS)
+        self.assertTrue(np.allclose(eb.values, eb_spf.values))
+
+        # compare with the separate functions
+        w = compute_eb_weights(self.mod_nb, self.data_eb,
+                               self.segment_lengths)
+        safety = w*self.spf + (1-w)*self.observed_crash_ct
+        self.assertTrue(np.allclose(eb['SPF'], self.spf))
+        self.assertTrue(np.allclose(eb['Weight'], w))
+        self.assertTrue(np.allclose(eb['Safety'], safety))
+        self.assertTrue(np.allclose(eb['ARP'], safety - self.spf))
+
+        # the variance of the safety is positive
+        self.assertTrue(len(np.where(eb['Var Safety'] > 0)[0]) == len(eb))
+
+    def test_rank_hotspots(self):
+        """
+        The top k sites should be the first k sites of a full stable sort,
+        for the whole network, per group and when read in batches.
+        """
+        eb = compute_empirical_bayes(self.mod_nb, self.data_eb,
+                                     self.segment_lengths,
+                                     self.observed_crash_ct, spf=self.spf)
+        eb['road_inv'] = self.data_eb['road_inv'].values
+        eb['ARP'] = eb['ARP'].round(1)
+
+        # compare with a full sort, ties kept in their order
+        expected = eb.sort_values('ARP', ascending=False, kind='mergesort')
+        hotspots = rank_hotspots(eb, k=20)
+        self.assertTrue(hotspots.index.equals(expected.index[:20]))
+        self.assertTrue(hotspots['Rank'].tolist() == list(range(1, 21)))
+
+        # rank per route
+        by_route = rank_hotspots(eb, k=3, group_by='road_inv')
+        for route, top in by_route.groupby('road_inv'):
+            first = expected[expected.road_inv == route].index[:3]
+            self.assertTrue(top.index.equals(first))
+
+        # read the network in batches
+        batches = [eb.iloc[i:i + 100] for i in range(0, len(eb), 100)]
+        streamed = rank_hotspots_streaming(batches, k=20)
+        self.assertTrue(streamed.index.equals(hotspots.index))
+
+    def test_screen_sliding_windows(self):
+        """
+        Check the windows of two small routes: the counts, spf and length
+        of each segment are shared between the windows it overlaps, and the
+        eb results follow the weight formula on the window values.
+        """
+        windows = screen_sliding_windows(self.mod_nb,
+                                         ['90', '5', '5', '5'],
+                                         [0.0, 0.0, 0.2, 0.4],
+                                         [0.2, 0.2, 0.4, 0.5],
+                                         [1, 2, 4, 1], [0.5, 1.0, 1.0, 0.5],
+                                         window=0.3, step=0.1)
+
+        # route 5 has windows starting at 0, 0.1, 0.2 (the last one ends at
+        # 0.5), route 90 is shorter than a window
+        self.assertTrue(windows.road_inv.tolist() == ['5', '5', '5', '90'])
+        self.assertTrue(np.allclose(windows.begmp, [0.0, 0.1, 0.2, 0.0]))
+        self.assertTrue(np.allclose(windows.endmp, [0.3, 0.4, 0.5, 0.2]))
+        self.assertTrue(np.allclose(windows.seg_lng, [0.3, 0.3, 0.3, 0.2]))
+        self.assertTrue(np.allclose(windows.tot_acc_ct, [4, 5, 5, 1]))
+        self.assertTrue(np.allclose(windows.SPF, [1.5, 1.5, 1.5, 0.5]))
+
+        # compare with the eb method on the window values
+        eb = compute_empirical_bayes(self.mod_nb, None, windows.seg_lng,
+                                     windows.tot_acc_ct, spf=windows.SPF)
+        self.assertTrue(np.allclose(windows[EB_COLUMNS].values, eb.values))
+
+        # segments without a route or a milepost are left out
+        incomplete = screen_sliding_windows(self.mod_nb,
+                                            ['90', '5', '5', '5', None, '5'],
+                                            [0.0, 0.0, 0.2, 0.4, 0.0, np.nan],
+                                            [0.2, 0.2, 0.4, 0.5, 0.3, 0.6],
+                                            [1, 2, 4, 1, 7, 7],
+                                            [0.5, 1.0, 1.0, 0.5, 3.0, 3.0],
+                                            window=0.3, step=0.1)
+        self.assertTrue(incomplete.equals(windows))
+
+        # no window without any placed segment
+        for routes, beg in [([], []), ([None], [0.0]), (['5'], [np.nan])]:
+            empty = screen_sliding_windows(self.mod_nb, routes, beg,
+                                           [0.5] * len(beg), [1] * len(beg),
+                                           [0.5] * len(beg))
+            self.assertTrue(len(empty) == 0)
+            self.assertTrue(list(empty.columns) == list(windows.columns))
+
+        # only the segments inside the study corridor are screened
+        index = SpatialIndex([-122.0, -122.0, -122.0, -122.0, -118.0],
+                             [47.0, 47.0, 47.0, 47.0, 46.0])
+        corridor = screen_sliding_windows(self.mod_nb,
+                                          ['90', '5', '5', '5', '5'],
+                                          [0.0, 0.0, 0.2, 0.4, 0.6],
+                                          [0.2, 0.2, 0.4, 0.5, 0.9],
+                                          [1, 2, 4, 1, 7],
+                                          [0.5, 1.0, 1.0, 0.5, 3.0],
+                                          window=0.3, step=0.1, index=index,
+                                          bbox=(-123.0, 48.0, -121.0, 46.5))
+        self.assertTrue(corridor.equals(windows))
+
     def test_calc_var_eta_hat(self):
         """
         All values in the variance vector for the linear predictor evaluated
@@ -144,6 +260,26 @@ class CrashModelingToolsTester(unittest.TestCase):
         self.assertTrue(len(np.where(self.var_eta_hat > 0)[0]) ==
                         len(self.var_eta_hat))
 
+    def test_calc_var_eta_hat_chunks(self):
+        """
+        The variance vector should match the diagonal of X*cov*X' whatever
+        the chunk size, and the design matrix should be left unchanged.
+        """
+        columns = list(self.data_design.columns)
+        var_eta_hat = calc_var_eta_hat(self.mod_nb, self.data_design,
+                                       chunksize=100)
+
+        # check that no intercept column was added to the design matrix
+        self.assertTrue(list(self.data_design.columns) == columns)
+
+        # compare with the full quadratic form
+        design = np.column_stack((np.ones(len(self.data_design)),
+                                  self.data_design.values))
+        cov_mat = self.mod_nb.normalized_cov_params.values
+        expected = np.diag(design.dot(cov_mat).dot(design.T))
+        self.assertTrue(np.allclose(var_eta_hat[:, 0], expected))
+        self.assertTrue(np.allclose(var_eta_hat, self.var_eta_hat))
+
     def test_calc_mu_hat_nb(self):
         """
         All values in the vector reprsenting the Poisson mean must be
@@ -202,6 +338,33 @@ class CrashModelingToolsTester(unittest.TestCase):
         self.assertTrue(len(np.where(pi_y_nb[[1]] > 0)[0]) ==
                         len(pi_y_nb[[1]]))
 
+    def test_predict_nb(self):
+        """
+        The batched prediction engine should give the same values as the
+        separate functions, whatever the chunk size.
+        """
+        prediction = predict_nb(self.mod_nb, self.data_design, chunksize=100)
+
+        # check the columns and the number of rows
+        self.assertTrue(list(prediction.columns) == PREDICTION_COLUMNS)
+        self.assertTrue(len(prediction) == len(self.data_design))
+
+        # compare with the separate functions
+        ci_mu_nb = calc_ci_mu_nb(self.mu_hat, self.var_eta_hat)
+        pi_m_nb = calc_pi_m_nb(self.mod_nb, self.mu_hat, self.var_eta_hat)
+        pi_y_nb = calc_pi_y_nb(self.mod_nb, self.mu_hat, self.var_eta_hat)
+        expected = pd.concat([ci_mu_nb, pi_m_nb, pi_y_nb], axis=1)
+        self.assertTrue(np.allclose(prediction['mu_hat'], self.mu_hat[:, 0]))
+        self.assertTrue(np.allclose(prediction['var_eta_hat'],
+                                    self.var_eta_hat[:, 0]))
+        for col in expected.columns:
+            self.assertTrue(np.allclose(prediction[col], expected[col]))
+
+        # the intervals of precomputed values should be the same
+        intervals = calc_nb_intervals(self.mod_nb, self.mu_hat,
+                                      self.var_eta_hat)
+        self.assertTrue(np.allclose(intervals.values, prediction.values))
+
     def test_plot_and_save_nb_cis_and_pis(self):
         """
         Here, we test the plotting function by making sure that it properly
@@ -1,11 +1,20 @@
+import hashlib
 import os
+import re
+from collections import OrderedDict
 import pandas as pd
 import sqlite3 as dbi
 
+from multiprocessing import Pool
+
 import seaborn
 import matplotlib.pyplot as plt
 
-from ipywidgets import interact
+from ipywidgets import interact, fixed
+
+import interval_join
+import map_matching
+import raw_cache
 
 # set the plot theme based on seaborn default parameters
 seaborn.set()
@@ -37,11 +46,233 @@ def get_tables(conn):
     return table_list
 
 
-def get_annual_data(year, conn):
+# composite (route, milepost) indexes of the raw tables, used by the range
+# joins in combine_tables_sql(); the annual data tables are indexed on the
+# segment key used by merge_annual_data()
+RAW_TABLE_INDEXES = {'road': ['road_inv', 'begmp', 'endmp'],
+                     'acc': ['rd_inv', 'milepost'],
+                     'curv': ['curv_inv', 'begmp'],
+                     'grad': ['grad_inv', 'begmp'],
+                     'elev': ['Route_id', 'milepost']}
+
+ANNUAL_TABLE_INDEX = ['road_inv', 'begmp', 'endmp']
+
+# PRAGMAs of the bulk-write mode: write-ahead journal, fsync only at
+# checkpoints, a 256 MB page cache and temporary tables kept in memory; they
+# are restored once the bulk writes are committed, so the database is not
+# left in WAL mode for its later readers
+BULK_PRAGMAS = {'journal_mode': 'WAL',
+                'synchronous': 'NORMAL',
+                'cache_size': -262144,
+                'temp_store': 'MEMORY'}
+
+
+def create_index(conn, table, columns):
+    '''
+    Parameters:
+    @conn {sqlite3 Connection} connection to the studied database
+    @table {string} name of the table to index
+    @columns {list} columns of the composite index
+    Create a composite B-tree index on a table (if it does not exist yet), so
+    that the lookups on the leading columns become index seeks instead of
+    full table scans.
+    '''
+    cu = conn.cursor()
+    cu.execute('CREATE INDEX IF NOT EXISTS idx_' + table + ' ON ' + table +
+               '(' + ', '.join(columns) + ')')
+
+
+def create_indexes(conn):
+    '''
+    Parameters:
+    @conn {sqlite3 Connection} connection to the studied database
+    Create the composite (route, milepost) indexes of the raw tables road,
+    acc, curv, grad and elev that exist in the database.
+    '''
+    table_list = get_tables(conn)
+    for table, columns in RAW_TABLE_INDEXES.items():
+        if any(table_list.name == table):
+            create_index(conn, table, columns)
+
+
+def has_rtree(conn):
+    '''
+    Parameters:
+    @conn {sqlite3 Connection} connection to the studied database
+    Return:
+    @available {bool} whether the SQLite library has the R*Tree module
+    '''
+    cu = conn.cursor()
+    try:
+        cu.execute('CREATE VIRTUAL TABLE temp.rtree_probe '
+                   'USING rtree(id, x, y)')
+    except dbi.OperationalError:
+        return False
+    cu.execute('DROP TABLE temp.rtree_probe')
+    return True
+
+
+def create_segment_rtree(conn):
+    '''
+    Parameters:
+    @conn {sqlite3 Connection} connection to the studied database
+    Store the [begmp, endmp] interval of every road segment in an R*Tree
+    (road_rtree). The route is the first dimension of the tree, encoded by
+    the integer code of the road_route table, and the milepost interval is the
+    second dimension.
+    '''
+    cu = conn.cursor()
+    cu.execute('DROP TABLE IF EXISTS road_route')
+    cu.execute('DROP TABLE IF EXISTS road_rtree')
+
+    # give every route an integer code
+    cu.execute('''
+    CREATE TABLE road_route (code INTEGER PRIMARY KEY, road_inv UNIQUE)
+    ''')
+    cu.execute('''
+    INSERT INTO road_route (road_inv)
+    SELECT DISTINCT road_inv FROM road WHERE road_inv IS NOT NULL
+    ''')
+
+    # a segment without a valid interval never matches the range joins
+    cu.execute('''
+    CREATE VIRTUAL TABLE road_rtree
+    USING rtree(id, route_lo, route_hi, begmp, endmp)
+    ''')
+    cu.execute('''
+    INSERT INTO road_rtree
+    SELECT road.rowid, r.code, r.code, road.begmp, road.endmp
+    FROM road JOIN road_route AS r ON r.road_inv = road.road_inv
+    WHERE road.begmp <= road.endmp
+    ''')
+
+
+def match_segments(conn, table, route_col, mp_col):
+    '''
+    Parameters:
+    @conn {sqlite3 Connection} connection to the studied database
+    @table {string} name of the point table (acc, curv, grad or elev)
+    @route_col {string} route column of the point table
+    @mp_col {string} milepost column of the point table
+    Look up the road segments of every point in the R*Tree and store the
+    matches as (segment key, point rowid) pairs in the <table>_match table.
+    The R*Tree keeps its coordinates in single precision, so the candidates
+    are checked again against the exact segment boundaries.
+    '''
+    cu = conn.cursor()
+    cu.execute('DROP TABLE IF EXISTS ' + table + '_match')
+    cu.execute('''
+    CREATE TABLE {t}_match AS
+    SELECT DISTINCT s.road_inv AS seg_inv, s.begmp AS seg_begmp,
+           s.endmp AS seg_endmp, p.rowid AS pt_id
+    FROM {t} AS p
+    JOIN road_route AS r ON r.road_inv = p.{route}
+    JOIN road_rtree AS t
+    ON t.route_lo <= r.code AND t.route_hi >= r.code AND
+       t.begmp <= p.{mp} AND t.endmp >= p.{mp}
+    JOIN road AS s
+    ON s.rowid = t.id AND s.road_inv = p.{route} AND
+       p.{mp} BETWEEN s.begmp AND s.endmp
+    '''.format(t=table, route=route_col, mp=mp_col))
+    create_index(conn, table + '_match',
+                 ['seg_inv', 'seg_begmp', 'seg_endmp'])
+
+
+def range_join(table, seg, route_col, mp_col, rtree):
+    '''
+    Parameters:
+    @table {string} name of the point table (acc, curv, grad or elev)
+    @seg {string} name or alias of the road segment table in the query
+    @route_col {string} route column of the point table
+    @mp_col {string} milepost column of the point table
+    @rtree {bool} whether to join through the R*Tree matches
+    Return:
+    @clause {string} the LEFT JOIN clause of the point table
+    Build the join clause that attaches the points of a table to the road
+    segments they fall on. Without the R*Tree the clause is the range join on
+    the indexed (route, milepost) columns.
+    '''
+    if rtree:
+        clause = '''
+        LEFT JOIN {t}_match AS m
+        ON m.seg_inv = {s}.road_inv AND
+           m.seg_begmp = {s}.begmp AND m.seg_endmp = {s}.endmp
+        LEFT JOIN {t} ON {t}.rowid = m.pt_id
+        '''
+    else:
+        clause = '''
+        LEFT JOIN {t}
+        ON {s}.road_inv = {t}.{route} AND
+           {t}.{mp} BETWEEN {s}.begmp AND {s}.endmp
+        '''
+    return clause.format(t=table, s=seg, route=route_col, mp=mp_col)
+
+
+def read_annual_tables(year, cache=True, read_acc=True):
+    '''
+    Parameters:
+    @year {string} the year for which to read the data tables
+    @cache {bool} whether to read the files through the columnar cache of
+    raw_cache.py instead of parsing the .csv text every time
+    @read_acc {bool} whether to read the accident records; if not, only the
+    columns of the accident file are read (an empty accident table)
+    Return:
+    @road {pd dataframe} road segment table
+    @acc {pd dataframe} accident table
+    @curv {pd dataframe} horizontal curvature table
+    @grad {pd dataframe} roadway grade table
+    @elev {pd dataframe} freeway elevation table
+    Read the five .csv files (road segments, accidents, curvature, grade,
+    elevation) used to build the annual data of a specific year.
+    '''
+
+    # set the current working directory to the data folder
+    set_directory()
+
+    # choose the reader of the .csv files
+    if cache:
+        read_csv = raw_cache.read_csv_cached
+    else:
+        read_csv = pd.read_csv
+
+    # read the .csv files for the specific year
+    road = read_csv('wa'+year+'road.csv')
+    if read_acc:
+        acc = read_csv('wa'+year+'acc.csv')
+    else:
+        acc = pd.read_csv('wa'+year+'acc.csv', nrows=0)
+    curv = read_csv('wa'+year+'curv.csv')
+    grad = read_csv('wa'+year+'grad.csv')
+
+    # the roadway elevation infomration does not change over years, the same
+    # file is used for all six years
+    elev = read_csv('wa_elev.csv')
+
+    return road, acc, curv, grad, elev
+
+
+def get_annual_data(year, conn, engine='sql', acc_chunksize=None,
+                    bulk=False, network=None):
     '''
     Parameters:
     @year {string} the year for which to combine different data tables
     @conn {sqlite3 Connection} connection to the studied database
+    @engine {string} 'sql' to merge the tables with indexed SQL range joins in
+    the database, 'rtree' to join them through an R*Tree of the segment
+    intervals, 'numpy' to merge them with the sorted-interval join engine
+    (interval_join.py), whose elevation statistics are cached in the
+    interval_join.ELEV_CACHE_DIR folder and reused by all years with the same
+    segments; all produce the same table
+    @acc_chunksize {int} if given, the accident file is not loaded as a whole:
+    it is streamed in chunks of this many rows and the crashes are counted
+    per segment on the fly (see interval_join.count_points_chunked())
+    @bulk {bool or dict} whether to load the raw tables in bulk-write mode
+    (see combine_tables_sql())
+    @network {map_matching.RoadNetwork} if given, the network is calibrated
+    with the elevation points and the crashes with coordinates but a missing
+    or unmatched milepost are map matched to it before they are counted (see
+    map_matching.fill_acc_locations()); accident files without coordinates
+    are counted as they are
     Return:
     @annual_data {pd dataframe} the combined annual dataframe
     Combine five data tables (road segments, elevation, grade, curvature,
@@ -52,36 +283,101 @@ def get_annual_data(year, conn):
     from different tables are merged into a combined table through SQL codes.
     '''
 
-    # set the current working directory to the data folder
-    set_directory()
-
     # read the .csv files for the specific year
-    road = pd.read_csv('wa'+year+'road.csv')
-    acc = pd.read_csv('wa'+year+'acc.csv')
-    curv = pd.read_csv('wa'+year+'curv.csv')
-    grad = pd.read_csv('wa'+year+'grad.csv')
+    road, acc, curv, grad, elev = read_annual_tables(
+        year, read_acc=(acc_chunksize is None))
+
+    # place the crashes missing from the road segments on the road network
+    if network is not None:
+        map_matching.calibrate_network(network, elev)
+        if acc is not None:
+            acc = map_matching.fill_acc_locations(acc, network, road)
+
+    # merge the tables with the requested engine
+    if engine in ('sql', 'rtree'):
+        annual_data = combine_tables_sql(conn, road, acc, curv, grad, elev,
+                                         rtree=(engine == 'rtree'),
+                                         bulk=bulk)
+    elif engine == 'numpy':
+        annual_data = interval_join.combine_tables(
+            road, acc, curv, grad, elev,
+            cache_dir=interval_join.ELEV_CACHE_DIR)
+    else:
+        raise ValueError('unknown engine: ' + str(engine))
+
+    # count the crashes of each segment while streaming the accident file;
+    # the route numbers are read as text if the segment routes are text
+    if acc_chunksize is not None:
+        if annual_data['road_inv'].dtype.kind in 'biuf':
+            dtype = None
+        else:
+            dtype = {'rd_inv': str}
+        chunks = pd.read_csv('wa'+year+'acc.csv', chunksize=acc_chunksize,
+                             dtype=dtype)
+        if network is not None:
+            chunks = (map_matching.fill_acc_locations(chunk, network, road)
+                      for chunk in chunks)
+        annual_data['acc_count'] = interval_join.count_points_chunked(
+            annual_data['road_inv'].values, annual_data['begmp'].values,
+            annual_data['endmp'].values, chunks, 'rd_inv', 'milepost',
+            'caseno')
+
+    # return the combined table
+    return annual_data
 
-    # the roadway elevation infomration does not change over years, the same
-    # file is used for all six years
-    elev = pd.read_csv('wa_elev.csv')
+
+def combine_tables_sql(conn, road, acc, curv, grad, elev, rtree=False,
+                       bulk=False):
+    '''
+    Parameters:
+    @conn {sqlite3 Connection} connection to the studied database
+    @road {pd dataframe} road segment table
+    @acc {pd dataframe} accident table
+    @curv {pd dataframe} horizontal curvature table
+    @grad {pd dataframe} roadway grade table
+    @elev {pd dataframe} freeway elevation table
+    @rtree {bool} whether to match the points to the road segments through
+    an R*Tree of the segment intervals (ignored if SQLite has no R*Tree)
+    @bulk {bool or dict} whether to use the bulk-write mode: the PRAGMAs of
+    BULK_PRAGMAS (or the given dict of PRAGMAs) are applied, and only the raw
+    tables that changed since the last load are written, in one transaction
+    (see load_raw_tables())
+    Return:
+    @annual_data {pd dataframe} the combined annual dataframe
+    Convert the five annual data tables into database tables and merge their
+    attributes into a combined table through SQL range joins. The tables are
+    indexed on (route, milepost) so that every range join is an index seek.
+    '''
 
     # create a database cursor that can execute query statements
     cu = conn.cursor()
 
-    # before converting dataframes into the database, drop existing tables with
-    # conflicting names
-    cu.execute('DROP TABLE IF EXISTS road')
-    cu.execute('DROP TABLE IF EXISTS acc')
-    cu.execute('DROP TABLE IF EXISTS curv')
-    cu.execute('DROP TABLE IF EXISTS grad')
-    cu.execute('DROP TABLE IF EXISTS elev')
-
-    # convert the pandas dataframes into database tables
-    road.to_sql(name='road', con=conn)
-    acc.to_sql(name='acc', con=conn)
-    curv.to_sql(name='curv', con=conn)
-    grad.to_sql(name='grad', con=conn)
-    elev.to_sql(name='elev', con=conn)
+    if bulk:
+        # write the changed raw tables in one transaction
+        previous = apply_pragmas(conn, bulk)
+        loaded = load_raw_tables(conn, {'road': road, 'acc': acc,
+                                        'curv': curv, 'grad': grad,
+                                        'elev': elev})
+    else:
+        # before converting dataframes into the database, drop existing
+        # tables with conflicting names
+        cu.execute('DROP TABLE IF EXISTS road')
+        cu.execute('DROP TABLE IF EXISTS acc')
+        cu.execute('DROP TABLE IF EXISTS curv')
+        cu.execute('DROP TABLE IF EXISTS grad')
+        cu.execute('DROP TABLE IF EXISTS elev')
+        cu.execute('DROP TABLE IF EXISTS raw_table_source')
+
+        # convert the pandas dataframes into database tables
+        road.to_sql(name='road', con=conn)
+        acc.to_sql(name='acc', con=conn)
+        curv.to_sql(name='curv', con=conn)
+        grad.to_sql(name='grad', con=conn)
+        elev.to_sql(name='elev', con=conn)
+        loaded = ['road', 'acc', 'curv', 'grad', 'elev']
+
+    # index the raw tables on (route, milepost)
+    create_indexes(conn)
 
     # SQL query for updating the negative grade values in the grade table
     # (in the original table, signs and absolute values of grade are stored
@@ -94,8 +390,19 @@ def get_annual_data(year, conn):
     END
     '''
 
-    # execute the query statement
-    cu.execute(qry_compute_signed_grade)
+    # execute the query statement (a grade table kept from the previous load
+    # is already signed)
+    if 'grad' in loaded:
+        cu.execute(qry_compute_signed_grade)
+
+    # with the R*Tree, match the points to the segments once per table
+    rtree = rtree and has_rtree(conn)
+    if rtree:
+        create_segment_rtree(conn)
+        match_segments(conn, 'elev', 'Route_id', 'milepost')
+        match_segments(conn, 'grad', 'grad_inv', 'begmp')
+        match_segments(conn, 'curv', 'curv_inv', 'begmp')
+        match_segments(conn, 'acc', 'rd_inv', 'milepost')
 
     # SQL query for merging elevation information into the road segment table
     # Two sources of roadway grade information is provided: the elevation
@@ -111,11 +418,10 @@ def get_annual_data(year, conn):
            AVG(elev.Grade)*100 AS avg_grad,
            MAX(elev.Grade)*100 AS max_grad,
            MIN(elev.Grade)*100 AS min_grad
-    FROM road LEFT JOIN elev
-    ON road.road_inv = elev.Route_id AND
-       elev.milepost BETWEEN road.begmp AND road.endmp
+    FROM road {join_elev}
     GROUP BY road.road_inv, road.begmp, road.endmp
-    '''
+    '''.format(join_elev=range_join('elev', 'road', 'Route_id',
+                                    'milepost', rtree))
 
     # SQL query for merging grade informatino when elevation information is not
     # obtainable
@@ -130,11 +436,9 @@ def get_annual_data(year, conn):
            ELSE MAX(pct_grad) END AS max_grad,
            CASE WHEN min_grad IS NOT NULL THEN min_grad
            ELSE MIN(pct_grad) END AS min_grad
-    FROM merge_elev AS e LEFT JOIN grad
-    ON e.road_inv = grad.grad_inv AND
-       grad.begmp BETWEEN e.begmp AND e.endmp
+    FROM merge_elev AS e {join_grad}
     GROUP BY e.road_inv, e.begmp, e.endmp
-    '''
+    '''.format(join_grad=range_join('grad', 'e', 'grad_inv', 'begmp', rtree))
 
     # SQL query for merging curvature information
     qry_merge_curv = '''
@@ -142,22 +446,18 @@ def get_annual_data(year, conn):
     SELECT g.*,
            COUNT(curv.dir_curv) AS curv_count,
            MAX(curv.deg_curv) AS max_deg_curv
-    FROM merge_grad AS g LEFT JOIN curv
-    ON curv.curv_inv = g.road_inv AND
-       curv.begmp BETWEEN g.begmp AND g.endmp
+    FROM merge_grad AS g {join_curv}
     GROUP BY g.road_inv, g.begmp, g.endmp
-    '''
+    '''.format(join_curv=range_join('curv', 'g', 'curv_inv', 'begmp', rtree))
 
     # SQL query for calculating and merging accident counts
     qry_merge_acc = '''
     SELECT c.*,
            COUNT(acc.caseno) AS acc_count
-    FROM merge_curv AS c LEFT JOIN acc
-    ON c.road_inv = acc.rd_inv AND
-       acc.milepost BETWEEN c.begmp AND c.endmp
+    FROM merge_curv AS c {join_acc}
     GROUP BY c.road_inv, c.begmp, c.endmp
     ORDER BY c.road_inv, c.begmp, c.endmp
-    '''
+    '''.format(join_acc=range_join('acc', 'c', 'rd_inv', 'milepost', rtree))
 
     # drop views if there exists name conflits
     cu.execute("DROP VIEW IF EXISTS merge_elev")
@@ -175,104 +475,263 @@ def get_annual_data(year, conn):
     # commit the changes to the database
     conn.commit()
 
+    # leave the bulk-write mode
+    if bulk:
+        apply_pragmas(conn, previous)
+
     # return the combined table
     return annual_data
 
 
-def merge_annual_data(conn):
+def sql_values(data):
+    '''
+    Parameters:
+    @data {pd dataframe} the table to be written to the database
+    Return:
+    @rows {list} list of row tuples holding plain python values
+    Convert a dataframe into rows that can be bound by sqlite3 (python int,
+    float and string values, with None for the missing values).
+    '''
+    columns = []
+    for col in data.columns:
+        values = data[col].astype(object)
+        columns.append(values.where(pd.notnull(values), None).tolist())
+    return list(zip(*columns))
+
+
+def insert_tables(cu, tables):
+    '''
+    Parameters:
+    @cu {sqlite3 Cursor} cursor of the studied database
+    @tables {dict} dataframes to be written, keyed by table name
+    Replace tables of the database with dataframes. Each table is created
+    with the typed column declarations of the dataframe and filled with a
+    single executemany() call. As with DataFrame.to_sql, the dataframe index
+    is stored in the "index" column.
+    '''
+    for name, data in tables.items():
+        data = data.reset_index()
+        cu.execute('DROP TABLE IF EXISTS ' + name)
+        cu.execute(pd.io.sql.get_schema(data, name, con=cu.connection))
+        cu.executemany('INSERT INTO ' + name + ' VALUES (' +
+                       ', '.join(['?'] * data.shape[1]) + ')',
+                       sql_values(data))
+
+
+def write_tables(conn, tables):
     '''
     Parameters:
     @conn {sqlite3 Connection} connection to the studied database
-    Merge all annual crash tables for six different years. Here we assume the
-    road geometry does not change over the six years, while the annual average
-    daily traffic (aadt) and crash counts for different years are merged based
-    on the road inventory number (road_inv) and the milepost data of each
-    segment. The function has no return value and the final table will be saved
-    in the database for further use.
+    @tables {dict} dataframes to be written, keyed by table name
+    Write several dataframes to the database in one transaction (see
+    insert_tables()). Existing tables with the same names are replaced.
     '''
+    # the connection context manager commits at the end of the block (or
+    # rolls everything back if one of the writes fails)
+    with conn:
+        cu = conn.cursor()
+        if not conn.in_transaction:
+            cu.execute('BEGIN')
+        insert_tables(cu, tables)
 
-    # get a list of tables in the database
+
+def apply_pragmas(conn, pragmas=True):
+    '''
+    Parameters:
+    @conn {sqlite3 Connection} connection to the studied database
+    @pragmas {bool or dict} the PRAGMAs to apply, keyed by name; True for
+    the PRAGMAs of BULK_PRAGMAS
+    Return:
+    @previous {dict} the values of the PRAGMAs before the change
+    Set the PRAGMAs (journal mode, synchronous, cache size, temp_store, ...)
+    of the database connection used for bulk writes. The previous values are
+    restored with apply_pragmas(conn, previous) once the bulk writes are
+    committed (the journal mode cannot change inside a transaction).
+    '''
+    if pragmas is True:
+        pragmas = BULK_PRAGMAS
+    previous = {}
+    for name, value in pragmas.items():
+        previous[name] = conn.execute('PRAGMA ' + name).fetchone()[0]
+        conn.execute('PRAGMA ' + name + ' = ' + str(value))
+    return previous
+
+
+def get_fingerprint(data):
+    '''
+    Parameters:
+    @data {pd dataframe} a raw data table
+    Return:
+    @fingerprint {string} hex SHA-1 digest of the columns and values
+    '''
+    sha1 = hashlib.sha1()
+    sha1.update(str([(str(col), str(data[col].dtype))
+                     for col in data.columns]).encode())
+    sha1.update(pd.util.hash_pandas_object(data).values.tobytes())
+    return sha1.hexdigest()
+
+
+def load_raw_tables(conn, tables):
+    '''
+    Parameters:
+    @conn {sqlite3 Connection} connection to the studied database
+    @tables {dict} the raw data tables, keyed by table name
+    Return:
+    @loaded {list} names of the tables that were written
+    Bulk-load the raw tables of one year. The fingerprint of every loaded
+    table is kept in the raw_table_source table, and a table whose content
+    is the same as in the previous load (e.g. the elevation table, which is
+    shared by all years) is not written again. All writes happen in one
+    transaction.
+    '''
     table_list = get_tables(conn)
+    stored = {}
+    if any(table_list.name == 'raw_table_source'):
+        stored = dict(conn.execute(
+            'SELECT name, fingerprint FROM raw_table_source').fetchall())
+
+    # find the tables that changed since the last load
+    fingerprints = dict((name, get_fingerprint(data))
+                        for name, data in tables.items())
+    changed = dict((name, data) for name, data in tables.items()
+                   if stored.get(name) != fingerprints[name] or
+                   not any(table_list.name == name))
+
+    with conn:
+        cu = conn.cursor()
+        if not conn.in_transaction:
+            cu.execute('BEGIN')
+        insert_tables(cu, changed)
+        cu.execute('''
+        CREATE TABLE IF NOT EXISTS raw_table_source
+        (name TEXT PRIMARY KEY, fingerprint TEXT)
+        ''')
+        cu.executemany('INSERT OR REPLACE INTO raw_table_source VALUES (?, ?)',
+                       [(name, fingerprints[name]) for name in changed])
+
+    return list(changed)
+
+
+def build_annual_data(args):
+    '''
+    Parameters:
+    @args {tuple} the year for which to build the annual data, the merging
+    engine, the bulk-write mode and the road network (see get_annual_data())
+    Return:
+    @year {string} the year of the annual data
+    @annual_data {pd dataframe} the combined annual dataframe
+    Worker function of merge_annual_data() for parallel builds. Each worker
+    merges the data of one year in a private in-memory scratch database, so
+    that the years do not share the raw tables of the main database.
+    '''
+    year, engine, bulk, network = args
 
-    # check if the annual data table already exist in the dataframe
-    # if not, call the get_annual_data() function to create the annual data
-    if not any(table_list.name == 'data_06'):
-        data_06 = get_annual_data('06', conn)
-        data_06.to_sql(name='data_06', con=conn)
+    # build the annual data in a scratch database
+    conn = dbi.connect(':memory:')
+    annual_data = get_annual_data(year, conn, engine, bulk=bulk,
+                                  network=network)
+    conn.close()
 
-    if not any(table_list.name == 'data_07'):
-        data_07 = get_annual_data('07', conn)
-        data_07.to_sql(name='data_07', con=conn)
+    return year, annual_data
 
-    if not any(table_list.name == 'data_08'):
-        data_08 = get_annual_data('08', conn)
-        data_08.to_sql(name='data_08', con=conn)
 
-    if not any(table_list.name == 'data_09'):
-        data_09 = get_annual_data('09', conn)
-        data_09.to_sql(name='data_09', con=conn)
+def build_annual_data_parallel(conn, years, n_jobs, engine='sql',
+                               bulk=False, network=None):
+    '''
+    Parameters:
+    @conn {sqlite3 Connection} connection to the studied database
+    @years {list} the years for which to build the annual data
+    @n_jobs {int} number of worker processes
+    @engine {string} the merging engine (see get_annual_data())
+    @bulk {bool or dict} the bulk-write mode (see combine_tables_sql())
+    @network {map_matching.RoadNetwork} the road network used to place the
+    crashes (optional, see get_annual_data())
+    Build the annual data of several years at the same time, one year per
+    worker process, and write all resulting data_XX tables to the database
+    in one bulk transaction.
+    '''
+    pool = Pool(min(n_jobs, len(years)))
+    try:
+        results = pool.map(build_annual_data,
+                           [(year, engine, bulk, network)
+                            for year in years])
+    finally:
+        pool.close()
+        pool.join()
 
-    if not any(table_list.name == 'data_10'):
-        data_10 = get_annual_data('10', conn)
-        data_10.to_sql(name='data_10', con=conn)
+    write_tables(conn, dict(('data_' + year, annual_data)
+                            for year, annual_data in results))
 
-    if not any(table_list.name == 'data_11'):
-        data_11 = get_annual_data('11', conn)
-        data_11.to_sql(name='data_11', con=conn)
 
-    # SQL query to merge data from all six years
-    qry_merge_data = '''
-    CREATE VIEW merge_data AS
-    SELECT d.*,
-           data_11.aadt AS aadt_11, data_11.acc_count AS acc_ct_11
-    FROM (
+def find_years(data_dir='.'):
+    '''
+    Parameters:
+    @data_dir {string} the data folder
+    Return:
+    @years {list} sorted two-digit years with a complete set of HSIS files
+    Find the years for which the road, accident, curvature and grade .csv
+    files (waYYroad.csv, waYYacc.csv, waYYcurv.csv, waYYgrad.csv) are all
+    available in the data folder.
+    '''
+    files = set(os.listdir(data_dir))
+    years = []
+    for file_name in files:
+        match = re.match(r'^wa(\d\d)road\.csv$', file_name)
+        if match is None:
+            continue
+        year = match.group(1)
+        if all('wa' + year + kind + '.csv' in files
+               for kind in ['acc', 'curv', 'grad']):
+            years.append(year)
+    return sorted(years)
+
+
+def get_panel_years(conn):
+    '''
+    Parameters:
+    @conn {sqlite3 Connection} connection to the studied database
+    Return:
+    @years {list} years merged into the crash_data table, in column order
+    '''
+    columns = pd.read_sql('PRAGMA table_info(crash_data)', con=conn).name
+    return [col[len('aadt_'):] for col in columns
+            if re.match(r'^aadt_\d\d$', col)]
 
-    SELECT c.*,
-           data_10.aadt AS aadt_10, data_10.acc_count AS acc_ct_10
-    FROM (
-
-    SELECT b.*,
-           data_09.aadt AS aadt_09, data_09.acc_count AS acc_ct_09
-    FROM (
-
-    SELECT a.*,
-           data_08.aadt AS aadt_08, data_08.acc_count AS acc_ct_08
-    FROM (
-
-    SELECT data_06.*,
-           data_06.aadt AS aadt_06, data_06.acc_count AS acc_ct_06,
-           data_07.aadt AS aadt_07, data_07.acc_count AS acc_ct_07
-    FROM data_06
-
-    LEFT JOIN data_07
-    ON data_06.road_inv = data_07.road_inv AND
-       data_06.begmp = data_07.begmp AND
-       data_06.endmp = data_07.endmp
-    ) AS a
-
-    LEFT JOIN data_08
-    ON a.road_inv = data_08.road_inv AND
-       a.begmp = data_08.begmp AND
-       a.endmp = data_08.endmp
-    ) AS b
-
-    LEFT JOIN data_09
-    ON b.road_inv = data_09.road_inv AND
-       b.begmp = data_09.begmp AND
-       b.endmp = data_09.endmp
-    ) AS c
-
-    LEFT JOIN data_10
-    ON c.road_inv = data_10.road_inv AND
-       c.begmp = data_10.begmp AND
-       c.endmp = data_10.endmp
-    ) AS d
-
-    LEFT JOIN data_11
-    ON d.road_inv = data_11.road_inv AND
-       d.begmp = data_11.begmp AND
-       d.endmp = data_11.endmp
+
+def create_crash_data(conn, years):
     '''
+    Parameters:
+    @conn {sqlite3 Connection} connection to the studied database
+    @years {list} the years to merge, the first one defining the segments
+    Build the crash_data table from the annual data tables of the given
+    years. The segment attributes are taken from the first year, and the
+    aadt and crash count of every year are joined on the segment key
+    (road_inv, begmp, endmp).
+    '''
+    first = 'data_' + years[0]
+
+    # one aadt and one crash count column per year, plus their joins
+    year_columns = []
+    joins = []
+    for year in years:
+        table = 'data_' + year
+        year_columns.append(table + '.aadt AS aadt_' + year + ', ' +
+                            table + '.acc_count AS acc_ct_' + year)
+        if table != first:
+            joins.append('''
+    LEFT JOIN {t}
+    ON {f}.road_inv = {t}.road_inv AND
+       {f}.begmp = {t}.begmp AND
+       {f}.endmp = {t}.endmp'''.format(t=table, f=first))
+
+    # SQL query to merge data from all years
+    qry_merge_data = '''
+    CREATE VIEW merge_data AS
+    SELECT {f}.*,
+           {columns}
+    FROM {f}{joins}
+    '''.format(f=first, columns=',\n           '.join(year_columns),
+               joins=''.join(joins))
 
     # SQL query to select columns needed for data modeling
     # and calculate the average aadt and total accident count
@@ -282,14 +741,17 @@ def merge_annual_data(conn):
            spd_limt, begmp, endmp, lanewid, no_lanes, lshldwid,
            rshldwid, medwid, seg_lng, longitude, latitude,
            avg_grad, max_grad, min_grad, curv_count, max_deg_curv,
-           aadt_06, acc_ct_06, aadt_07, acc_ct_07, aadt_08, acc_ct_08,
-           aadt_09, acc_ct_09, aadt_10, acc_ct_10, aadt_11, acc_ct_11,
-           (aadt_06+aadt_07+aadt_08+aadt_09+aadt_10+aadt_11)/6 AS avg_aadt,
-           (acc_ct_06+acc_ct_07+acc_ct_08+acc_ct_09+acc_ct_10+acc_ct_11)
+           {columns},
+           ({aadt})/{n} AS avg_aadt,
+           ({acc_ct})
            AS tot_acc_ct
     FROM merge_data
     ORDER BY road_inv, begmp, endmp
-    '''
+    '''.format(columns=', '.join('aadt_' + y + ', acc_ct_' + y
+                                 for y in years),
+               aadt='+'.join('aadt_' + y for y in years),
+               acc_ct='+'.join('acc_ct_' + y for y in years),
+               n=len(years))
 
     # create a database cursor that can execute query statements
     cu = conn.cursor()
@@ -302,12 +764,140 @@ def merge_annual_data(conn):
     cu.execute(qry_merge_data)
     cu.execute(qry_final_data)
 
+
+def append_crash_data(conn, panel_years, new_years):
+    '''
+    Parameters:
+    @conn {sqlite3 Connection} connection to the studied database
+    @panel_years {list} the years already merged into crash_data
+    @new_years {list} the years to add to crash_data
+    Add new years to the existing crash_data table in place. The aadt and
+    crash count columns of each new year are filled from its annual table
+    through the segment key, and avg_aadt and tot_acc_ct are updated from the
+    per-year columns already stored in crash_data, so that the annual tables
+    of the earlier years are not joined again. The columns of the new years
+    are appended after tot_acc_ct.
+    '''
+    cu = conn.cursor()
+    for year in new_years:
+        # lookup of the annual table on the segment key
+        lookup = '''
+        (SELECT {col} FROM data_{y} AS d
+         WHERE d.road_inv = crash_data.road_inv AND
+               d.begmp = crash_data.begmp AND
+               d.endmp = crash_data.endmp)'''
+
+        cu.execute('ALTER TABLE crash_data ADD COLUMN aadt_' + year)
+        cu.execute('ALTER TABLE crash_data ADD COLUMN acc_ct_' + year)
+        cu.execute('''
+        UPDATE crash_data
+        SET aadt_{y} = {aadt},
+            acc_ct_{y} = {acc_ct}
+        '''.format(y=year, aadt=lookup.format(col='aadt', y=year),
+                   acc_ct=lookup.format(col='acc_count', y=year)))
+
+    # update the average aadt and the total accident count
+    years = panel_years + new_years
+    cu.execute('''
+    UPDATE crash_data
+    SET avg_aadt = ({aadt})/{n},
+        tot_acc_ct = tot_acc_ct + {acc_ct}
+    '''.format(aadt='+'.join('aadt_' + y for y in years), n=len(years),
+               acc_ct='+'.join('acc_ct_' + y for y in new_years)))
+
+
+def merge_annual_data(conn, n_jobs=1, engine='sql', years=None,
+                      rebuild=False, bulk=False, network=None):
+    '''
+    Parameters:
+    @conn {sqlite3 Connection} connection to the studied database
+    @n_jobs {int} number of worker processes used to build the missing annual
+    tables; with 1 (default) the years are built one after another
+    @engine {string} the merging engine (see get_annual_data())
+    @years {list} the years to merge; by default all years found in the data
+    folder (see find_years())
+    @rebuild {bool} whether to rebuild crash_data from the annual tables of
+    the given years only; otherwise the years already in crash_data are kept
+    and only the other years are added
+    @bulk {bool or dict} whether to use the bulk-write mode: the PRAGMAs of
+    BULK_PRAGMAS (or the given dict of PRAGMAs) are applied, unchanged raw
+    tables are not reloaded and every table is written with executemany() in
+    one transaction (see combine_tables_sql())
+    @network {map_matching.RoadNetwork} the road network used to place the
+    crashes missing from the road segments (optional, see get_annual_data())
+    Merge all annual crash tables for the available years. Here we assume the
+    road geometry does not change over the years, while the annual average
+    daily traffic (aadt) and crash counts for different years are merged based
+    on the road inventory number (road_inv) and the milepost data of each
+    segment. If crash_data already exists, only the years it does not hold
+    yet are merged into it, and nothing is done if there are none; years
+    missing from the data folder are never removed from it. The function has
+    no return value and the final table will be saved in the database for
+    further use.
+    '''
+
+    # find the years with data in the data folder
+    if years is None:
+        years = find_years()
+
+    # get a list of tables in the database
+    table_list = get_tables(conn)
+
+    # find the years to merge: unless the final dataset is rebuilt, the years
+    # already in the existing panel are kept and only the others are added
+    panel_years = []
+    if any(table_list.name == 'crash_data'):
+        panel_years = get_panel_years(conn)
+    if rebuild:
+        new_years = list(years)
+    else:
+        new_years = [year for year in years if year not in panel_years]
+    if not new_years:
+        return
+
+    # set the PRAGMAs of the bulk-write mode
+    if bulk:
+        previous = apply_pragmas(conn, bulk)
+
+    # check if the annual data tables already exist in the database
+    # if not, call the get_annual_data() function to create the annual data
+    missing = [year for year in new_years
+               if not any(table_list.name == 'data_' + year)]
+    if n_jobs > 1 and len(missing) > 1:
+        # build all missing annual tables at the same time
+        build_annual_data_parallel(conn, missing, n_jobs, engine, bulk,
+                                   network)
+    else:
+        for year in missing:
+            annual_data = get_annual_data(year, conn, engine, bulk=bulk,
+                                          network=network)
+            if bulk:
+                write_tables(conn, {'data_' + year: annual_data})
+            else:
+                annual_data.to_sql(name='data_' + year, con=conn)
+
+    # index the annual data tables on the segment key used by the joins below
+    for year in new_years:
+        create_index(conn, 'data_' + year, ANNUAL_TABLE_INDEX)
+
+    # extend the existing panel with the new years, or build it from scratch
+    if panel_years and not rebuild:
+        append_crash_data(conn, panel_years, new_years)
+    else:
+        create_crash_data(conn, new_years)
+
     # commit changes to the database
     conn.commit()
 
+    # leave the bulk-write mode
+    if bulk:
+        apply_pragmas(conn, previous)
 
-def get_data():
+
+def get_data(columns=None):
     '''
+    Parameters:
+    @columns {list} the columns to read; by default all columns
     Return:
     @crash_data {pd dataframe} the crash dataset for modeling and analysis
     This function return the processed crash dataset in the form of a pandas
@@ -322,16 +912,17 @@ def get_data():
     # the database will be created if it does not exist
     conn = dbi.connect('crash_database')
 
-    # get a list of tables in the database
-    table_list = get_tables(conn)
-
-    # if the crash data table does not exist in the database, call the
-    # merge_annual_data() function to create the crash dataset
-    if not any(table_list.name == 'crash_data'):
-        merge_annual_data(conn)
+    # call the merge_annual_data() function to create the crash dataset if
+    # it does not exist, or to add the years that are not merged yet; the
+    # existing dataset is left as is otherwise
+    merge_annual_data(conn)
 
     # read the crash dataset as a pandas dataframe from the database
-    crash_data = pd.read_sql('SELECT * FROM crash_data', con=conn)
+    if columns is None:
+        qry_select = 'SELECT * FROM crash_data'
+    else:
+        qry_select = 'SELECT ' + ', '.join(columns) + ' FROM crash_data'
+    crash_data = pd.read_sql(qry_select, con=conn)
 
     # close the database connection
     conn.close()
@@ -340,42 +931,162 @@ def get_data():
     return crash_data
 
 
-def plot_scatter(x='Average AADT', y='Total Accident Count'):
+# maximum number of column selections kept by get_data_cached()
+DATA_CACHE_SIZE = 8
+
+# cached crash datasets, least recently used first, keyed by the database
+# path and the selected columns
+DATA_CACHE = OrderedDict()
+
+# absolute path of the crash database, found on the first cached call
+DATA_CACHE_PATH = {}
+
+
+def get_database_version(path):
+    '''
+    Parameters:
+    @path {string} path of the sqlite database file
+    Return:
+    @version {tuple} modification time and size of the database file and of
+    its write-ahead log, or None if the database does not exist
+    Every committed change to the database (e.g. a rebuilt crash_data table)
+    updates the database file or its write-ahead log, so the version changes
+    whenever the cached data may be stale.
+    '''
+    version = []
+    for file_name in [path, path + '-wal']:
+        if os.path.exists(file_name):
+            stat = os.stat(file_name)
+            version.append((stat.st_mtime, stat.st_size))
+        elif file_name == path:
+            return None
+    return tuple(version)
+
+
+def get_data_cached(columns=None):
+    '''
+    Parameters:
+    @columns {list} the columns to read; by default all columns
+    Return:
+    @crash_data {pd dataframe} the crash dataset for modeling and analysis
+    Cached version of get_data() for interactive use. The dataset (or the
+    selected columns) is kept in memory and returned directly as long as the
+    database file is unchanged; a change to the database invalidates it.
+    At most DATA_CACHE_SIZE selections are kept, the least recently used
+    one being evicted first (see also clear_data_cache()). The returned
+    dataframe is shared with the cache and should not be modified.
+    '''
+
+    # locate the crash database once
+    if 'path' not in DATA_CACHE_PATH:
+        set_directory()
+        DATA_CACHE_PATH['path'] = os.path.abspath('crash_database')
+    path = DATA_CACHE_PATH['path']
+
+    # return the cached data if the database has not changed
+    key = (path, None if columns is None else tuple(columns))
+    version = get_database_version(path)
+    if key in DATA_CACHE and DATA_CACHE[key][0] == version:
+        DATA_CACHE.move_to_end(key)
+        return DATA_CACHE[key][1]
+
+    # the selected columns can be taken from a cached full dataset
+    full_key = (path, None)
+    if columns is not None and full_key in DATA_CACHE and \
+            DATA_CACHE[full_key][0] == version:
+        crash_data = DATA_CACHE[full_key][1][list(columns)]
+    else:
+        crash_data = get_data(columns)
+        version = get_database_version(path)
+
+    # store the data and evict the least recently used selections
+    DATA_CACHE[key] = (version, crash_data)
+    DATA_CACHE.move_to_end(key)
+    while len(DATA_CACHE) > DATA_CACHE_SIZE:
+        DATA_CACHE.popitem(last=False)
+
+    return crash_data
+
+
+def clear_data_cache():
+    '''
+    Remove all datasets kept in memory by get_data_cached().
+    '''
+    DATA_CACHE.clear()
+
+
+def get_data_years():
+    '''
+    Return:
+    @years {list} years merged into the crash dataset, in column order
+    The crash dataset is created or extended first if necessary (see
+    merge_annual_data()).
+    '''
+
+    # set the current working directory to the data folder
+    set_directory()
+
+    # read the years from the columns of the crash dataset
+    conn = dbi.connect('crash_database')
+    merge_annual_data(conn)
+    years = get_panel_years(conn)
+    conn.close()
+
+    return years
+
+
+def get_scatter_variables(years):
+    '''
+    Parameters:
+    @years {list} years merged into the crash dataset (see get_data_years())
+    Return:
+    @x_variables {OrderedDict} column names of the variables that can be
+    shown on the x axis of the scatter plot, keyed by label
+    @y_variables {OrderedDict} column names of the variables that can be
+    shown on the y axis of the scatter plot, keyed by label
+    '''
+    x_variables = OrderedDict([
+        ('Speed Limit', 'spd_limt'), ('Lane Width', 'lanewid'),
+        ('No. of Lanes', 'no_lanes'), ('Left Shoulder Width', 'lshldwid'),
+        ('Right Shoulder Width', 'rshldwid'), ('Median Width', 'medwid'),
+        ('Segment Length', 'seg_lng'), ('Average Grade', 'avg_grad'),
+        ('Maximum Grade', 'max_grad'), ('Minimum Grade', 'min_grad'),
+        ('Curvature Count', 'curv_count'),
+        ('Maximum Curvature Degree', 'max_deg_curv')])
+    y_variables = OrderedDict()
+
+    # one aadt and one crash count column per year of the dataset
+    for year in sorted(years):
+        x_variables['AADT 20' + year] = 'aadt_' + year
+        y_variables['Accident Count 20' + year] = 'acc_ct_' + year
+    x_variables['Average AADT'] = 'avg_aadt'
+    y_variables['Total Accident Count'] = 'tot_acc_ct'
+
+    return x_variables, y_variables
+
+
+def plot_scatter(x='Average AADT', y='Total Accident Count', years=None):
     """
     Parameters:
     @x {string} the variable to be shown on x axis
     @y {string} the variable to be shown on y axis
+    @years {list} years merged into the crash dataset; by default they are
+    read from the database (see get_data_years())
     Draw the scatter plot of two columns in the crash dataset.
     """
 
-    # two lists of variables from which users selected to be shown on x/y axis
-    x_data = ['Speed Limit', 'Lane Width', 'No. of Lanes',
-              'Left Shoulder Width', 'Right Shoulder Width', 'Median Width',
-              'Segment Length', 'Average Grade', 'Maximum Grade',
-              'Minimum Grade', 'Curvature Count', 'Maximum Curvature Degree',
-              'AADT 2006', 'AADT 2007', 'AADT 2008', 'AADT 2009',
-              'AADT 2010', 'AADT 2011', 'Average AADT']
-
-    y_data = ['Accident Count 2006', 'Accident Count 2007',
-              'Accident Count 2008', 'Accident Count 2009',
-              'Accident Count 2010', 'Accident Count 2011',
-              'Total Accident Count']
-
-    # two lists of corresponding column names in the crash dataset
-    x_columns = ['spd_limt', 'lanewid', 'no_lanes', 'lshldwid', 'rshldwid',
-                 'medwid', 'seg_lng', 'avg_grad', 'max_grad', 'min_grad',
-                 'curv_count', 'max_deg_curv', 'aadt_06', 'aadt_07',
-                 'aadt_08', 'aadt_09', 'aadt_10', 'aadt_11', 'avg_aadt']
-
-    y_columns = ['acc_ct_06', 'acc_ct_07', 'acc_ct_08', 'acc_ct_09',
-                 'acc_ct_10', 'acc_ct_11', 'tot_acc_ct']
+    # the lists of variables from which users selected to be shown on x/y
+    # axis, with the corresponding column names in the crash dataset
+    if years is None:
+        years = get_data_years()
+    x_variables, y_variables = get_scatter_variables(years)
 
     # find the selected x/y column names
-    x_col = x_columns[x_data.index(x)]
-    y_col = y_columns[y_data.index(y)]
+    x_col = x_variables[x]
+    y_col = y_variables[y]
 
-    # get the dataset table as a pandas dataframe
-    crash_data = get_data()
+    # get the two columns of the dataset from the in-memory cache
+    crash_data = get_data_cached([x_col, y_col])
 
     # draw the scatter plot
     fig = plt.figure()
@@ -398,18 +1109,10 @@ def plot_x_vs_y():
     '''
 
     # define two lists of variables from which users can define the data
-    # shown on x/y axis of the scatter plot
-    x_data = ['Speed Limit', 'Lane Width', 'No. of Lanes',
-              'Left Shoulder Width', 'Right Shoulder Width', 'Median Width',
-              'Segment Length', 'Average Grade', 'Maximum Grade',
-              'Minimum Grade', 'Curvature Count', 'Maximum Curvature Degree',
-              'AADT 2006', 'AADT 2007', 'AADT 2008', 'AADT 2009',
-              'AADT 2010', 'AADT 2011', 'Average AADT']
-
-    y_data = ['Accident Count 2006', 'Accident Count 2007',
-              'Accident Count 2008', 'Accident Count 2009',
-              'Accident Count 2010', 'Accident Count 2011',
-              'Total Accident Count']
+    # shown on x/y axis of the scatter plot, for the years of the dataset
+    years = get_data_years()
+    x_variables, y_variables = get_scatter_variables(years)
 
     # interactive scatter plot function
-    interact(plot_scatter, x=x_data, y=y_data)
+    interact(plot_scatter, x=list(x_variables), y=list(y_variables),
+             years=fixed(years))
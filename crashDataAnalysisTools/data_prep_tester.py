@@ -35,6 +35,37 @@ class DataPrepTest(unittest.TestCase):
         # returned dataframe
         self.assertTrue('name' in tables.columns.values)
 
+    # test create_indexes() function
+    def test_create_indexes(self):
+        '''
+        Create an accident table in a scratch database, index it and check
+        that a (route, milepost) lookup is answered through the new index.
+        '''
+
+        # set up an in-memory database with a small accident table
+        conn = dbi.connect(':memory:')
+        acc = pd.DataFrame({'rd_inv': ['005', '090'],
+                            'milepost': [1.5, 20.2],
+                            'caseno': [1, 2]})
+        acc.to_sql(name='acc', con=conn)
+
+        # call the function to index the raw tables
+        create_indexes(conn)
+
+        # get the query plan of a range lookup
+        plan = conn.execute('''
+                            EXPLAIN QUERY PLAN
+                            SELECT caseno FROM acc
+                            WHERE rd_inv = '005' AND
+                                  milepost BETWEEN 1 AND 2
+                            ''').fetchall()
+
+        # close the database connection
+        conn.close()
+
+        # check if the lookup searches the composite index
+        self.assertTrue('idx_acc' in str(plan))
+
     # test get_annual_data() function
     def test_get_annual_data(self):
         '''
@@ -72,6 +103,33 @@ class DataPrepTest(unittest.TestCase):
         # check if a new 2008 table has been created in the database
         self.assertTrue('data_08' in tables.name.tolist())
 
+    # test get_annual_data() function with a road network
+    def test_get_annual_data_network(self):
+        '''
+        The crashes are only map matched when the accident file has
+        coordinates, which the HSIS files do not have: with a road network,
+        loaded as a whole or streamed, the 2008 data should be the same.
+        '''
+
+        # set the working directory to the data folder
+        set_directory()
+
+        # a one-polyline road network
+        network = map_matching.RoadNetwork([-122.3, -122.2], [47.6, 47.6],
+                                           [0, 2], ['005'])
+
+        conn = dbi.connect(':memory:')
+        data_08 = get_annual_data('08', conn, engine='numpy')
+        matched = get_annual_data('08', conn, engine='numpy',
+                                  network=network)
+        streamed = get_annual_data('08', conn, engine='numpy',
+                                   acc_chunksize=10000, network=network)
+        conn.close()
+
+        self.assertTrue(matched.equals(data_08))
+        self.assertTrue((streamed['acc_count'].values ==
+                         data_08['acc_count'].values).all())
+
     # test merge_annual_data() function
     def test_merge_annual_data(self):
         '''
@@ -104,6 +162,143 @@ class DataPrepTest(unittest.TestCase):
         # check if a new crash_data table has been created in the database
         self.assertTrue('crash_data' in tables.name.tolist())
 
+    # test merge_annual_data() function with parallel workers
+    def test_merge_annual_data_parallel(self):
+        '''
+        Remove two annual tables and the final dataset, then rebuild them with
+        two worker processes. Both annual tables should be written back to the
+        database together with the final dataset.
+        '''
+
+        # set the working directory to the data folder
+        set_directory()
+
+        # set up a connection to the database
+        conn = dbi.connect('crash_database')
+
+        # drop the tables that should be rebuilt
+        cu = conn.cursor()
+        cu.execute('DROP TABLE IF EXISTS data_10')
+        cu.execute('DROP TABLE IF EXISTS data_11')
+        cu.execute('DROP TABLE IF EXISTS crash_data')
+
+        # call the function with two worker processes
+        merge_annual_data(conn, n_jobs=2)
+
+        # get the database table name list
+        tables = get_tables(conn).name.tolist()
+
+        # close the database connection
+        conn.close()
+
+        # check if the tables have been rebuilt
+        self.assertTrue('data_10' in tables)
+        self.assertTrue('data_11' in tables)
+        self.assertTrue('crash_data' in tables)
+
+    # test write_tables() function
+    def test_write_tables(self):
+        '''
+        Write two small tables with missing values in one transaction and read
+        them back from the database.
+        '''
+
+        # set up an in-memory database
+        conn = dbi.connect(':memory:')
+
+        # call the function to write the tables
+        road = pd.DataFrame({'road_inv': ['005', None], 'aadt': [100, 200]})
+        acc = pd.DataFrame({'milepost': [1.5, float('nan')]})
+        write_tables(conn, {'road': road, 'acc': acc})
+
+        # read the tables back
+        road_db = pd.read_sql('SELECT * FROM road', con=conn)
+        acc_db = pd.read_sql('SELECT * FROM acc', con=conn)
+
+        # close the database connection
+        conn.close()
+
+        # check the values and the missing values of the tables
+        self.assertEqual(road_db.aadt.tolist(), [100, 200])
+        self.assertTrue(pd.isnull(road_db.road_inv[1]))
+        self.assertTrue(pd.isnull(acc_db.milepost[1]))
+
+    # test find_years() function
+    def test_find_years(self):
+
+        # set the working directory to the data folder
+        set_directory()
+
+        # call the function to find the years with data
+        years = find_years()
+
+        # check if the six years of HSIS data have been found
+        self.assertEqual(years, ['06', '07', '08', '09', '10', '11'])
+
+    # test merge_annual_data() function when adding a new year
+    def test_merge_annual_data_incremental(self):
+        '''
+        Rebuild the final dataset without the last year, then merge again so
+        that only the last year is added to the existing table. The average
+        aadt should then agree with the six annual aadt columns.
+        '''
+
+        # set the working directory to the data folder
+        set_directory()
+
+        # set up a connection to the database
+        conn = dbi.connect('crash_database')
+
+        # build the final dataset from the first five years only
+        merge_annual_data(conn, years=['06', '07', '08', '09', '10'],
+                          rebuild=True)
+
+        # add the last year to the existing final dataset
+        merge_annual_data(conn)
+
+        # read the final dataset
+        crash_data = pd.read_sql('SELECT * FROM crash_data', con=conn)
+
+        # close the database connection
+        conn.close()
+
+        # check the new columns and the updated average aadt
+        self.assertTrue('aadt_11' in crash_data.columns)
+        self.assertTrue('acc_ct_11' in crash_data.columns)
+        aadt = crash_data[['aadt_06', 'aadt_07', 'aadt_08', 'aadt_09',
+                           'aadt_10', 'aadt_11']].dropna()
+        self.assertTrue(((aadt.sum(axis=1) / 6 -
+                          crash_data.avg_aadt[aadt.index]).abs() < 1).all())
+
+    # test merge_annual_data() function with a subset of the years
+    def test_merge_annual_data_keeps_panel(self):
+        '''
+        Merging fewer years than the existing final dataset holds, or no year
+        at all, should leave the final dataset unchanged.
+        '''
+
+        # set the working directory to the data folder
+        set_directory()
+
+        # set up a connection to the database
+        conn = dbi.connect('crash_database')
+
+        # make sure the final dataset holds all six years
+        merge_annual_data(conn)
+        before = pd.read_sql('SELECT * FROM crash_data', con=conn)
+
+        # merge a subset of the years, then no year
+        merge_annual_data(conn, years=['06', '07', '08', '09', '10'])
+        merge_annual_data(conn, years=[])
+        after = pd.read_sql('SELECT * FROM crash_data', con=conn)
+
+        # close the database connection
+        conn.close()
+
+        # check that no year has been dropped
+        self.assertTrue('aadt_11' in after.columns)
+        self.assertTrue(before.equals(after))
+
     # test get_data() function
     def test_get_data(self):
 
@@ -113,6 +308,29 @@ class DataPrepTest(unittest.TestCase):
         # check if the returned dataframe is not empty
         self.assertFalse(crash_data.empty)
 
+    # test get_data_cached() function
+    def test_get_data_cached(self):
+        '''
+        A second call with the same columns should return the cached
+        dataframe, while a change to the database file or an explicit
+        eviction should read the data again.
+        '''
+
+        # call the function twice with the same columns
+        first = get_data_cached(['avg_aadt', 'tot_acc_ct'])
+        second = get_data_cached(['avg_aadt', 'tot_acc_ct'])
+        self.assertTrue(first is second)
+        self.assertEqual(list(first.columns), ['avg_aadt', 'tot_acc_ct'])
+
+        # a change of the database file invalidates the cache
+        os.utime('crash_database', None)
+        third = get_data_cached(['avg_aadt', 'tot_acc_ct'])
+        self.assertFalse(third is second)
+
+        # so does an explicit eviction
+        clear_data_cache()
+        self.assertFalse(get_data_cached(['avg_aadt', 'tot_acc_ct']) is third)
+
 
 if __name__ == '__main__':
     unittest.main()
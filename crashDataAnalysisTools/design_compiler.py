@@ -0,0 +1,385 @@
+import itertools
+import re
+import types
+import weakref
+
+import numpy as np
+import pandas as pd
+import patsy
+import patsy.builtins
+from patsy.categorical import categorical_to_int
+from patsy.eval import ast_names
+
+# compiled design of every model, see get_design_compiler()
+COMPILED_DESIGNS = weakref.WeakKeyDictionary()
+
+# factor codes evaluated straight from a column of the data:
+# 'var' and 'C(var)'
+VARIABLE_CODE = re.compile(r'^(?:C\(\s*)?(\w+)(?:\s*\))?$')
+
+
+class DesignCompiler(object):
+    """
+    Design matrix builder compiled from the patsy description of a fitted
+    model (its DesignInfo). The formula is parsed and the levels of the
+    categorical variables are found once; a batch of new data is then turned
+    straight into a contiguous float64 design matrix: numerical variables
+    are read from their column, categorical variables are converted to
+    integer codes and their dummy columns are rows of the contrast matrix
+    picked by the codes. Factors other than plain variables (e.g.
+    np.log(aadt)) are evaluated by patsy with the state saved at fit time.
+    """
+
+    def __init__(self, design_info):
+        self.design_info = design_info
+        self.column_names = list(design_info.column_names)
+        self.n_columns = len(self.column_names)
+
+        # factors of the model: (factor, type, categories, variable)
+        self.factors = []
+        for factor, info in design_info.factor_infos.items():
+            match = VARIABLE_CODE.match(factor.code)
+            self.factors.append((factor, info.type, info.categories,
+                                 None if match is None else match.group(1)))
+
+        # columns of every subterm: (first column, number of columns, factors
+        # with their contrast matrix, if any)
+        self.subterms = []
+        for term, subterms in design_info.term_codings.items():
+            column = design_info.term_slices[term].start
+            for subterm in subterms:
+                factors = [(factor, subterm.contrast_matrices[factor].matrix
+                            if factor in subterm.contrast_matrices else None)
+                           for factor in subterm.factors]
+                self.subterms.append((column, subterm.num_columns, factors))
+                column += subterm.num_columns
+
+    def evaluate(self, data):
+        """
+        Parameters:
+        @data {pd dataframe or dict} the raw predictor variables
+        Return:
+        @values {dict} value of every factor: a 2d float array for the
+        numerical factors, the integer codes of the levels for the
+        categorical factors
+        """
+        values = {}
+        for factor, kind, categories, variable in self.factors:
+            if variable is not None and variable in data:
+                value = data[variable]
+            else:
+                state = self.design_info.factor_infos[factor].state
+                value = factor.eval(state, data)
+
+            if kind == 'numerical':
+                value = np.asarray(value, dtype=np.float64)
+                values[factor] = value.reshape(len(value), -1)
+            elif variable is not None:
+                # the levels are looked up explicitly: missing values and
+                # unknown levels get the code -1
+                codes = pd.Index(categories).get_indexer(np.asarray(value))
+                if np.any(codes < 0):
+                    raise ValueError('missing value or unknown level of %s '
+                                     '(the model levels are %s)' %
+                                     (factor.code, list(categories)))
+                values[factor] = codes
+            else:
+                values[factor] = categorical_to_int(
+                    value, categories, patsy.NAAction('raise'), factor)
+        return values
+
+    def build(self, values, start=0, stop=None, out=None):
+        """
+        Parameters:
+        @values {dict} value of every factor (see evaluate())
+        @start {int} first row to build
+        @stop {int} last row to build (excluded); by default the last row
+        of the data
+        @out {numpy array} array to write the rows into (optional)
+        Return:
+        @design {numpy array} the rows of the design matrix
+        """
+        n_rows = len(next(iter(values.values()))) if values else stop
+        stop = n_rows if stop is None else min(stop, n_rows)
+        if out is None:
+            out = np.empty((stop - start, self.n_columns), dtype=np.float64)
+
+        for column, n_columns, factors in self.subterms:
+            block = out[:, column:column + n_columns]
+            if not factors:
+                # intercept
+                block[:] = 1
+            elif len(factors) == 1:
+                factor, contrast = factors[0]
+                if contrast is None:
+                    block[:] = values[factor][start:stop]
+                else:
+                    np.take(contrast, values[factor][start:stop], axis=0,
+                            out=block)
+            else:
+                # interactions: the left-most factor varies fastest, as in
+                # patsy
+                columns = []
+                for factor, contrast in factors:
+                    if contrast is None:
+                        columns.append(values[factor][start:stop])
+                    else:
+                        columns.append(contrast[values[factor][start:stop]])
+                combinations = itertools.product(
+                    *[range(x.shape[1]) for x in reversed(columns)])
+                for i, combination in enumerate(combinations):
+                    block[:, i] = 1
+                    for x, j in zip(columns, reversed(combination)):
+                        block[:, i] *= x[:, j]
+        return out
+
+    def count_rows(self, values, data=None):
+        """
+        Parameters:
+        @values {dict} value of every factor (see evaluate())
+        @data {pd dataframe or dict} the raw predictor variables, used when
+        the model has no factor (intercept only)
+        Return:
+        @n_rows {int} number of rows of the design matrix
+        """
+        if values:
+            return len(next(iter(values.values())))
+        if isinstance(data, pd.DataFrame):
+            return len(data)
+        if isinstance(data, dict) and data:
+            return len(next(iter(data.values())))
+        return 0
+
+    def __call__(self, data, out=None):
+        """
+        Parameters:
+        @data {pd dataframe or dict} the raw predictor variables
+        @out {numpy array} array to write the design matrix into (optional)
+        Return:
+        @design {numpy array} the design matrix, one column per coefficient
+        """
+        values = self.evaluate(data)
+        return self.build(values, 0, self.count_rows(values, data), out)
+
+
+def fix_levels(data, levels):
+    """
+    Parameters:
+    @data {pd dataframe} the raw predictor variables
+    @levels {dict} levels of the categorical variables of a model, by
+    factor code (e.g. 'C(curve)')
+    Return:
+    @data {pd dataframe} the data with the categorical variables cast to
+    pd categoricals with the model levels
+    """
+    columns = {}
+    for code, var_levels in levels.items():
+        match = VARIABLE_CODE.match(code)
+        if match is not None and match.group(1) in data.columns:
+            var = match.group(1)
+            columns[var] = pd.Categorical(data[var], categories=var_levels)
+    if columns:
+        data = data.assign(**columns)
+    return data
+
+
+def get_formula_variables(design_info):
+    """
+    Parameters:
+    @design_info {patsy DesignInfo} description of a design matrix
+    Return:
+    @variables {list} names of the raw predictor variables read by the
+    factors, e.g. ['aadt', 'curve'] for 'np.log(aadt)' and 'C(curve)'
+    """
+    variables = []
+    for factor, info in design_info.factor_infos.items():
+        namespace = info.state['eval_env'].namespace
+        for name in ast_names(factor.code):
+            # functions and modules (np, C, center, ...) are not variables
+            value = namespace.get(name, getattr(patsy.builtins, name, None))
+            if callable(value) or isinstance(value, types.ModuleType):
+                continue
+            if name not in variables:
+                variables.append(name)
+    return variables
+
+
+def get_reference_row(design_info, data):
+    """
+    Parameters:
+    @design_info {patsy DesignInfo} description of a design matrix
+    @data {pd dataframe} the data the model was fit on
+    Return:
+    @reference {dict} values of the raw predictor variables in the first
+    complete row of the data, from which the design can be rebuilt (see
+    get_design_info())
+    """
+    data = data[get_formula_variables(design_info)].dropna().iloc[:1]
+    return dict((col, value.item() if isinstance(value, np.generic)
+                 else value) for col, value in data.iloc[0].items())
+
+
+def encode_state(value):
+    """
+    Parameters:
+    @value {object} an attribute of a stateful transform (e.g. the sum and
+    count of center())
+    Return:
+    @encoded {object} the value with the numpy arrays and scalars converted
+    to json types
+    """
+    # extended precision floats (kept by center() and standardize()) are
+    # saved as float64
+    if isinstance(value, np.ndarray):
+        values = value.astype(np.float64) if value.dtype.kind == 'f' \
+            else value
+        return {'array': values.tolist(), 'dtype': str(value.dtype)}
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [encode_state(x) for x in value]
+    if isinstance(value, dict):
+        return dict((key, encode_state(x)) for key, x in value.items())
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    raise ValueError('cannot save a transform state of type %s' %
+                     type(value).__name__)
+
+
+def decode_state(value):
+    """
+    Parameters:
+    @value {object} an attribute encoded by encode_state()
+    Return:
+    @decoded {object} the attribute with its numpy arrays
+    """
+    if isinstance(value, dict) and set(value) == {'array', 'dtype'}:
+        # extended precision floats are not available on every platform
+        dtype = value['dtype'] if hasattr(np, value['dtype']) else None
+        return np.array(value['array'], dtype=dtype)
+    if isinstance(value, dict):
+        return dict((key, decode_state(x)) for key, x in value.items())
+    if isinstance(value, list):
+        return [decode_state(x) for x in value]
+    return value
+
+
+def get_transform_states(design_info):
+    """
+    Parameters:
+    @design_info {patsy DesignInfo} description of a design matrix
+    Return:
+    @states {dict} attributes of the stateful transforms (center(),
+    standardize(), bs(), ...) learned at fit time, by factor code and
+    transform name, as json types
+    """
+    states = {}
+    for factor, info in design_info.factor_infos.items():
+        transforms = info.state.get('transforms', {})
+        if transforms:
+            states[factor.code] = dict(
+                (name, {'class': type(obj).__name__,
+                        'state': encode_state(vars(obj))})
+                for name, obj in transforms.items())
+    return states
+
+
+def set_transform_states(design_info, states):
+    """
+    Parameters:
+    @design_info {patsy DesignInfo} description of a design matrix
+    @states {dict} the transform states of the fitted model (see
+    get_transform_states())
+    Restore the state learned at fit time into the stateful transforms of a
+    rebuilt design.
+    """
+    for factor, info in design_info.factor_infos.items():
+        for name, obj in info.state.get('transforms', {}).items():
+            saved = states.get(factor.code, {}).get(name)
+            if saved is None or saved['class'] != type(obj).__name__:
+                raise ValueError('no saved state for the transform %s of %s'
+                                 % (type(obj).__name__, factor.code))
+            vars(obj).clear()
+            vars(obj).update(decode_state(saved['state']))
+
+
+def get_design_info(model, data=None):
+    """
+    Parameters:
+    @model {statsmodels genmod, NBResults or SPFModel} fitted model
+    @data {pd dataframe} the raw predictor variables, only used for models
+    keeping their formula and levels but no patsy description (SPFModel)
+    without a reference row
+    Return:
+    @design_info {patsy DesignInfo} description of the design matrix, or
+    None if the model was not fit from a formula
+    The design of an SPFModel is rebuilt from its formula on one row (its
+    reference row, or the first row of the data); the levels of the
+    categorical variables and the state of the stateful transforms are then
+    those of the fitted model, not those of that row.
+    """
+    design_info = getattr(model, 'design_info', None)
+    if design_info is not None:
+        return design_info
+
+    # statsmodels results keep it in the model data
+    model_data = getattr(getattr(model, 'model', None), 'data', None)
+    design_info = getattr(model_data, 'design_info',
+                          getattr(model_data, 'model_spec', None))
+    if design_info is not None:
+        return design_info
+
+    # rebuild it from the formula, with the levels and transform states of
+    # the fitted model
+    formula = getattr(model, 'formula', None)
+    levels = getattr(model, 'levels', None)
+    if getattr(model, 'reference', None) is not None:
+        data = pd.DataFrame([model.reference])
+    if formula is None or levels is None or data is None:
+        return None
+    data = fix_levels(pd.DataFrame(data).iloc[:1], levels)
+    design_info = patsy.incr_dbuilder(formula.split('~', 1)[1],
+                                      lambda: iter([data]),
+                                      NA_action='raise')
+    transforms = getattr(model, 'transforms', None)
+    if transforms is not None:
+        set_transform_states(design_info, transforms)
+    names = list(getattr(model, 'names', design_info.column_names))
+    if design_info.column_names != names:
+        raise ValueError('the design matrix columns %s do not match the '
+                         'model coefficients %s' %
+                         (design_info.column_names, names))
+    return design_info
+
+
+def get_design_compiler(model, data=None):
+    """
+    Parameters:
+    @model {statsmodels genmod, NBResults or SPFModel} fitted model
+    @data {pd dataframe} the raw predictor variables (see get_design_info())
+    Return:
+    @compiler {DesignCompiler} the design matrix builder of the model, or
+    None if the model was not fit from a formula
+    The compiler is built once per model and cached (as long as the model
+    exists), so the prediction functions only parse the formula on their
+    first call.
+    """
+    try:
+        compiler = COMPILED_DESIGNS.get(model)
+    except TypeError:
+        # models that cannot be weakly referenced are not cached
+        compiler = None
+    if compiler is not None:
+        return compiler
+
+    design_info = get_design_info(model, data)
+    if design_info is None:
+        return None
+    compiler = DesignCompiler(design_info)
+    try:
+        COMPILED_DESIGNS[model] = compiler
+    except TypeError:
+        pass
+    return compiler
@@ -0,0 +1,132 @@
+from crash_modeling_tools import calc_mu_hat_nb, calc_var_eta_hat, \
+    compute_spf
+from design_compiler import *
+import numpy as np
+import pandas as pd
+import patsy
+import statsmodels.api as sm
+import statsmodels.formula.api as smf
+import unittest
+import warnings
+
+
+class DesignCompilerTester(unittest.TestCase):
+    """
+    The compiled design matrices are checked against those built by patsy,
+    for a model fit on the I-90 test dataset.
+    """
+
+    # load in a standard dataset and fit a nb regression model
+    crash_data_path = '../data/unit_test_data/crash_data_final_90_test.csv'
+    crash_data = pd.read_csv(crash_data_path)
+    crash_data = crash_data.dropna()
+    crash_data['log_aadt'] = crash_data.log_avg_aadt.astype(np.float64)
+    offset_term = np.log(crash_data['seg_lng'] * 3)
+    mod_nb = smf.glm('tot_acc_ct~log_aadt+lanewid+avg_grad+C(curve)+\
+                     C(surf_typ)', data=crash_data, offset=offset_term,
+                     family=sm.families.NegativeBinomial()).fit()
+
+    # load a new dataset on which to apply the model
+    eb_data_path = '../data/unit_test_data/crash_data_eb_test.csv'
+    data_eb = pd.read_csv(eb_data_path)
+    data_eb = data_eb.dropna()
+    data_eb['log_aadt'] = data_eb.log_avg_aadt.astype(np.float64)
+
+    def test_compiled_design(self):
+        """
+        The compiled design matrix should be the patsy design matrix, as a
+        contiguous float64 array, and the compiler should be cached.
+        """
+        compiler = get_design_compiler(self.mod_nb)
+        self.assertTrue(compiler is get_design_compiler(self.mod_nb))
+        self.assertTrue(compiler.column_names ==
+                        list(self.mod_nb.params.index))
+
+        design = compiler(self.data_eb)
+        expected = patsy.build_design_matrices(
+            [get_design_info(self.mod_nb)], self.data_eb)[0]
+        self.assertTrue(design.dtype == np.float64)
+        self.assertTrue(design.flags['C_CONTIGUOUS'])
+        self.assertTrue(np.array_equal(design, np.asarray(expected)))
+
+        # the spf is the statsmodels prediction
+        self.assertTrue(np.allclose(compute_spf(self.mod_nb, self.data_eb),
+                                    self.mod_nb.predict(self.data_eb)))
+
+    def test_transforms_and_interactions(self):
+        """
+        Factors evaluated by patsy and interactions should give the patsy
+        columns too, in chunks as well as in one piece.
+        """
+        formula = 'tot_acc_ct~np.sqrt(lanewid)+C(curve):log_aadt+' \
+                  'C(surf_typ)*avg_grad'
+        model = smf.glm(formula, data=self.crash_data,
+                        family=sm.families.Poisson()).fit()
+        expected = patsy.build_design_matrices(
+            [get_design_info(model)], self.data_eb)[0]
+
+        values = get_design_compiler(model).evaluate(self.data_eb)
+        design = np.vstack([get_design_compiler(model).build(values, i,
+                                                             i + 100)
+                            for i in range(0, len(self.data_eb), 100)])
+        self.assertTrue(np.allclose(design, np.asarray(expected)))
+        self.assertTrue(np.allclose(calc_mu_hat_nb(model, self.data_eb,
+                                                   100)[:, 0],
+                                    model.predict(self.data_eb)))
+
+    def test_unknown_level(self):
+        """
+        A level the model was not fit on should raise an error.
+        """
+        data = self.data_eb.copy()
+        data['curve'] = 7
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            with self.assertRaises(ValueError):
+                get_design_compiler(self.mod_nb)(data)
+
+        # and so should a missing value
+        data = self.data_eb.copy()
+        data['surf_typ'] = data.surf_typ.astype(object)
+        data.loc[data.index[0], 'surf_typ'] = None
+        with self.assertRaises(ValueError):
+            get_design_compiler(self.mod_nb)(data)
+
+    def test_dict_predictors(self):
+        """
+        The raw predictors given as a dict of arrays, as accepted by patsy,
+        should give the statsmodels prediction.
+        """
+        data = {col: self.data_eb[col].values for col in self.data_eb}
+        expected = self.mod_nb.predict(self.data_eb)
+        self.assertTrue(np.allclose(compute_spf(self.mod_nb, data),
+                                    expected))
+        self.assertTrue(np.allclose(calc_mu_hat_nb(self.mod_nb, data)[:, 0],
+                                    expected))
+        self.assertTrue(np.allclose(
+            calc_var_eta_hat(self.mod_nb, data)[:, 0],
+            calc_var_eta_hat(self.mod_nb, self.data_eb)[:, 0]))
+
+    def test_permuted_columns(self):
+        """
+        Raw predictors whose columns are the coefficient names in another
+        order should give the statsmodels prediction, and so should a design
+        matrix with permuted columns.
+        """
+        model = smf.glm('tot_acc_ct~lanewid+avg_grad', data=self.crash_data,
+                        family=sm.families.NegativeBinomial()).fit()
+        data = self.data_eb[['avg_grad', 'lanewid']]
+        expected = model.predict(data)
+        self.assertTrue(np.allclose(compute_spf(model, data), expected))
+        self.assertTrue(np.allclose(calc_mu_hat_nb(model, data)[:, 0],
+                                    expected))
+
+        design = patsy.dmatrix(get_design_info(model), data,
+                               return_type='dataframe')
+        permuted = design[['avg_grad', 'Intercept', 'lanewid']]
+        self.assertTrue(np.allclose(calc_mu_hat_nb(model, permuted)[:, 0],
+                                    expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
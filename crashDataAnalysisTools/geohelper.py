@@ -1,9 +1,235 @@
+import hashlib
+import json
+import os
+
 import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.collections import LineCollection
 
 from mpl_toolkits.basemap import Basemap
 
+# first bytes of a road geometry cache file
+GEOMETRY_MAGIC = b'ROADGEOM1\n'
+
+# default folder (relative to the shapefile folder) of the road geometry
+# cache files
+GEOMETRY_CACHE_DIR = 'geometry_cache'
+
+
+def get_map_params(llon, llat, rlon, rlat):
+    '''
+    A function to get the projection of the map of an area
+    Parameters:
+    @llon {float} longitude of the top left corner
+    @llat {float} latitude of the top left corner
+    @rlon {float} longitude of the bottom right corner
+    @rlat {float} latitude of the bottom right corner
+    Return:
+    @map_params {dict} the Basemap parameters of the map projection
+    '''
+    return {'llcrnrlon': llon, 'llcrnrlat': llat, 'urcrnrlon': rlon,
+            'urcrnrlat': rlat, 'projection': 'tmerc',
+            'lat_0': (llat+rlat)/2, 'lon_0': (llon+rlon)/2}
+
+
+def read_shapefile_lines(shpurl):
+    '''
+    A function to read the polylines of a shapefile
+    Parameters:
+    @shpurl {string} the shapefile url, without suffix
+    Return:
+    @lons {numpy array} longitudes of the vertices of all the polylines
+    @lats {numpy array} latitudes of the vertices of all the polylines
+    @offsets {numpy array} index of the first vertex of every polyline
+    (every part of a shape), followed by the number of vertices
+    '''
+    # pyshp is only needed to read the shapefiles
+    import shapefile
+
+    reader = shapefile.Reader(shpurl)
+    points = []
+    sizes = []
+    for shape in reader.iterShapes():
+        parts = list(shape.parts) + [len(shape.points)]
+        for start, stop in zip(parts[:-1], parts[1:]):
+            if stop > start:
+                points.extend(shape.points[start:stop])
+                sizes.append(stop - start)
+    reader.close()
+
+    points = np.array(points, dtype=np.float64).reshape(-1, 2)
+    offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+    return points[:, 0], points[:, 1], offsets
+
+
+def get_geometry_cache_file(shpurl, map_params, cache_folder=None):
+    '''
+    A function to get the name of the road geometry cache file of a
+    shapefile drawn with a projection
+    Parameters:
+    @shpurl {string} the shapefile url, without suffix
+    @map_params {dict} the Basemap parameters of the map projection
+    @cache_folder {string} folder of the cache files (default: the
+    GEOMETRY_CACHE_DIR folder next to the shapefile)
+    Return:
+    @file_name {string} path of the cache file; the name changes with the
+    shapefile, its size and modification time, and the projection
+    '''
+    shp = os.path.abspath(shpurl + '.shp')
+    stat = os.stat(shp)
+    key = json.dumps({'shapefile': shp, 'size': stat.st_size,
+                      'mtime': stat.st_mtime, 'map': map_params},
+                     sort_keys=True)
+    if cache_folder is None:
+        cache_folder = os.path.join(os.path.dirname(shp), GEOMETRY_CACHE_DIR)
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(cache_folder, '%s.%s.geom' % (
+        os.path.basename(shpurl), digest))
+
 
-def draw_road_network_map(shpurl, llon, llat, rlon, rlat):
+def save_road_geometry(file_name, xy, offsets):
+    '''
+    A function to save projected polylines
+    Parameters:
+    @file_name {string} path of the cache file
+    @xy {numpy array} projected coordinates of all the vertices (n x 2)
+    @offsets {numpy array} index of the first vertex of every polyline,
+    followed by the number of vertices
+    Return: Nothing
+    The file holds a small json header (the array sizes) followed by the
+    coordinates as float64 and the offsets as int64, aligned so that they
+    can be memory mapped. The file is written under a temporary name and
+    renamed, so readers never see a partial file.
+    '''
+    header = json.dumps({'vertices': len(xy),
+                         'offsets': len(offsets)}).encode()
+    offset = len(GEOMETRY_MAGIC) + 8 + len(header)
+    padding = -offset % 8
+
+    temp_name = '%s.%d.tmp' % (file_name, os.getpid())
+    with open(temp_name, 'wb') as f:
+        f.write(GEOMETRY_MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        f.write(b'\0' * padding)
+        f.write(np.ascontiguousarray(xy, dtype=np.float64).tobytes())
+        f.write(np.ascontiguousarray(offsets, dtype=np.int64).tobytes())
+    os.replace(temp_name, file_name)
+
+
+def load_road_geometry(file_name, mmap=True):
+    '''
+    A function to load projected polylines (see save_road_geometry())
+    Parameters:
+    @file_name {string} path of the cache file
+    @mmap {bool} whether to memory map the arrays instead of reading them
+    Return:
+    @xy {numpy array} projected coordinates of all the vertices (n x 2)
+    @offsets {numpy array} index of the first vertex of every polyline,
+    followed by the number of vertices
+    '''
+    with open(file_name, 'rb') as f:
+        if f.read(len(GEOMETRY_MAGIC)) != GEOMETRY_MAGIC:
+            raise ValueError(file_name + ' is not a road geometry file')
+        size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(size).decode())
+        offset = len(GEOMETRY_MAGIC) + 8 + size
+        offset += -offset % 8
+
+        n_vertices = header['vertices']
+        n_offsets = header['offsets']
+        if mmap:
+            xy = np.memmap(file_name, dtype=np.float64, mode='r',
+                           offset=offset, shape=(n_vertices, 2))
+            offsets = np.memmap(file_name, dtype=np.int64, mode='r',
+                                offset=offset + 16 * n_vertices,
+                                shape=(n_offsets,))
+        else:
+            f.seek(offset)
+            xy = np.fromfile(f, dtype=np.float64,
+                             count=2 * n_vertices).reshape(n_vertices, 2)
+            offsets = np.fromfile(f, dtype=np.int64, count=n_offsets)
+    return xy, offsets
+
+
+def cache_road_geometry(shpurl, map, map_params, cache_folder=None):
+    '''
+    A function to get the polylines of a shapefile projected on a map,
+    from the cache file if there is one
+    Parameters:
+    @shpurl {string} the shapefile url, without suffix
+    @map {Basemap} the map canvas
+    @map_params {dict} the Basemap parameters of the map projection
+    @cache_folder {string} folder of the cache files (default: the
+    GEOMETRY_CACHE_DIR folder next to the shapefile)
+    Return:
+    @xy {numpy array} projected coordinates of all the vertices (n x 2)
+    @offsets {numpy array} index of the first vertex of every polyline,
+    followed by the number of vertices
+    The first draw of a shapefile with a projection reads the shapefile,
+    projects all the vertices in one call and saves them; the next draws
+    memory map the saved arrays.
+    '''
+    file_name = get_geometry_cache_file(shpurl, map_params, cache_folder)
+    if not os.path.exists(file_name):
+        if not os.path.isdir(os.path.dirname(file_name)):
+            os.makedirs(os.path.dirname(file_name))
+        lons, lats, offsets = read_shapefile_lines(shpurl)
+        x, y = map(lons, lats)
+        save_road_geometry(file_name, np.column_stack((x, y)), offsets)
+    return load_road_geometry(file_name)
+
+
+def draw_road_geometry(map, xy, offsets, ax=None, **kwargs):
+    '''
+    A function to draw projected polylines as a single line collection
+    Parameters:
+    @map {Basemap} the map canvas
+    @xy {numpy array} projected coordinates of all the vertices (n x 2)
+    @offsets {numpy array} index of the first vertex of every polyline,
+    followed by the number of vertices
+    @ax {matplotlib axes} axes to draw on (default: the current axes)
+    @kwargs {dict} properties of the lines (default: black, 0.5 wide, as
+    Basemap.readshapefile)
+    Return:
+    @lines {LineCollection} the drawn lines
+    '''
+    if ax is None:
+        ax = plt.gca()
+    kwargs.setdefault('color', 'k')
+    kwargs.setdefault('linewidth', 0.5)
+    lines = LineCollection(np.split(np.asarray(xy), offsets[1:-1]),
+                           **kwargs)
+    ax.add_collection(lines)
+    map.set_axes_limits(ax=ax)
+    return lines
+
+
+def draw_road_network(shpurl, llon, llat, rlon, rlat, cache_folder=None):
+    '''
+    A function to set up a map canvas and draw a road network on it
+    Parameters:
+    @shpurl {string} the shapefile url, without suffix,
+    e.g. '../data/highway/wgs84'
+    @llon {float} longitude of the top left corner
+    @llat {float} latitude of the top left corner
+    @rlon {float} longitude of the bottom right corner
+    @rlat {float} latitude of the bottom right corner
+    @cache_folder {string} folder of the road geometry cache files
+    (default: the GEOMETRY_CACHE_DIR folder next to the shapefile)
+    Return:
+    @map {Basemap} the map canvas
+    '''
+    map_params = get_map_params(llon, llat, rlon, rlat)
+    # the road network is the only layer drawn, so no coastline data is
+    # loaded
+    map = Basemap(resolution=None, **map_params)
+    xy, offsets = cache_road_geometry(shpurl, map, map_params, cache_folder)
+    draw_road_geometry(map, xy, offsets)
+    return map
+
+
+def draw_road_network_map(shpurl, llon, llat, rlon, rlat, cache_folder=None):
     '''
     A function to plot a road network from shapefile
     Parameters:
@@ -13,20 +239,18 @@ def draw_road_network_map(shpurl, llon, llat, rlon, rlat):
     @llat {float} latitude of the top left corner
     @rlon {float} longitude of the bottom right corner
     @rlat {float} latitude of the bottom right corner
+    @cache_folder {string} folder of the road geometry cache files
+    (default: the GEOMETRY_CACHE_DIR folder next to the shapefile)
     Return: Nothing
     '''
-    # set up a map canvas
-    map = Basemap(llcrnrlon=llon, llcrnrlat=llat,
-                  urcrnrlon=rlon, urcrnrlat=rlat, resolution='i',
-                  projection='tmerc', lat_0=(llat+rlat)/2,
-                  lon_0=(llon+rlon)/2)
-    # read the shapefile
-    map.readshapefile(shpurl, 'highway')
+    # set up a map canvas and draw the road network
+    draw_road_network(shpurl, llon, llat, rlon, rlat, cache_folder)
     # show the map
     plt.show()
 
 
-def draw_crash_map(shpurl, name, llon, llat, rlon, rlat, lons, lats, data):
+def draw_crash_map(shpurl, name, llon, llat, rlon, rlat, lons, lats, data,
+                   bins=None, cache_folder=None, index=None):
     '''
     A function to plot hot spot map for crash rate and
     crash severity
@@ -41,43 +265,74 @@ def draw_crash_map(shpurl, name, llon, llat, rlon, rlat, lons, lats, data):
     @lons {a list of float} longitudes of the crash spots
     @lats {a list of float} latitudes of the crash spots
     @data {a list of float} data for crash rates or severity
+    @bins {int or a list of float} number of equal-width bins of the data,
+    or the bin edges; by default the marker size follows every value
+    @cache_folder {string} folder of the road geometry cache files
+    (default: the GEOMETRY_CACHE_DIR folder next to the shapefile)
+    @index {SpatialIndex} spatial index of lons and lats (see
+    spatial_index); when given, only the crash spots inside the map are
+    drawn
     Return: Nothing
+    The crash spots are projected in one call and drawn as a single scatter
+    collection (one per bin when binned), so large networks render quickly.
     '''
-    # set up a map canvas
-    map = Basemap(llcrnrlon=llon, llcrnrlat=llat,
-                  urcrnrlon=rlon, urcrnrlat=rlat, resolution='i',
-                  projection='tmerc', lat_0=(llat+rlat)/2,
-                  lon_0=(llon+rlon)/2)
-
-    # read the shapefile
-    map.readshapefile(shpurl, 'highway')
-
-    # get the max value from the data to scale the size of the marker
-    max_val = max(data)
-
-    # plot the hot spots one by one with the marker
-    # size corresponding to the data
-    for index in range(len(data)):
-        x, y = map(lons[index], lats[index])
-        map.plot(x, y, marker='o', color='r',
-                 markersize=((data[index]*15/max_val)+5))
-        # update the min value that is larger than 0
-        if data[index] > 0 and data[index] < min_val:
-            min_val = data[index]
-
-    # create legends
-    # the largest marker and the smallest marker
-    red_dot1, = plt.plot([], "ro", markersize=20)
-    red_dot2, = plt.plot([], "ro", markersize=5)
+    # set up a map canvas and draw the road network
+    map = draw_road_network(shpurl, llon, llat, rlon, rlat, cache_folder)
+
+    # project all the hot spots (inside the map) at once
+    data = np.asarray(data, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    if index is not None:
+        inside = index.query_bbox(llon, llat, rlon, rlat)
+        data, lons, lats = data[inside], lons[inside], lats[inside]
+    x, y = map(lons, lats)
+
+    # only the road network is shown if there is no hot spot to draw
+    if np.all(np.isnan(data)):
+        plt.show()
+        return
+
+    # get the max value and the min value larger than 0 from the data to
+    # scale the size of the marker
+    max_val = np.nanmax(data)
+    positive = data[data > 0]
+    min_val = positive.min() if len(positive) > 0 else 0
 
     # determine the legend according to the parameter @name
-    if name == 'rate':
-        str1 = 'Max crash rate:' + str(round(max_val, 2))
-        str2 = 'Min crash rate:' + str(round(min_val, 2))
+    label = 'crash rate' if name == 'rate' else 'crash severity'
+
+    if bins is None:
+        # plot the hot spots with the marker size (diameter in points)
+        # corresponding to the data
+        map.scatter(x, y, s=((data*15/max_val)+5)**2, c='r', marker='o',
+                    zorder=3)
+
+        # create legends
+        # the largest marker and the smallest marker
+        red_dot1, = plt.plot([], "ro", markersize=20)
+        red_dot2, = plt.plot([], "ro", markersize=5)
+        str1 = 'Max ' + label + ':' + str(round(max_val, 2))
+        str2 = 'Min ' + label + ':' + str(round(min_val, 2))
+        plt.legend([red_dot1, red_dot2], [str1, str2])
     else:
-        str1 = 'Max crash severity:' + str(round(max_val, 2))
-        str2 = 'Min crash severity:' + str(round(min_val, 2))
-    plt.legend([red_dot1, red_dot2], [str1, str2])
+        # plot the hot spots of every bin with the marker size of the upper
+        # edge of the bin, the largest markers first
+        if np.isscalar(bins):
+            bins = np.linspace(min(np.nanmin(data), 0), max_val, bins + 1)
+        bins = np.asarray(bins, dtype=np.float64)
+        data_bin = np.clip(np.searchsorted(bins, data, side='left') - 1, 0,
+                           len(bins) - 2)
+        for i in reversed(range(len(bins) - 1)):
+            spots = (data_bin == i) & ~np.isnan(data)
+            if np.any(spots):
+                map.scatter(x[spots], y[spots],
+                            s=((bins[i + 1]*15/max_val)+5)**2, c='r',
+                            marker='o', zorder=3,
+                            label='%s %s-%s' % (label.capitalize(),
+                                                round(bins[i], 2),
+                                                round(bins[i + 1], 2)))
+        plt.legend()
 
     # show the map
     plt.show()
@@ -0,0 +1,357 @@
+import hashlib
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+
+# side of a tile (pixels)
+TILE_SIZE = 256
+
+# diameter of the hot spot markers (pixels): MIN_MARKER for a value of 0,
+# MIN_MARKER+MARKER_RANGE for the max value, as in geohelper.draw_crash_map
+MIN_MARKER = 5
+MARKER_RANGE = 15
+
+# name of the file listing the tiles of a pyramid and their contents
+MANIFEST = 'manifest.json'
+
+# road network used by the worker processes, see attach_roads()
+SHARED_ROADS = {}
+
+
+def to_world_pixels(lons, lats):
+    """
+    Parameters:
+    @lons {numpy array} longitudes (degrees)
+    @lats {numpy array} latitudes (degrees)
+    Return:
+    @x {numpy array} web mercator x at zoom 0 (0 to TILE_SIZE, east)
+    @y {numpy array} web mercator y at zoom 0 (0 to TILE_SIZE, south)
+    Multiply by 2**zoom to get the pixel coordinates at a zoom level; the
+    tile of a pixel is (x // TILE_SIZE, y // TILE_SIZE).
+    """
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.clip(np.asarray(lats, dtype=np.float64), -85.0511, 85.0511)
+    x = (lons + 180) / 360 * TILE_SIZE
+    sin_lats = np.sin(np.radians(lats))
+    y = (0.5 - np.log((1 + sin_lats) / (1 - sin_lats)) / (4 * np.pi)) * \
+        TILE_SIZE
+    return x, y
+
+
+def get_marker_sizes(values, max_value):
+    """
+    Parameters:
+    @values {numpy array} hot spot values (e.g. eb safety or arp)
+    @max_value {float} value of the largest marker
+    Return:
+    @sizes {numpy array} marker diameters (pixels)
+    """
+    values = np.clip(np.asarray(values, dtype=np.float64), 0, max_value)
+    return values * MARKER_RANGE / max_value + MIN_MARKER
+
+
+def expand_tiles(x0, y0, x1, y1):
+    """
+    Parameters:
+    @x0, y0, x1, y1 {numpy arrays} first and last tile columns and rows
+    covered by every item
+    Return:
+    @item {numpy array} item of every (item, tile) pair
+    @x, y {numpy arrays} tile of every pair
+    """
+    n_cols = x1 - x0 + 1
+    n_tiles = n_cols * (y1 - y0 + 1)
+    item = np.repeat(np.arange(len(x0)), n_tiles)
+    k = np.arange(n_tiles.sum()) - np.repeat(np.cumsum(n_tiles) - n_tiles,
+                                             n_tiles)
+    return item, x0[item] + k % n_cols[item], y0[item] + k // n_cols[item]
+
+
+def get_point_hashes(lons, lats, values):
+    """
+    Parameters:
+    @lons, lats, values {numpy arrays} the hot spots
+    Return:
+    @hashes {numpy array} 64-bit hash of every hot spot, used to detect the
+    tiles whose hot spots changed
+    """
+    rows = pd.DataFrame({'lon': lons, 'lat': lats, 'value': values})
+    return pd.util.hash_pandas_object(rows, index=False).values
+
+
+def list_tiles(road_x, road_y, offsets, x, y, sizes, hashes, zoom):
+    """
+    Parameters:
+    @road_x, road_y {numpy arrays} world pixels of the road vertices
+    @offsets {numpy array} index of the first vertex of every polyline,
+    followed by the number of vertices
+    @x, y {numpy arrays} world pixels of the hot spots
+    @sizes {numpy array} marker diameters of the hot spots (pixels)
+    @hashes {numpy array} hash of every hot spot
+    @zoom {int} zoom level
+    Return:
+    @tiles {pd dataframe} one row per tile with roads or hot spots: zoom,
+    tile column and row, signature of its hot spots, and the hot spots
+    drawn on it (indices)
+    """
+    scale = 2.0**zoom
+    max_tile = int(scale) - 1
+
+    # tiles crossed by the road segments (bounding box, plus a pixel for the
+    # line width)
+    line = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    first = np.flatnonzero(line[:-1] == line[1:])
+    ax, ay = road_x[first] * scale, road_y[first] * scale
+    bx, by = road_x[first + 1] * scale, road_y[first + 1] * scale
+
+    def tile_range(lo, hi):
+        return (np.clip(np.floor(lo / TILE_SIZE), 0, max_tile)
+                .astype(np.int64),
+                np.clip(np.floor(hi / TILE_SIZE), 0, max_tile)
+                .astype(np.int64))
+
+    x0, x1 = tile_range(np.minimum(ax, bx) - 1, np.maximum(ax, bx) + 1)
+    y0, y1 = tile_range(np.minimum(ay, by) - 1, np.maximum(ay, by) + 1)
+    item, road_tx, road_ty = expand_tiles(x0, y0, x1, y1)
+    road_keys = np.unique(road_tx * (max_tile + 1) + road_ty)
+
+    # tiles touched by the hot spot markers
+    px, py, radius = x * scale, y * scale, sizes / 2.0 + 1
+    x0, x1 = tile_range(px - radius, px + radius)
+    y0, y1 = tile_range(py - radius, py + radius)
+    point, point_tx, point_ty = expand_tiles(x0, y0, x1, y1)
+    point_keys = point_tx * (max_tile + 1) + point_ty
+
+    # signature of the hot spots of every tile: their number and the sum of
+    # their hashes, which do not depend on the order of the hot spots
+    order = np.argsort(point_keys, kind='stable')
+    point, point_keys = point[order], point_keys[order]
+    keys, starts, counts = np.unique(point_keys, return_index=True,
+                                     return_counts=True)
+    with np.errstate(over='ignore'):
+        sums = np.add.reduceat(hashes[point], starts) if len(starts) else \
+            np.array([], dtype=np.uint64)
+    signatures = dict((key, '%d-%016x' % (count, total))
+                      for key, count, total in zip(keys, counts, sums))
+    members = dict((key, point[start:start + count])
+                   for key, start, count in zip(keys, starts, counts))
+
+    all_keys = np.union1d(road_keys, keys)
+    empty = np.array([], dtype=np.int64)
+    return pd.DataFrame({'zoom': zoom,
+                         'x': all_keys // (max_tile + 1),
+                         'y': all_keys % (max_tile + 1),
+                         'signature': [signatures.get(key, '0')
+                                       for key in all_keys],
+                         'points': [members.get(key, empty)
+                                    for key in all_keys]},
+                        columns=['zoom', 'x', 'y', 'signature', 'points'])
+
+
+def attach_roads(road_x, road_y, offsets):
+    """
+    Parameters:
+    @road_x, road_y {numpy arrays} world pixels of the road vertices
+    @offsets {numpy array} index of the first vertex of every polyline,
+    followed by the number of vertices
+    Initialize a worker process with the road network, and the bounding box
+    of every polyline.
+    """
+    SHARED_ROADS['xy'] = np.column_stack((road_x, road_y))
+    SHARED_ROADS['offsets'] = offsets
+    starts, stops = offsets[:-1], offsets[1:]
+    nonempty = stops > starts
+    bounds = np.full((len(starts), 4), np.nan)
+    for i, reduce in enumerate([np.minimum, np.maximum]):
+        for j, coords in enumerate([road_x, road_y]):
+            if np.any(nonempty):
+                bounds[nonempty, 2 * i + j] = reduce.reduceat(
+                    coords, starts[nonempty])
+    SHARED_ROADS['bounds'] = bounds
+
+
+def render_tile(args):
+    """
+    Parameters:
+    @args {tuple} file name, zoom, tile column and row, and the world
+    pixels and marker sizes of the hot spots of the tile
+    Return:
+    @seconds {float} time taken to render the tile
+    Render one transparent TILE_SIZE x TILE_SIZE png tile: the road
+    polylines crossing it and the hot spot markers, sized by their values.
+    """
+    start = time.time()
+    file_name, zoom, tx, ty, x, y, sizes = args
+    scale = 2.0**zoom
+    left, top = tx * TILE_SIZE, ty * TILE_SIZE
+
+    fig = Figure(figsize=(1, 1), dpi=TILE_SIZE)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    ax.set_xlim(left, left + TILE_SIZE)
+    ax.set_ylim(top + TILE_SIZE, top)
+
+    # road polylines whose bounding box meets the tile
+    bounds = SHARED_ROADS['bounds'] * scale
+    lines = np.flatnonzero((bounds[:, 0] <= left + TILE_SIZE + 1) &
+                           (bounds[:, 2] >= left - 1) &
+                           (bounds[:, 1] <= top + TILE_SIZE + 1) &
+                           (bounds[:, 3] >= top - 1))
+    offsets = SHARED_ROADS['offsets']
+    xy = SHARED_ROADS['xy']
+    ax.add_collection(LineCollection(
+        [xy[offsets[i]:offsets[i + 1]] * scale for i in lines],
+        colors='k', linewidths=0.5))
+
+    # hot spot markers; the marker sizes are areas in points
+    if len(x) > 0:
+        points = 72.0 / TILE_SIZE
+        ax.scatter(x * scale, y * scale, s=(sizes * points)**2, c='r',
+                   marker='o', zorder=3)
+
+    folder = os.path.dirname(file_name)
+    if not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    fig.savefig(file_name, transparent=True)
+
+    return time.time() - start
+
+
+def build_tile_pyramid(folder, lons, lats, values, zooms=range(6, 13),
+                       shpurl='../data/highway/wgs84', road_lines=None,
+                       max_value=None, n_jobs=1):
+    """
+    Parameters:
+    @folder {string} root folder of the tiles
+    @lons {numpy array} longitudes of the hot spots
+    @lats {numpy array} latitudes of the hot spots
+    @values {numpy array} values sizing the hot spot markers, e.g. the eb
+    safety or arp of every site (see crash_modeling_tools)
+    @zooms {list} zoom levels of the pyramid
+    @shpurl {string} the road shapefile url, without suffix
+    @road_lines {tuple} longitudes, latitudes and offsets of the road
+    polylines (see geohelper.read_shapefile_lines()), in place of shpurl
+    @max_value {float} value of the largest marker (default: the largest
+    value); keep it fixed across updates so that the markers of unchanged
+    hot spots keep their size
+    @n_jobs {int} number of worker processes
+    Return:
+    @tiles {pd dataframe} zoom, x, y, status ('rendered', 'unchanged' or
+    'removed') and rendering time (seconds) of every tile
+    Render the road network and the hot spots into a z/x/y png tile
+    pyramid (web mercator, folder/zoom/x/y.png) for a slippy map viewer.
+    Only the tiles with roads or hot spots are made. A manifest records the
+    hot spots of every tile; when the pyramid is built again (e.g. after one
+    year of results changed), only the tiles whose hot spots changed are
+    rendered again, and the tiles left empty are removed. The tiles are
+    rendered on a process pool. When the roads or the marker scale change,
+    the whole pyramid is rendered again and the tiles of the old pyramid
+    that are not in the new one are removed.
+    """
+    if road_lines is None:
+        # needs pyshp, only for a shapefile
+        from geohelper import read_shapefile_lines
+        road_lines = read_shapefile_lines(shpurl)
+    road_lons, road_lats, offsets = road_lines
+    road_x, road_y = to_world_pixels(road_lons, road_lats)
+    offsets = np.asarray(offsets, dtype=np.int64)
+
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~(np.isnan(lons) | np.isnan(lats) | np.isnan(values))
+    lons, lats, values = lons[valid], lats[valid], values[valid]
+    if max_value is None:
+        max_value = values.max() if len(values) > 0 else 1.0
+    x, y = to_world_pixels(lons, lats)
+    sizes = get_marker_sizes(values, max_value)
+    hashes = get_point_hashes(lons, lats, values)
+
+    # the whole pyramid is rendered again when the roads or the marker
+    # scale change
+    base = hashlib.sha1()
+    for array in [road_x, road_y, offsets]:
+        base.update(np.ascontiguousarray(array).tobytes())
+    base.update(repr((float(max_value), MIN_MARKER, MARKER_RANGE,
+                      TILE_SIZE)).encode())
+    base = base.hexdigest()
+
+    # the tiles of the previous pyramid, whose signatures are only reused
+    # if it has the same base
+    manifest_file = os.path.join(folder, MANIFEST)
+    old_names = []
+    old_tiles = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        old_names = list(manifest['tiles'])
+        if manifest.get('base') == base:
+            old_tiles = manifest['tiles']
+
+    tiles = pd.concat([list_tiles(road_x, road_y, offsets, x, y, sizes,
+                                  hashes, zoom) for zoom in zooms],
+                      ignore_index=True)
+    names = ['%d/%d/%d' % tile
+             for tile in zip(tiles.zoom, tiles.x, tiles.y)]
+    changed = np.array([old_tiles.get(name) != signature or
+                        not os.path.exists(os.path.join(folder,
+                                                        name + '.png'))
+                        for name, signature in zip(names,
+                                                   tiles.signature)],
+                       dtype=bool)
+
+    tasks = [(os.path.join(folder, names[i] + '.png'), tiles.zoom[i],
+              tiles.x[i], tiles.y[i], x[tiles.points[i]],
+              y[tiles.points[i]], sizes[tiles.points[i]])
+             for i in np.flatnonzero(changed)]
+    if n_jobs > 1 and len(tasks) > 1:
+        pool = Pool(n_jobs, initializer=attach_roads,
+                    initargs=(road_x, road_y, offsets))
+        try:
+            seconds = pool.map(render_tile, tasks,
+                               chunksize=max(1, len(tasks) // (4 * n_jobs)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        attach_roads(road_x, road_y, offsets)
+        try:
+            seconds = [render_tile(task) for task in tasks]
+        finally:
+            SHARED_ROADS.clear()
+
+    # remove the tiles of the previous pyramid that are now empty
+    removed = sorted(set(old_names) - set(names))
+    for name in removed:
+        file_name = os.path.join(folder, name + '.png')
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+    if not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    with open(manifest_file, 'w') as f:
+        json.dump({'base': base,
+                   'tiles': dict(zip(names, tiles.signature))}, f)
+
+    status = np.where(changed, 'rendered', 'unchanged')
+    timing = np.zeros(len(tiles))
+    timing[changed] = seconds
+    result = pd.DataFrame({'zoom': tiles.zoom, 'x': tiles.x, 'y': tiles.y,
+                           'status': status, 'seconds': timing},
+                          columns=['zoom', 'x', 'y', 'status', 'seconds'])
+    if removed:
+        parts = np.array([name.split('/') for name in removed], dtype=int)
+        result = pd.concat([result, pd.DataFrame(
+            {'zoom': parts[:, 0], 'x': parts[:, 1], 'y': parts[:, 2],
+             'status': 'removed', 'seconds': 0.0},
+            columns=['zoom', 'x', 'y', 'status', 'seconds'])],
+            ignore_index=True)
+    return result
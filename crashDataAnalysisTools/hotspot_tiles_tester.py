@@ -0,0 +1,99 @@
+from hotspot_tiles import *
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class HotspotTilesTester(unittest.TestCase):
+    """
+    The tiles are rendered for two straight roads and a few hot spots
+    around Seattle, at a few zoom levels.
+    """
+
+    road_lines = (np.array([-122.5, -122.3, -122.1, -122.3, -122.3]),
+                  np.array([47.6, 47.6, 47.6, 47.4, 47.8]),
+                  np.array([0, 3, 5]))
+    lons = np.array([-122.45, -122.3, -122.15, -122.3])
+    lats = np.array([47.6, 47.6, 47.6, 47.7])
+    values = np.array([1.0, 4.0, 2.0, 0.5])
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_to_world_pixels(self):
+        """
+        The tile of a point should be the standard web mercator tile.
+        """
+        x, y = to_world_pixels(np.array([-122.3]), np.array([47.6]))
+        tile = (x * 2**12 // TILE_SIZE, y * 2**12 // TILE_SIZE)
+        self.assertTrue(tile == (656, 1430))
+
+    def test_build_tile_pyramid(self):
+        """
+        The first build should render every tile with roads or hot spots;
+        the second only the tiles of the changed hot spot.
+        """
+        tiles = build_tile_pyramid(self.folder, self.lons, self.lats,
+                                   self.values, zooms=[8, 10, 12],
+                                   road_lines=self.road_lines, max_value=5.0)
+        self.assertTrue((tiles.status == 'rendered').all())
+        for zoom, x, y in zip(tiles.zoom, tiles.x, tiles.y):
+            self.assertTrue(os.path.exists(os.path.join(
+                self.folder, str(zoom), str(x), '%d.png' % y)))
+
+        # change the value of the hot spot north of the crossing
+        values = self.values.copy()
+        values[3] = 3.0
+        updated = build_tile_pyramid(self.folder, self.lons, self.lats,
+                                     values, zooms=[8, 10, 12],
+                                     road_lines=self.road_lines,
+                                     max_value=5.0, n_jobs=2)
+        rendered = updated[updated.status == 'rendered']
+        self.assertTrue(len(rendered) > 0)
+        self.assertTrue(len(rendered) < len(updated))
+
+        x, y = to_world_pixels(self.lons[3:], self.lats[3:])
+        for zoom, tx, ty in zip(rendered.zoom, rendered.x, rendered.y):
+            px, py = x[0] * 2**zoom, y[0] * 2**zoom
+            self.assertTrue(abs(px - (tx + 0.5) * TILE_SIZE) <
+                            TILE_SIZE / 2 + 12)
+            self.assertTrue(abs(py - (ty + 0.5) * TILE_SIZE) <
+                            TILE_SIZE / 2 + 12)
+
+    def test_build_tile_pyramid_new_roads(self):
+        """
+        When the roads change, the tiles of the old pyramid that are not in
+        the new one should be removed.
+        """
+        old = build_tile_pyramid(self.folder, self.lons, self.lats,
+                                 self.values, zooms=[8, 10, 12],
+                                 road_lines=self.road_lines, max_value=5.0)
+
+        # keep the north-south road only, without hot spots
+        road_lines = (self.road_lines[0][3:], self.road_lines[1][3:],
+                      np.array([0, 2]))
+        tiles = build_tile_pyramid(self.folder, [], [], [],
+                                   zooms=[8, 10, 12], road_lines=road_lines,
+                                   max_value=5.0)
+        kept = tiles[tiles.status != 'removed']
+        removed = tiles[tiles.status == 'removed']
+        self.assertTrue((kept.status == 'rendered').all())
+        self.assertTrue(len(removed) > 0)
+
+        old_names = set(zip(old.zoom, old.x, old.y))
+        names = set(zip(kept.zoom, kept.x, kept.y))
+        self.assertTrue(set(zip(removed.zoom, removed.x, removed.y)) ==
+                        old_names - names)
+        for zoom, x, y in old_names:
+            self.assertTrue(os.path.exists(os.path.join(
+                self.folder, str(zoom), str(x), '%d.png' % y)) ==
+                ((zoom, x, y) in names))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,624 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# default folder (relative to the data folder) holding the sorted elevation
+# points and the elevation statistics of the road segments
+ELEV_CACHE_DIR = 'elev_cache'
+
+# columns of the elevation table used by the merge_elev view
+ELEV_COLUMNS = ['Route_id', 'Milepost', 'Grade', 'Longitude', 'Latitude']
+
+# version of the elevation artifacts, part of their fingerprint so that the
+# files saved by an older version are not reused
+ELEV_FORMAT = 'route-keys'
+
+# maximum number of sorted elevation tables, and of segment statistics,
+# kept in memory
+ELEV_MEMORY_SIZE = 4
+
+# sorted elevation points and segment statistics computed in this session,
+# least recently used first, keyed by fingerprint (see aggregate_elevation())
+ELEV_INDEXES = OrderedDict()
+ELEV_SUMMARIES = OrderedDict()
+
+
+def get_column(data, name):
+    '''
+    Parameters:
+    @data {pd dataframe} the table to look up
+    @name {string} the column name, in any letter case
+    Return:
+    @column {numpy array} values of the requested column
+    Look up a column the way SQLite does, i.e. ignoring the letter case of the
+    column name (e.g. 'Route_id' finds the 'Route_ID' column of the elevation
+    file).
+    '''
+    # try the exact name first and fall back to a case-insensitive match
+    if name in data.columns:
+        return data[name].values
+    for col in data.columns:
+        if str(col).lower() == name.lower():
+            return data[col].values
+    raise KeyError(name)
+
+
+def get_route_keys(routes):
+    '''
+    Parameters:
+    @routes {numpy array} route numbers, read as numbers or as text
+    Return:
+    @keys {numpy array} the routes in one canonical text form: the numeric
+    routes without padding or decimals (e.g. 5, 5.0 and '005' all give
+    '5'), the other routes as text; missing routes stay missing
+    The same route may be read as a number from one file and as zero-padded
+    text from another. SQLite converts the text to a number when it
+    compares them; the engine compares the keys, so that both match the
+    same points.
+    '''
+    routes = pd.Series(np.asarray(routes))
+    numbers = pd.to_numeric(routes, errors='coerce')
+    keys = pd.Series(np.full(len(routes), None, dtype=object))
+
+    text = routes.notnull().values & numbers.isnull().values
+    keys[text] = routes[text].astype(str)
+    numeric = numbers.notnull().values
+    whole = numeric & (numbers.values == np.floor(numbers.values))
+    keys[whole] = numbers[whole].astype(np.int64).astype(str)
+    keys[numeric & ~whole] = numbers[numeric & ~whole].astype(str)
+    return keys.values
+
+
+def locate_intervals(seg_routes, seg_beg, seg_end, pt_routes, pt_mps):
+    '''
+    Parameters:
+    @seg_routes {numpy array} route number of each road segment
+    @seg_beg {numpy array} beginning milepost of each road segment
+    @seg_end {numpy array} ending milepost of each road segment
+    @pt_routes {numpy array} route number of each point (crash, curve, etc.)
+    @pt_mps {numpy array} milepost of each point
+    Return:
+    @order {numpy array} indices of the points sorted by route and milepost
+    @lo {numpy array} first sorted position matched by each segment
+    @hi {numpy array} one past the last sorted position matched by each
+    segment
+    Match every point to the road segments it falls on. The points are sorted
+    once by (route, milepost) and, route by route, the segment boundaries are
+    located in the sorted mileposts with a binary search. Segment i covers the
+    sorted points order[lo[i]:hi[i]], which is the same set of rows as the SQL
+    join condition "route = route AND milepost BETWEEN begmp AND endmp".
+    '''
+    seg_beg = np.asarray(seg_beg, dtype=np.float64)
+    seg_end = np.asarray(seg_end, dtype=np.float64)
+    pt_mps = np.asarray(pt_mps, dtype=np.float64)
+
+    # encode the routes as integer codes shared by segments and points,
+    # through their keys (see get_route_keys()); points on routes without
+    # any segment get -1 and are never matched
+    seg_codes, routes = pd.factorize(get_route_keys(seg_routes))
+    pt_codes = pd.Index(routes).get_indexer(get_route_keys(pt_routes))
+
+    # sort the usable points by route code and then by milepost
+    valid = np.flatnonzero((pt_codes >= 0) & ~np.isnan(pt_mps))
+    order = valid[np.lexsort((pt_mps[valid], pt_codes[valid]))]
+    codes_sorted = pt_codes[order]
+    mps_sorted = pt_mps[order]
+
+    # partition points and segments by route
+    n_routes = len(routes)
+    pt_bounds = np.searchsorted(codes_sorted, np.arange(n_routes + 1))
+    seg_order = np.argsort(seg_codes, kind='mergesort')
+    seg_bounds = np.searchsorted(seg_codes[seg_order],
+                                 np.arange(n_routes + 1))
+
+    # segments without a route (code -1) sit at the front of seg_order and
+    # keep an empty range
+    lo = np.zeros(len(seg_codes), dtype=np.int64)
+    hi = np.zeros(len(seg_codes), dtype=np.int64)
+
+    # binary search the segment boundaries within each route partition
+    for code in range(n_routes):
+        start, stop = pt_bounds[code], pt_bounds[code + 1]
+        segs = seg_order[seg_bounds[code]:seg_bounds[code + 1]]
+        mps = mps_sorted[start:stop]
+        lo[segs] = start + np.searchsorted(mps, seg_beg[segs], side='left')
+        hi[segs] = start + np.searchsorted(mps, seg_end[segs], side='right')
+
+    # a segment with begmp > endmp (or a missing milepost) matches nothing
+    hi = np.maximum(hi, lo)
+
+    return order, lo, hi
+
+
+def expand_ranges(lo, hi):
+    '''
+    Parameters:
+    @lo {numpy array} start of each range
+    @hi {numpy array} end (exclusive) of each range
+    Return:
+    @idx {numpy array} concatenated positions of all ranges
+    @offsets {numpy array} start of each range within idx
+    @counts {numpy array} length of each range
+    Flatten a set of (possibly overlapping) ranges into one index array so
+    that the ranges can be reduced with ufunc.reduceat.
+    '''
+    counts = hi - lo
+    offsets = np.zeros(len(counts), dtype=np.int64)
+    np.cumsum(counts[:-1], out=offsets[1:])
+    idx = np.arange(counts.sum(), dtype=np.int64) - \
+        np.repeat(offsets - lo, counts)
+    return idx, offsets, counts
+
+
+def reduce_ranges(ufunc, values, lo, hi):
+    '''
+    Parameters:
+    @ufunc {numpy ufunc} the reduction, e.g. np.fmax or np.add
+    @values {numpy array} sorted point values
+    @lo {numpy array} start of each range
+    @hi {numpy array} end (exclusive) of each range
+    Return:
+    @out {numpy array} the reduced value of each range (NaN for empty ranges)
+    Apply a grouped reduction over the points matched by every segment.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    idx, offsets, counts = expand_ranges(lo, hi)
+    out = np.full(len(lo), np.nan)
+    nonempty = counts > 0
+    if nonempty.any():
+        out[nonempty] = ufunc.reduceat(values[idx], offsets[nonempty])
+    return out
+
+
+def summarize_ranges(values, lo, hi):
+    '''
+    Parameters:
+    @values {numpy array} sorted point values
+    @lo {numpy array} start of each range
+    @hi {numpy array} end (exclusive) of each range
+    Return:
+    @summary {dict} average, maximum, minimum and count of the non-missing
+    values in each range
+    Compute the SQL aggregates AVG, MAX, MIN and COUNT over the points matched
+    by every segment. As in SQL, missing values are ignored and the aggregates
+    of an empty range are missing (the count is 0).
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    present = ~np.isnan(values)
+    count = reduce_ranges(np.add, present, lo, hi)
+    total = reduce_ranges(np.add, np.where(present, values, 0), lo, hi)
+    count = np.nan_to_num(count).astype(np.int64)
+
+    # fmax/fmin skip NaN as long as the range holds one real value
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg = np.where(count > 0, total / count, np.nan)
+    summary = {'avg': avg,
+               'max': reduce_ranges(np.fmax, values, lo, hi),
+               'min': reduce_ranges(np.fmin, values, lo, hi),
+               'count': count}
+    return summary
+
+
+def count_ranges(values, lo, hi):
+    '''
+    Parameters:
+    @values {numpy array} sorted point values
+    @lo {numpy array} start of each range
+    @hi {numpy array} end (exclusive) of each range
+    Return:
+    @count {numpy array} number of non-missing values in each range
+    Equivalent of the SQL COUNT(column) aggregate over each range.
+    '''
+    present = pd.notnull(values).astype(np.float64)
+    count = reduce_ranges(np.add, present, lo, hi)
+    return np.nan_to_num(count).astype(np.int64)
+
+
+def get_elevation_key(elev, columns=ELEV_COLUMNS):
+    '''
+    Parameters:
+    @elev {pd dataframe} freeway elevation table (wa_elev.csv)
+    @columns {list} the columns to digest, by default those used by the
+    elevation join
+    Return:
+    @key {string} hex SHA-1 digest of the columns (and of ELEV_FORMAT)
+    '''
+    sha1 = hashlib.sha1(ELEV_FORMAT.encode())
+    for name in columns:
+        column = pd.Series(get_column(elev, name))
+        sha1.update(str(column.dtype).encode())
+        sha1.update(pd.util.hash_pandas_object(column,
+                                               index=False).values.tobytes())
+    return sha1.hexdigest()
+
+
+def sort_elevation(elev):
+    '''
+    Parameters:
+    @elev {pd dataframe} freeway elevation table (wa_elev.csv)
+    Return:
+    @index {dict} the elevation points sorted by route and milepost: the
+    distinct routes, the start of every route in the sorted arrays
+    (route_start) and the sorted milepost, grade, longitude and latitude
+    Sort the elevation points once by (route, milepost), so that the points
+    of any segment are a contiguous slice of the sorted arrays. The routes
+    are stored as keys (see get_route_keys()). Points without a route or a
+    milepost can never be matched and are dropped.
+    '''
+    routes = get_route_keys(get_column(elev, 'Route_id'))
+    mps = get_column(elev, 'milepost').astype(np.float64)
+    valid = np.flatnonzero(pd.notnull(routes) & ~np.isnan(mps))
+
+    codes, uniques = pd.factorize(routes[valid])
+    order = valid[np.lexsort((mps[valid], codes))]
+    codes = np.sort(codes)
+
+    index = {'routes': np.asarray(uniques),
+             'route_start': np.searchsorted(codes,
+                                            np.arange(len(uniques) + 1))}
+    for name in ELEV_COLUMNS[1:]:
+        index[name.lower()] = \
+            get_column(elev, name).astype(np.float64)[order]
+    return index
+
+
+def save_arrays(file_name, arrays):
+    '''
+    Parameters:
+    @file_name {string} path of the .npz file
+    @arrays {dict} the arrays to store, keyed by name
+    Write the arrays through a temporary file, so that concurrent readers
+    (e.g. the workers of a parallel build) never see a partial file.
+    '''
+    tmp_path = file_name + '.%d.tmp.npz' % os.getpid()
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, file_name)
+
+
+def load_arrays(file_name):
+    '''
+    Parameters:
+    @file_name {string} path of the .npz file
+    Return:
+    @arrays {dict} the stored arrays, keyed by name
+    '''
+    with np.load(file_name) as data:
+        return dict((name, data[name]) for name in data.files)
+
+
+def remember(cache, key, value):
+    '''
+    Parameters:
+    @cache {OrderedDict} ELEV_INDEXES or ELEV_SUMMARIES
+    @key {string} the fingerprint of the value
+    @value {dict} the value to keep
+    Keep a value in memory and evict the least recently used ones beyond
+    ELEV_MEMORY_SIZE.
+    '''
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > ELEV_MEMORY_SIZE:
+        cache.popitem(last=False)
+
+
+def clear_elevation_cache():
+    '''
+    Remove all sorted elevation points and segment statistics kept in memory
+    (the files of the cache folder are kept).
+    '''
+    ELEV_INDEXES.clear()
+    ELEV_SUMMARIES.clear()
+
+
+def get_elevation_index(elev, cache_dir=None):
+    '''
+    Parameters:
+    @elev {pd dataframe} freeway elevation table (wa_elev.csv)
+    @cache_dir {string} folder holding the sorted elevation artifact; if
+    None, the sorted points are only kept in memory
+    Return:
+    @key {string} fingerprint of the elevation table
+    @index {dict} the sorted elevation points (see sort_elevation())
+    Get the elevation points sorted by route and milepost. The elevation
+    file is the same for all years, so the sorted points are kept in memory
+    (for the ELEV_MEMORY_SIZE most recently used tables) and, with a cache
+    folder, saved to elev_<fingerprint>.npz to be reused
+    by other processes and sessions.
+    '''
+    key = get_elevation_key(elev)
+    if key in ELEV_INDEXES:
+        ELEV_INDEXES.move_to_end(key)
+        return key, ELEV_INDEXES[key]
+
+    file_name = None
+    if cache_dir is not None:
+        file_name = os.path.join(cache_dir, 'elev_' + key + '.npz')
+
+    if file_name is not None and os.path.exists(file_name):
+        index = load_arrays(file_name)
+    else:
+        index = sort_elevation(elev)
+        # the route keys are stored as fixed-width strings
+        routes = index['routes'].astype(str)
+        if file_name is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            save_arrays(file_name, dict(index, routes=routes))
+
+    remember(ELEV_INDEXES, key, index)
+    return key, index
+
+
+def locate_sorted_ranges(index, seg_routes, seg_beg, seg_end):
+    '''
+    Parameters:
+    @index {dict} points sorted by route and milepost (see sort_elevation())
+    @seg_routes {numpy array} route number of each road segment
+    @seg_beg {numpy array} beginning milepost of each road segment
+    @seg_end {numpy array} ending milepost of each road segment
+    Return:
+    @lo {numpy array} first sorted position matched by each segment
+    @hi {numpy array} one past the last sorted position matched by each
+    segment
+    Same as locate_intervals(), for points that are already sorted: only the
+    segment boundaries are located with a binary search, route by route.
+    '''
+    seg_beg = np.asarray(seg_beg, dtype=np.float64)
+    seg_end = np.asarray(seg_end, dtype=np.float64)
+    route_start = index['route_start']
+    mps = index['milepost']
+
+    # segments on routes without any point (code -1) keep an empty range
+    seg_codes = pd.Index(index['routes']).get_indexer(
+        get_route_keys(seg_routes))
+    lo = np.zeros(len(seg_codes), dtype=np.int64)
+    hi = np.zeros(len(seg_codes), dtype=np.int64)
+
+    seg_order = np.argsort(seg_codes, kind='mergesort')
+    seg_bounds = np.searchsorted(seg_codes[seg_order],
+                                 np.arange(len(route_start)))
+    for code in range(len(route_start) - 1):
+        segs = seg_order[seg_bounds[code]:seg_bounds[code + 1]]
+        if len(segs) == 0:
+            continue
+        start, stop = route_start[code], route_start[code + 1]
+        lo[segs] = start + np.searchsorted(mps[start:stop], seg_beg[segs],
+                                           side='left')
+        hi[segs] = start + np.searchsorted(mps[start:stop], seg_end[segs],
+                                           side='right')
+
+    return lo, np.maximum(hi, lo)
+
+
+def aggregate_elevation(elev, seg_routes, seg_beg, seg_end, cache_dir=None):
+    '''
+    Parameters:
+    @elev {pd dataframe} freeway elevation table (wa_elev.csv)
+    @seg_routes {numpy array} route number of each road segment
+    @seg_beg {numpy array} beginning milepost of each road segment
+    @seg_end {numpy array} ending milepost of each road segment
+    @cache_dir {string} folder holding the elevation artifacts; if None,
+    they are only kept in memory
+    Return:
+    @summary {dict} average longitude and latitude of the points on each
+    segment (longitude, latitude) and the average, maximum and minimum grade
+    in percent (avg_grad, max_grad, min_grad); NaN for segments without
+    points
+    Vectorized counterpart of the merge_elev view. The elevation points are
+    sorted once (see get_elevation_index()), the segment boundaries are
+    located in the sorted mileposts and every statistic is computed with
+    ufunc.reduceat over the matched slices. Since the elevation file is the
+    same for all years, the result is cached on the segment boundaries too:
+    the years sharing the same segments reuse it without any join.
+    '''
+    key, index = get_elevation_index(elev, cache_dir)
+
+    # the cached result is keyed on the elevation table and the segments
+    sha1 = hashlib.sha1(key.encode())
+    sha1.update(pd.util.hash_pandas_object(
+        pd.DataFrame({'route': np.asarray(seg_routes),
+                      'begmp': np.asarray(seg_beg, dtype=np.float64),
+                      'endmp': np.asarray(seg_end, dtype=np.float64)}),
+        index=False).values.tobytes())
+    seg_key = sha1.hexdigest()
+    if seg_key in ELEV_SUMMARIES:
+        ELEV_SUMMARIES.move_to_end(seg_key)
+        return ELEV_SUMMARIES[seg_key]
+
+    file_name = None
+    if cache_dir is not None:
+        file_name = os.path.join(cache_dir, 'elev_segments_' + seg_key +
+                                 '.npz')
+    if file_name is not None and os.path.exists(file_name):
+        summary = load_arrays(file_name)
+    else:
+        lo, hi = locate_sorted_ranges(index, seg_routes, seg_beg, seg_end)
+        grade = summarize_ranges(index['grade'] * 100, lo, hi)
+        summary = {'longitude': summarize_ranges(index['longitude'],
+                                                 lo, hi)['avg'],
+                   'latitude': summarize_ranges(index['latitude'],
+                                                lo, hi)['avg'],
+                   'avg_grad': grade['avg'],
+                   'max_grad': grade['max'],
+                   'min_grad': grade['min']}
+        if file_name is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            save_arrays(file_name, summary)
+
+    remember(ELEV_SUMMARIES, seg_key, summary)
+    return summary
+
+
+def combine_tables(road, acc, curv, grad, elev, cache_dir=None):
+    '''
+    Parameters:
+    @road {pd dataframe} road segment table (waYYroad.csv)
+    @acc {pd dataframe} accident table (waYYacc.csv)
+    @curv {pd dataframe} horizontal curvature table (waYYcurv.csv)
+    @grad {pd dataframe} roadway grade table (waYYgrad.csv)
+    @elev {pd dataframe} freeway elevation table (wa_elev.csv)
+    @cache_dir {string} folder holding the elevation artifacts (see
+    aggregate_elevation()); if None, they are only kept in memory
+    Return:
+    @annual_data {pd dataframe} the combined annual dataframe
+    Vectorized counterpart of data_prep.combine_tables_sql(). The elevation,
+    grade, curvature and accident points are matched to the road segments
+    with locate_intervals() and aggregated per segment, which yields the same
+    columns (and the same row order) as the chained SQL views without any
+    nested-loop range join.
+    '''
+    # the SQL views group by the segment key, so duplicated segments collapse
+    road = road.drop_duplicates(['road_inv', 'begmp', 'endmp'])
+    road = road.reset_index(drop=True)
+    routes = road['road_inv'].values
+    begmp = road['begmp'].values
+    endmp = road['endmp'].values
+
+    # merge the elevation information (merge_elev view), reused across the
+    # years with the same segments
+    elev_stats = aggregate_elevation(elev, routes, begmp, endmp, cache_dir)
+
+    # merge the HSIS grade where the elevation is not available (merge_grad
+    # view); the grade sign is stored in a separate column
+    pct_grad = get_column(grad, 'pct_grad').astype(np.float64)
+    pct_grad = np.where(get_column(grad, 'dir_grad') == '-',
+                        -pct_grad, pct_grad)
+    order, lo, hi = locate_intervals(routes, begmp, endmp,
+                                     get_column(grad, 'grad_inv'),
+                                     get_column(grad, 'begmp'))
+    hsis_grad = summarize_ranges(pct_grad[order], lo, hi)
+
+    annual_data = road[['lshl_typ', 'med_type', 'rshl_typ', 'surf_typ',
+                        'road_inv', 'spd_limt', 'begmp', 'endmp', 'lanewid',
+                        'no_lanes', 'lshldwid', 'rshldwid', 'medwid',
+                        'seg_lng', 'aadt']].copy()
+    annual_data['longitude'] = elev_stats['longitude']
+    annual_data['latitude'] = elev_stats['latitude']
+    for stat in ['avg', 'max', 'min']:
+        elev_grad = elev_stats[stat + '_grad']
+        annual_data[stat + '_grad'] = np.where(np.isnan(elev_grad),
+                                               hsis_grad[stat], elev_grad)
+
+    # merge the curvature information (merge_curv view)
+    order, lo, hi = locate_intervals(routes, begmp, endmp,
+                                     get_column(curv, 'curv_inv'),
+                                     get_column(curv, 'begmp'))
+    annual_data['curv_count'] = count_ranges(
+        get_column(curv, 'dir_curv')[order], lo, hi)
+    annual_data['max_deg_curv'] = reduce_ranges(
+        np.fmax, get_column(curv, 'deg_curv')[order], lo, hi)
+
+    # count the accidents on each segment
+    order, lo, hi = locate_intervals(routes, begmp, endmp,
+                                     get_column(acc, 'rd_inv'),
+                                     get_column(acc, 'milepost'))
+    annual_data['acc_count'] = count_ranges(
+        get_column(acc, 'caseno')[order], lo, hi)
+
+    # order the rows like the SQL output
+    annual_data = annual_data.sort_values(['road_inv', 'begmp', 'endmp'],
+                                          na_position='first',
+                                          kind='mergesort')
+    annual_data = annual_data.reset_index(drop=True)
+
+    return annual_data
+
+
+def count_points_chunked(seg_routes, seg_beg, seg_end, chunks, route_col,
+                         mp_col, count_col):
+    '''
+    Parameters:
+    @seg_routes {numpy array} route number of each road segment
+    @seg_beg {numpy array} beginning milepost of each road segment
+    @seg_end {numpy array} ending milepost of each road segment
+    @chunks {iterable} dataframes holding consecutive parts of the point
+    table, e.g. pd.read_csv(..., chunksize=...)
+    @route_col {string} route column of the point table
+    @mp_col {string} milepost column of the point table
+    @count_col {string} column whose non-missing values are counted
+    Return:
+    @count {numpy array} number of points on each road segment
+    Count the points (e.g. crashes) on every road segment while reading the
+    point table chunk by chunk. The segment boundaries of each route are
+    sorted once; every chunk is then binned on these boundaries with a binary
+    search and added to two per-boundary accumulators (points exactly on a
+    boundary, points between two boundaries). The memory used thus depends
+    on the number of segments, not on the number of points. The counts are
+    the same as the SQL join condition "milepost BETWEEN begmp AND endmp".
+    '''
+    seg_beg = np.asarray(seg_beg, dtype=np.float64)
+    seg_end = np.asarray(seg_end, dtype=np.float64)
+    seg_codes, routes = pd.factorize(get_route_keys(seg_routes))
+    routes = pd.Index(routes)
+    valid = (seg_codes >= 0) & (seg_beg <= seg_end)
+
+    # sorted distinct boundaries of every route
+    codes = np.concatenate((seg_codes[valid], seg_codes[valid]))
+    mps = np.concatenate((seg_beg[valid], seg_end[valid]))
+    order = np.lexsort((mps, codes))
+    codes, mps = codes[order], mps[order]
+    distinct = np.ones(len(mps), dtype=bool)
+    distinct[1:] = (codes[1:] != codes[:-1]) | (mps[1:] != mps[:-1])
+    codes, mps = codes[distinct], mps[distinct]
+    route_start = np.searchsorted(codes, np.arange(len(routes) + 1))
+
+    # position of the segment ends among the boundaries
+    beg_pos = np.zeros(len(seg_codes), dtype=np.int64)
+    end_pos = np.zeros(len(seg_codes), dtype=np.int64)
+    seg_order = np.flatnonzero(valid)
+    seg_order = seg_order[np.argsort(seg_codes[seg_order], kind='mergesort')]
+    seg_start = np.searchsorted(seg_codes[seg_order],
+                                np.arange(len(routes) + 1))
+    for code in range(len(routes)):
+        segs = seg_order[seg_start[code]:seg_start[code + 1]]
+        start, stop = route_start[code], route_start[code + 1]
+        beg_pos[segs] = start + np.searchsorted(mps[start:stop],
+                                                seg_beg[segs])
+        end_pos[segs] = start + np.searchsorted(mps[start:stop],
+                                                seg_end[segs])
+
+    # on[i] counts the points on boundary i, between[i] the points between
+    # boundaries i-1 and i of the same route
+    n_bounds = len(mps)
+    on = np.zeros(n_bounds, dtype=np.int64)
+    between = np.zeros(n_bounds + 1, dtype=np.int64)
+
+    for chunk in chunks:
+        # keep the points with a known route, milepost and counted value
+        pt_codes = routes.get_indexer(get_route_keys(chunk[route_col]))
+        pt_mps = np.asarray(chunk[mp_col], dtype=np.float64)
+        keep = (pt_codes >= 0) & ~np.isnan(pt_mps) & \
+            np.asarray(pd.notnull(chunk[count_col]))
+        pt_codes, pt_mps = pt_codes[keep], pt_mps[keep]
+
+        # bin the points of each route on its boundaries
+        on_idx = []
+        between_idx = []
+        for code in np.unique(pt_codes):
+            start, stop = route_start[code], route_start[code + 1]
+            if start == stop:
+                continue
+            sel = pt_mps[pt_codes == code]
+            pos = np.searchsorted(mps[start:stop], sel)
+            hit = (pos < stop - start) & \
+                (mps[start + np.minimum(pos, stop - start - 1)] == sel)
+            on_idx.append(start + pos[hit])
+            between_idx.append(start + pos[~hit])
+
+        if on_idx:
+            on += np.bincount(np.concatenate(on_idx), minlength=n_bounds)
+            between += np.bincount(np.concatenate(between_idx),
+                                   minlength=n_bounds + 1)
+
+    # count of [begmp, endmp]: points on the boundaries from begmp to endmp
+    # plus the points between them
+    on_sum = np.concatenate(([0], np.cumsum(on)))
+    between_sum = np.concatenate(([0], np.cumsum(between)))
+    count = (on_sum[end_pos + 1] - on_sum[beg_pos]) + \
+        (between_sum[end_pos + 1] - between_sum[beg_pos + 1])
+
+    return np.where(valid, count, 0)
@@ -0,0 +1,271 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import sqlite3 as dbi
+
+from interval_join import *
+from data_prep import combine_tables_sql, load_raw_tables
+
+
+class IntervalJoinTest(unittest.TestCase):
+    '''
+    Test functions for the sorted-interval join engine. A small set of tables
+    with the same columns as the HSIS files is built below, so that the result
+    of the engine can be checked against the SQL range joins in data_prep.py.
+    '''
+    # road segments on two routes, including a segment on a route without
+    # any other record and a pair of segments sharing a boundary milepost
+    road = pd.DataFrame({'lshl_typ': ['A', 'A', 'B', 'B'],
+                         'med_type': ['1', '1', '2', '2'],
+                         'rshl_typ': ['A', 'A', 'B', 'B'],
+                         'surf_typ': ['P', 'P', 'B', 'P'],
+                         'road_inv': ['005', '005', '090', '099'],
+                         'spd_limt': [60, 60, 70, 50],
+                         'begmp': [0.0, 1.0, 10.0, 0.0],
+                         'endmp': [1.0, 2.5, 12.0, 3.0],
+                         'lanewid': [24, 24, 36, 24],
+                         'no_lanes': [2, 2, 3, 2],
+                         'lshldwid': [4, 4, 6, 2],
+                         'rshldwid': [8, 8, 10, 4],
+                         'medwid': [20, 20, 40, 0],
+                         'seg_lng': [1.0, 1.5, 2.0, 3.0],
+                         'aadt': [10000, 12000, 30000, 800]})
+
+    acc = pd.DataFrame({'rd_inv': ['005', '005', '005', '090', '090', '005'],
+                        'milepost': [0.5, 1.0, 2.0, 11.0, 13.0, np.nan],
+                        'caseno': [1, 2, 3, 4, 5, 6]})
+
+    curv = pd.DataFrame({'curv_inv': ['005', '090', '090'],
+                         'dir_curv': ['L', 'R', 'L'],
+                         'begmp': [1.2, 10.5, 11.5],
+                         'deg_curv': [3.5, 1.5, 2.5]})
+
+    grad = pd.DataFrame({'grad_inv': ['005', '005', '090'],
+                         'dir_grad': ['-', '+', '-'],
+                         'pct_grad': [2.0, 1.0, 3.0],
+                         'begmp': [0.2, 1.5, 10.2]})
+
+    elev = pd.DataFrame({'Route_ID': ['005', '005', '005', '090'],
+                         'Milepost': [0.1, 0.9, 1.6, 20.0],
+                         'Longitude': [-122.1, -122.2, -122.3, -120.0],
+                         'Latitude': [47.1, 47.2, 47.3, 47.0],
+                         'Grade': [0.01, -0.02, 0.03, 0.04]})
+
+    def test_locate_intervals(self):
+        '''
+        Check the sorted positions matched by each segment, including the
+        inclusive boundaries of the BETWEEN condition.
+        '''
+        order, lo, hi = locate_intervals(self.road.road_inv.values,
+                                         self.road.begmp.values,
+                                         self.road.endmp.values,
+                                         self.acc.rd_inv.values,
+                                         self.acc.milepost.values)
+
+        # the crash at milepost 1.0 is on both route 5 segments, the one
+        # without a milepost is on none
+        counts = hi - lo
+        self.assertEqual(counts.tolist(), [2, 2, 1, 0])
+        self.assertEqual(sorted(self.acc.caseno.values[order[lo[1]:hi[1]]]),
+                         [2, 3])
+
+    def test_summarize_ranges(self):
+        '''
+        Missing values are ignored and empty ranges give missing aggregates.
+        '''
+        values = np.array([1.0, np.nan, 3.0, 5.0])
+        summary = summarize_ranges(values, np.array([0, 1, 2]),
+                                   np.array([3, 2, 2]))
+
+        self.assertEqual(summary['count'].tolist(), [2, 0, 0])
+        self.assertEqual(summary['avg'][0], 2.0)
+        self.assertEqual(summary['max'][0], 3.0)
+        self.assertTrue(np.isnan(summary['min'][1]))
+
+    def test_count_points_chunked(self):
+        '''
+        Counting the crashes over chunks of the accident table should give
+        the same counts as matching the whole table at once.
+        '''
+        chunks = [self.acc.iloc[i:i + 2] for i in range(0, len(self.acc), 2)]
+        count = count_points_chunked(self.road.road_inv.values,
+                                     self.road.begmp.values,
+                                     self.road.endmp.values, chunks,
+                                     'rd_inv', 'milepost', 'caseno')
+
+        self.assertEqual(count.tolist(), [2, 2, 1, 0])
+
+    def test_combine_tables(self):
+        '''
+        The interval join engine should give the same table as the SQL path,
+        with the range joins done either on the B-tree indexes or through the
+        R*Tree of the segment intervals.
+        '''
+        np_data = combine_tables(self.road, self.acc, self.curv, self.grad,
+                                 self.elev)
+
+        for rtree in [False, True]:
+            # run the SQL path on a scratch in-memory database
+            conn = dbi.connect(':memory:')
+            sql_data = combine_tables_sql(conn, self.road, self.acc,
+                                          self.curv, self.grad, self.elev,
+                                          rtree=rtree)
+            conn.close()
+
+            self.assertEqual(list(sql_data.columns), list(np_data.columns))
+            for col in ['longitude', 'latitude', 'avg_grad', 'max_grad',
+                        'min_grad', 'curv_count', 'max_deg_curv',
+                        'acc_count']:
+                self.assertTrue(np.allclose(sql_data[col].astype(float),
+                                            np_data[col].astype(float),
+                                            equal_nan=True))
+
+    def test_combine_tables_mixed_routes(self):
+        '''
+        With the routes read as numbers from some files and as zero-padded
+        text from others, the engine should match the same points as the
+        SQL path, and the streamed counts should be the same.
+        '''
+        acc = self.acc.assign(rd_inv=self.acc.rd_inv.astype(int))
+        curv = self.curv.assign(curv_inv=self.curv.curv_inv.astype(float))
+        grad = self.grad.assign(grad_inv=self.grad.grad_inv.astype(int))
+        elev = self.elev.assign(Route_ID=self.elev.Route_ID.astype(int))
+        np_data = combine_tables(self.road, acc, curv, grad, elev)
+
+        conn = dbi.connect(':memory:')
+        sql_data = combine_tables_sql(conn, self.road, acc, curv, grad, elev)
+        conn.close()
+
+        self.assertEqual(np_data['acc_count'].tolist(), [2, 2, 1, 0])
+        for col in ['longitude', 'latitude', 'avg_grad', 'max_grad',
+                    'min_grad', 'curv_count', 'max_deg_curv', 'acc_count']:
+            self.assertTrue(np.allclose(sql_data[col].astype(float),
+                                        np_data[col].astype(float),
+                                        equal_nan=True))
+
+        chunks = [acc.iloc[i:i + 2] for i in range(0, len(acc), 2)]
+        count = count_points_chunked(self.road.road_inv.values,
+                                     self.road.begmp.values,
+                                     self.road.endmp.values, chunks,
+                                     'rd_inv', 'milepost', 'caseno')
+        self.assertEqual(count.tolist(), [2, 2, 1, 0])
+
+    def test_aggregate_elevation(self):
+        '''
+        The elevation statistics from the sorted artifact should be those of
+        a direct interval join, and a new session should reuse the artifacts
+        saved in the cache folder.
+        '''
+        routes = self.road.road_inv.values
+        order, lo, hi = locate_intervals(routes, self.road.begmp.values,
+                                         self.road.endmp.values,
+                                         self.elev.Route_ID.values,
+                                         self.elev.Milepost.values)
+        expected = summarize_ranges(self.elev.Grade.values[order] * 100,
+                                    lo, hi)
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            summary = aggregate_elevation(self.elev, routes,
+                                          self.road.begmp.values,
+                                          self.road.endmp.values, cache_dir)
+            for stat in ['avg', 'max', 'min']:
+                self.assertTrue(np.allclose(summary[stat + '_grad'],
+                                            expected[stat], equal_nan=True))
+            self.assertTrue(np.allclose(summary['longitude'],
+                                        [-122.15, -122.3, np.nan, np.nan],
+                                        equal_nan=True))
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            # a new session loads the saved artifacts
+            clear_elevation_cache()
+            cached = aggregate_elevation(self.elev, routes,
+                                         self.road.begmp.values,
+                                         self.road.endmp.values, cache_dir)
+            for name in summary:
+                self.assertTrue(np.array_equal(cached[name], summary[name],
+                                               equal_nan=True))
+
+            # only the most recently used statistics are kept in memory
+            for shift in range(ELEV_MEMORY_SIZE + 1):
+                aggregate_elevation(self.elev, routes,
+                                    self.road.begmp.values + shift,
+                                    self.road.endmp.values + shift)
+            self.assertEqual(len(ELEV_SUMMARIES), ELEV_MEMORY_SIZE)
+            self.assertEqual(len(ELEV_INDEXES), 1)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_aggregate_elevation_numeric_routes(self):
+        '''
+        An elevation file whose Route_ID is read as numbers should match the
+        zero-padded text routes of the segments like the merge_elev view.
+        '''
+        elev = self.elev.copy()
+        elev['Route_ID'] = elev['Route_ID'].astype(int)
+        summary = aggregate_elevation(elev, self.road.road_inv.values,
+                                      self.road.begmp.values,
+                                      self.road.endmp.values)
+
+        conn = dbi.connect(':memory:')
+        combine_tables_sql(conn, self.road, self.acc, self.curv, self.grad,
+                           elev)
+        merge_elev = pd.read_sql('''SELECT * FROM merge_elev
+                                    ORDER BY road_inv, begmp, endmp''',
+                                 con=conn)
+        conn.close()
+
+        self.assertEqual(merge_elev['longitude'].notnull().sum(), 2)
+        for col in ['longitude', 'latitude', 'avg_grad', 'max_grad',
+                    'min_grad']:
+            self.assertTrue(np.allclose(merge_elev[col].astype(float),
+                                        summary[col], equal_nan=True))
+
+    def test_combine_tables_bulk(self):
+        '''
+        The bulk-write mode of the SQL path should give the same table as the
+        default mode, and a second load of the same raw tables should not
+        write any of them again.
+        '''
+        conn = dbi.connect(':memory:')
+        sql_data = combine_tables_sql(conn, self.road, self.acc, self.curv,
+                                      self.grad, self.elev)
+        bulk_data = combine_tables_sql(conn, self.road, self.acc, self.curv,
+                                       self.grad, self.elev, bulk=True)
+        self.assertTrue(sql_data.equals(bulk_data))
+
+        # only the changed table is written by the next load
+        acc = self.acc.iloc[:3]
+        self.assertEqual(load_raw_tables(conn, {'road': self.road,
+                                                'acc': acc}), ['acc'])
+        self.assertEqual(load_raw_tables(conn, {'road': self.road,
+                                                'acc': acc}), [])
+        bulk_data = combine_tables_sql(conn, self.road, self.acc, self.curv,
+                                       self.grad, self.elev, bulk=True)
+        self.assertTrue(sql_data.equals(bulk_data))
+        conn.close()
+
+    def test_combine_tables_bulk_journal(self):
+        '''
+        The bulk-write mode should restore the journal mode of a database
+        file, without leaving a write-ahead log behind.
+        '''
+        folder = tempfile.mkdtemp()
+        try:
+            path = os.path.join(folder, 'crash_database')
+            conn = dbi.connect(path)
+            combine_tables_sql(conn, self.road, self.acc, self.curv,
+                               self.grad, self.elev, bulk=True)
+            mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+            conn.close()
+            self.assertEqual(mode, 'delete')
+            self.assertFalse(os.path.exists(path + '-wal'))
+        finally:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,502 @@
+from multiprocessing import Pool
+import numbers
+
+import numpy as np
+import pandas as pd
+
+from interval_join import get_column, get_elevation_key, locate_intervals
+from spatial_index import EARTH_RADIUS, SpatialIndex
+
+# number of points matched at once
+MATCH_CHUNKSIZE = 100000
+
+# largest distance between two sample points of a polyline (miles)
+SAMPLE_SPACING = 0.05
+
+# number of nearest sample points whose segments are checked for a point
+N_CANDIDATES = 8
+
+# road network used by the worker processes, see attach_network()
+SHARED_NETWORK = {}
+
+# columns of the reference points (see calibrate_network())
+CALIBRATION_COLUMNS = ['Route_id', 'Milepost', 'Longitude', 'Latitude']
+
+
+class RoadNetwork(object):
+    """
+    Highway polylines prepared for map matching. The polylines are split
+    into straight segments stored in flat arrays: the two ends of every
+    segment, its polyline, its route, its length and the measure (miles from
+    the start of the polyline) of its first end. The segments are sampled
+    every SAMPLE_SPACING miles at most, and the samples are put in a spatial
+    index (see spatial_index), so the segments near a point are found from
+    its nearest samples.
+    The measures are not mileposts: the polylines of a route are neither
+    ordered nor oriented like its mileposts. They are turned into mileposts
+    by interpolation between reference points of known milepost on the same
+    polyline (see calibrate()).
+    """
+
+    def __init__(self, lons, lats, offsets, routes,
+                 sample_spacing=SAMPLE_SPACING):
+        """
+        Parameters:
+        @lons {numpy array} longitudes of the vertices of all the polylines
+        @lats {numpy array} latitudes of the vertices of all the polylines
+        @offsets {numpy array} index of the first vertex of every polyline,
+        followed by the number of vertices
+        @routes {list} route of every polyline
+        @sample_spacing {float} largest distance between two samples of a
+        segment (miles)
+        """
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        sizes = np.diff(offsets)
+
+        # segments between consecutive vertices of the same polyline
+        line = np.repeat(np.arange(len(sizes)), sizes)
+        first = np.flatnonzero(line[:-1] == line[1:])
+        self.beg_lon, self.beg_lat = lons[first], lats[first]
+        self.end_lon, self.end_lat = lons[first + 1], lats[first + 1]
+        self.length = haversine(self.beg_lon, self.beg_lat, self.end_lon,
+                                self.end_lat)
+
+        # polyline and route of every segment, and measure of its first end
+        # along its polyline
+        self.route_names, line_codes = np.unique(np.asarray(routes,
+                                                            dtype=object),
+                                                 return_inverse=True)
+        self.line = line[first]
+        self.line_route = line_codes
+        self.route = line_codes[self.line]
+        cum = np.cumsum(self.length) - self.length
+        line_start = np.r_[True, self.line[1:] != self.line[:-1]]
+        cum -= np.maximum.accumulate(np.where(line_start, cum, 0))
+        self.measure = cum
+
+        # no reference points yet, see calibrate()
+        self.calibrate([], [], [], [])
+
+        # samples of the segments, every sample_spacing miles at most
+        n_samples = np.maximum(np.ceil(self.length / sample_spacing), 1)
+        n_samples = n_samples.astype(np.int64) + 1
+        self.sample_segment = np.repeat(np.arange(len(first)), n_samples)
+        share = (np.arange(n_samples.sum()) -
+                 np.repeat(np.cumsum(n_samples) - n_samples, n_samples)) / \
+            np.repeat(n_samples - 1, n_samples)
+        seg = self.sample_segment
+        self.index = SpatialIndex(
+            self.beg_lon[seg] + share * (self.end_lon[seg] -
+                                         self.beg_lon[seg]),
+            self.beg_lat[seg] + share * (self.end_lat[seg] -
+                                         self.beg_lat[seg]))
+
+    def match(self, lons, lats, n_candidates=N_CANDIDATES):
+        """
+        Parameters:
+        @lons {numpy array} longitudes of the points
+        @lats {numpy array} latitudes of the points
+        @n_candidates {int} number of nearest samples whose segments are
+        checked for every point
+        Return:
+        @segment {numpy array} nearest segment of every point (-1 for a
+        point without coordinates)
+        @share {numpy array} position of the nearest location along the
+        segment (0 at its first end, 1 at the other)
+        @distance {numpy array} distance between the point and the nearest
+        location (miles)
+        The distances to the candidate segments of all the points are
+        computed at once, in a plane tangent to the earth at every point.
+        """
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        valid = ~(np.isnan(lons) | np.isnan(lats))
+        segment = np.full(len(lons), -1, dtype=np.int64)
+        share = np.full(len(lons), np.nan)
+        distance = np.full(len(lons), np.nan)
+        lons, lats = lons[valid], lats[valid]
+
+        # candidate segments: those of the nearest samples
+        candidates = self.index.query_knn(lons, lats,
+                                          min(n_candidates,
+                                              len(self.index)))[1]
+        candidates = self.sample_segment[candidates]
+
+        # local coordinates (miles) of the point and of the segment ends
+        scale = np.radians(EARTH_RADIUS)
+        x_scale = scale * np.cos(np.radians(lats))[:, None]
+        ax = (self.beg_lon[candidates] - lons[:, None]) * x_scale
+        ay = (self.beg_lat[candidates] - lats[:, None]) * scale
+        bx = (self.end_lon[candidates] - lons[:, None]) * x_scale
+        by = (self.end_lat[candidates] - lats[:, None]) * scale
+
+        # nearest location of every candidate segment
+        dx, dy = bx - ax, by - ay
+        norm = dx**2 + dy**2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.where(norm > 0, -(ax*dx + ay*dy) / norm, 0)
+        t = np.clip(t, 0, 1)
+        d2 = (ax + t*dx)**2 + (ay + t*dy)**2
+
+        best = np.argmin(d2, axis=1)
+        rows = np.arange(len(best))
+        segment[valid] = candidates[rows, best]
+        share[valid] = t[rows, best]
+        distance[valid] = np.sqrt(d2[rows, best])
+
+        return segment, share, distance
+
+    def calibrate(self, routes, mileposts, lons, lats, max_distance=0.1,
+                  key=None):
+        """
+        Parameters:
+        @routes {list} route of every reference point, named like the
+        routes of the network (see normalize_routes())
+        @mileposts {numpy array} milepost of every reference point
+        @lons {numpy array} longitudes of the reference points
+        @lats {numpy array} latitudes of the reference points
+        @max_distance {float} reference points farther from a polyline of
+        their route (miles) are left out
+        @key {string} fingerprint of the reference points, kept in the
+        calibration_key attribute (optional)
+        The reference points are matched to the network, and those matched
+        to a polyline of their own route are kept, sorted by polyline and
+        measure. A polyline is calibrated by two of its reference points at
+        least: the mileposts of its other points are interpolated (or
+        extrapolated) linearly between the nearest of them.
+        """
+        mileposts = np.asarray(mileposts, dtype=np.float64)
+        routes = np.asarray(routes, dtype=object)
+        segment = np.full(len(mileposts), -1, dtype=np.int64)
+        share = np.full(len(mileposts), np.nan)
+        if len(mileposts):
+            segment, share, distance = self.match(lons, lats)
+            found = segment >= 0
+            same = np.zeros(len(segment), dtype=bool)
+            same[found] = self.route_names[self.route[segment[found]]] == \
+                routes[found]
+            segment[~(same & (distance <= max_distance) &
+                      ~np.isnan(mileposts))] = -1
+        keep = segment >= 0
+        line, measure = self.get_measures(segment[keep], share[keep])
+
+        # reference points sorted by polyline and measure, the polylines
+        # being spaced by more than their length in the sort key
+        self.key_span = self.measure.max() + self.length.max() + 1 \
+            if len(self.length) else 1.0
+        cal_key = line * self.key_span + measure
+        order = np.argsort(cal_key, kind='stable')
+        self.cal_key = cal_key[order]
+        self.cal_measure = measure[order]
+        self.cal_milepost = mileposts[keep][order]
+        self.cal_start = np.searchsorted(line[order],
+                                         np.arange(len(self.line_route) + 1))
+        self.calibration_key = key
+
+    def get_measures(self, segment, share):
+        """
+        Parameters:
+        @segment {numpy array} segment of every point, all found
+        @share {numpy array} position along the segment of every point
+        Return:
+        @line {numpy array} polyline of every point
+        @measure {numpy array} miles from the start of the polyline
+        """
+        return self.line[segment], self.measure[segment] + \
+            share * self.length[segment]
+
+    def locate(self, segment, share):
+        """
+        Parameters:
+        @segment {numpy array} segment of every point (see match())
+        @share {numpy array} position along the segment of every point
+        Return:
+        @routes {numpy array} route of every point (None without segment)
+        @mileposts {numpy array} milepost of every point, interpolated
+        between the reference points of its polyline (missing when its
+        polyline is not calibrated, see calibrate())
+        """
+        found = segment >= 0
+        routes = np.full(len(segment), None, dtype=object)
+        routes[found] = self.route_names[self.route[segment[found]]]
+        mileposts = np.full(len(segment), np.nan)
+        line, measure = self.get_measures(segment[found], share[found])
+
+        # nearest two reference points of the same polyline
+        start, stop = self.cal_start[line], self.cal_start[line + 1]
+        calibrated = stop - start >= 2
+        hi = np.searchsorted(self.cal_key, line * self.key_span + measure)
+        hi = np.clip(hi, start + 1, stop - 1)[calibrated]
+        lo = hi - 1
+
+        m_lo, m_hi = self.cal_measure[lo], self.cal_measure[hi]
+        mp_lo, mp_hi = self.cal_milepost[lo], self.cal_milepost[hi]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = np.where(m_hi > m_lo, (mp_hi - mp_lo) / (m_hi - m_lo), 0)
+        rows = np.flatnonzero(found)[calibrated]
+        mileposts[rows] = mp_lo + (measure[calibrated] - m_lo) * slope
+        return routes, mileposts
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Parameters:
+    @lon1 {numpy array} longitudes of the first points (degrees)
+    @lat1 {numpy array} latitudes of the first points (degrees)
+    @lon2 {numpy array} longitudes of the second points (degrees)
+    @lat2 {numpy array} latitudes of the second points (degrees)
+    Return:
+    @distance {numpy array} great circle distances (miles)
+    """
+    lon1, lat1, lon2, lat2 = [np.radians(x)
+                              for x in (lon1, lat1, lon2, lat2)]
+    h = np.sin((lat2 - lat1) / 2)**2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(h))
+
+
+def normalize_routes(routes, like=None):
+    """
+    Parameters:
+    @routes {list} route numbers, as numbers or text
+    @like {pd series} routes whose type the result should have, e.g. the
+    rd_inv column of the accident table (optional)
+    Return:
+    @routes {numpy array} the routes as numbers if the routes of like are
+    numbers, otherwise as text, numeric routes being padded to three digits
+    like in the HSIS tables (e.g. '002')
+    """
+    routes = pd.Series(np.asarray(routes, dtype=object))
+    if like is not None:
+        values = like.dropna()
+        if like.dtype.kind in 'biuf' or \
+                (len(values) and isinstance(values.iloc[0], numbers.Number)):
+            return pd.to_numeric(routes, errors='coerce').values
+
+    def to_text(route):
+        if route is None or (isinstance(route, float) and np.isnan(route)):
+            return None
+        if isinstance(route, numbers.Number):
+            route = '%d' % route
+        route = str(route).strip()
+        return route.zfill(3) if route.isdigit() else route
+    return np.array([to_text(route) for route in routes], dtype=object)
+
+
+def read_road_network(shpurl='../data/highway/wgs84',
+                      route_field='StateRoute', related_field='RelRouteTy',
+                      sample_spacing=SAMPLE_SPACING):
+    """
+    Parameters:
+    @shpurl {string} the shapefile url, without suffix
+    @route_field {string} field of the route of every shape
+    @related_field {string} field of the related route type of every shape;
+    only the main-line shapes, where it is blank, are read (None to read all
+    the shapes)
+    @sample_spacing {float} largest distance between two samples of a
+    segment (miles)
+    Return:
+    @network {RoadNetwork} the polylines of the shapefile, one per part of a
+    shape, with the routes named like the HSIS routes (see
+    normalize_routes())
+    The shapefile is read with pyshp, imported here so that the rest of the
+    module does not need it.
+    """
+    import shapefile
+
+    reader = shapefile.Reader(shpurl)
+    field_names = [f[0] for f in reader.fields[1:]]
+    field = field_names.index(route_field)
+    related = field_names.index(related_field) \
+        if related_field is not None else None
+    points = []
+    sizes = []
+    routes = []
+    for shape_record in reader.iterShapeRecords():
+        if related is not None and \
+                str(shape_record.record[related]).strip():
+            continue
+        shape = shape_record.shape
+        parts = list(shape.parts) + [len(shape.points)]
+        for start, stop in zip(parts[:-1], parts[1:]):
+            if stop > start:
+                points.extend(shape.points[start:stop])
+                sizes.append(stop - start)
+                routes.append(shape_record.record[field])
+    reader.close()
+
+    points = np.array(points, dtype=np.float64).reshape(-1, 2)
+    offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+    return RoadNetwork(points[:, 0], points[:, 1], offsets,
+                       normalize_routes(routes), sample_spacing)
+
+
+def calibrate_network(network, elev, max_distance=0.1):
+    """
+    Parameters:
+    @network {RoadNetwork} the road network
+    @elev {pd dataframe} reference points with a route, a milepost and
+    coordinates, e.g. the freeway elevation table (see CALIBRATION_COLUMNS)
+    @max_distance {float} reference points farther from a polyline of their
+    route (miles) are left out
+    Return:
+    @network {RoadNetwork} the network, calibrated by the reference points
+    (see RoadNetwork.calibrate()); a network already calibrated by the same
+    table is returned as it is
+    """
+    key = get_elevation_key(elev, CALIBRATION_COLUMNS)
+    if network.calibration_key != key:
+        route, milepost, lon, lat = [get_column(elev, name)
+                                     for name in CALIBRATION_COLUMNS]
+        network.calibrate(normalize_routes(route), milepost, lon, lat,
+                          max_distance, key)
+    return network
+
+
+def attach_network(network):
+    """
+    Parameters:
+    @network {RoadNetwork} the road network
+    Initialize a worker process with the road network.
+    """
+    SHARED_NETWORK['network'] = network
+
+
+def match_chunk(args):
+    """
+    Parameters:
+    @args {tuple} longitudes and latitudes of a chunk of points
+    Return:
+    @segment, share, distance {numpy arrays} see RoadNetwork.match()
+    """
+    lons, lats = args
+    return SHARED_NETWORK['network'].match(lons, lats)
+
+
+def match_points(network, lons, lats, max_distance=None,
+                 chunksize=MATCH_CHUNKSIZE, n_jobs=1):
+    """
+    Parameters:
+    @network {RoadNetwork} the road network (see read_road_network())
+    @lons {numpy array} longitudes of the points
+    @lats {numpy array} latitudes of the points
+    @max_distance {float} points farther from the network (miles) are not
+    matched (optional)
+    @chunksize {int} number of points matched at once
+    @n_jobs {int} number of worker processes
+    Return:
+    @matches {pd dataframe} route, milepost (see RoadNetwork.locate()) and
+    distance to the network (miles) of every point; the route is missing
+    for the points that were not matched, and the milepost for those whose
+    polyline is not calibrated
+    Snap every point to the nearest polyline of the network. The points are
+    matched in chunks, on a process pool when n_jobs > 1.
+    """
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    chunks = [(lons[start:start + chunksize], lats[start:start + chunksize])
+              for start in range(0, len(lons), chunksize)]
+
+    if n_jobs > 1 and len(chunks) > 1:
+        pool = Pool(n_jobs, initializer=attach_network, initargs=(network,))
+        try:
+            results = pool.map(match_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [network.match(*chunk) for chunk in chunks]
+
+    if results:
+        segment, share, distance = [np.concatenate(x)
+                                    for x in zip(*results)]
+    else:
+        segment = np.array([], dtype=np.int64)
+        share = distance = np.array([])
+    if max_distance is not None:
+        segment = np.where(distance <= max_distance, segment, -1)
+
+    routes, mileposts = network.locate(segment, share)
+    return pd.DataFrame({'route': routes, 'milepost': mileposts,
+                         'distance': distance},
+                        columns=['route', 'milepost', 'distance'])
+
+
+def get_on_road(road, routes, mileposts):
+    """
+    Parameters:
+    @road {pd dataframe} road segments (road_inv, begmp, endmp)
+    @routes {numpy array} route of every point
+    @mileposts {numpy array} milepost of every point
+    Return:
+    @on_road {numpy array} whether every point is on a road segment of its
+    route
+    """
+    order, lo, hi = locate_intervals(road['road_inv'].values,
+                                     road['begmp'].values,
+                                     road['endmp'].values, routes, mileposts)
+    depth = np.zeros(len(order) + 1, dtype=np.int64)
+    np.add.at(depth, lo, 1)
+    np.add.at(depth, hi, -1)
+    on_road = np.zeros(len(routes), dtype=bool)
+    on_road[order] = np.cumsum(depth)[:-1] > 0
+    return on_road
+
+
+def fill_acc_locations(acc, network, road=None, lon_col='longitude',
+                       lat_col='latitude', max_distance=0.1, n_jobs=1):
+    """
+    Parameters:
+    @acc {pd dataframe} crash records with rd_inv, milepost and coordinates
+    @network {RoadNetwork} the road network, calibrated by reference points
+    (see calibrate_network())
+    @road {pd dataframe} road segments (road_inv, begmp, endmp); when given,
+    the crashes whose milepost is on no segment of their route are matched
+    too, and a crash is only moved to a location on a road segment
+    (optional)
+    @lon_col {string} column of the longitudes
+    @lat_col {string} column of the latitudes
+    @max_distance {float} crashes farther from the network (miles) are left
+    as they are
+    @n_jobs {int} number of worker processes
+    Return:
+    @acc {pd dataframe} the crash records, with a boolean map_matched
+    column. The crashes with coordinates but a missing (or, with road,
+    unmatched) milepost get the route of their nearest polyline, converted
+    to the type of rd_inv, and the milepost interpolated on it; when the
+    polyline is not calibrated, the crash keeps its own milepost, if any.
+    Crash records without coordinate columns are returned as they are.
+    """
+    acc = acc.copy()
+    acc['map_matched'] = False
+    if lon_col not in acc or lat_col not in acc:
+        return acc
+
+    bad = acc['milepost'].isnull().values.copy()
+    if road is not None:
+        bad |= ~get_on_road(road, acc['rd_inv'].values,
+                            acc['milepost'].values)
+    missing = bad & acc[lon_col].notnull().values & \
+        acc[lat_col].notnull().values
+
+    matches = match_points(network, acc.loc[missing, lon_col].values,
+                           acc.loc[missing, lat_col].values, max_distance,
+                           n_jobs=n_jobs)
+    routes = normalize_routes(matches['route'].values, acc['rd_inv'])
+    mileposts = matches['milepost'].values
+    mileposts = np.where(np.isnan(mileposts),
+                         acc.loc[missing, 'milepost'].values, mileposts)
+    found = pd.notnull(routes) & ~np.isnan(mileposts)
+    if road is not None:
+        found[found] = get_on_road(road, routes[found], mileposts[found])
+
+    rows = acc.index[missing][found]
+    routes = routes[found]
+    if acc['rd_inv'].dtype.kind in 'iu':
+        routes = routes.astype(acc['rd_inv'].dtype)
+    acc.loc[rows, 'rd_inv'] = routes
+    acc.loc[rows, 'milepost'] = mileposts[found]
+    acc.loc[rows, 'map_matched'] = True
+    return acc
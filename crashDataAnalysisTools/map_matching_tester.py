@@ -0,0 +1,153 @@
+from map_matching import *
+import numpy as np
+import pandas as pd
+import unittest
+
+
+class MapMatchingTester(unittest.TestCase):
+    """
+    The points are matched to a small network of three routes: route 002
+    going east along a parallel in two polylines, route 005 going north
+    along a meridian, and route 009 going east, further away. The mileposts
+    of route 002 start at 100 at its west end and increase eastwards, those
+    of route 005 decrease northwards, and route 009 has no reference point.
+    """
+
+    lons = np.array([-120.0, -119.9, -119.8, -119.8, -119.7,
+                     -119.75, -119.75, -119.5, -119.4])
+    lats = np.array([47.0, 47.0, 47.0, 47.0, 47.0, 46.9, 47.2, 47.0, 47.0])
+    offsets = np.array([0, 3, 5, 7, 9])
+    network = RoadNetwork(lons, lats, offsets, ['002', '002', '005', '009'])
+
+    # one degree of longitude at 47 degrees is about 47.2 miles
+    mile_per_lon = haversine(-120.0, 47.0, -119.0, 47.0)
+
+    # reference points, the last one being too far from its route 005
+    elev = pd.DataFrame({
+        'Route_ID': [2, 2, 2, 2, 5, 5, 5],
+        'Milepost': [100 + 0.02 * mile_per_lon, 100 + 0.18 * mile_per_lon,
+                     100 + 0.22 * mile_per_lon, 100 + 0.28 * mile_per_lon,
+                     50.0, 50 - haversine(-119.75, 46.95, -119.75, 47.15),
+                     0.0],
+        'Longitude': [-119.98, -119.82, -119.78, -119.72, -119.75, -119.75,
+                      -119.9],
+        'Latitude': [47.0, 47.0, 47.0, 47.0, 46.95, 47.15, 47.0]})
+    calibrate_network(network, elev)
+
+    def test_match_points(self):
+        """
+        Every point should get the route of its nearest polyline, and the
+        milepost interpolated between the reference points of the polyline.
+        """
+        matches = match_points(self.network,
+                               [-119.85, -119.71, -119.7501, -119.0,
+                                -119.45],
+                               [47.001, 46.999, 47.1, 47.0, 47.0],
+                               max_distance=1.0)
+        self.assertTrue(list(matches.route[:3]) == ['002', '002', '005'])
+        self.assertTrue(matches.route.isnull()[3])
+        self.assertTrue(matches.route[4] == '009')
+
+        self.assertTrue(np.isclose(matches.milepost[0],
+                                   100 + 0.15 * self.mile_per_lon,
+                                   rtol=1e-4))
+        # extrapolated past the last reference point of the polyline
+        self.assertTrue(np.isclose(matches.milepost[1],
+                                   100 + 0.29 * self.mile_per_lon,
+                                   rtol=1e-4))
+        self.assertTrue(np.isclose(matches.milepost[2],
+                                   50 - haversine(-119.75, 46.95,
+                                                  -119.75, 47.1),
+                                   rtol=1e-4))
+        self.assertTrue(matches.distance[2] < 0.01)
+        # no milepost on a polyline without reference points
+        self.assertTrue(np.isnan(matches.milepost[4]))
+
+        # the same matches on a process pool
+        pooled = match_points(self.network,
+                              [-119.85, -119.71, -119.7501, -119.0,
+                               -119.45],
+                              [47.001, 46.999, 47.1, 47.0, 47.0],
+                              max_distance=1.0, chunksize=2, n_jobs=2)
+        self.assertTrue(pooled.equals(matches))
+
+    def test_get_on_road(self):
+        """
+        Integer routes should be on the segments of the same zero-padded
+        text routes.
+        """
+        road = pd.DataFrame({'road_inv': ['002', '005'],
+                             'begmp': [100.0, 40.0], 'endmp': [120.0, 60.0]})
+        on_road = get_on_road(road, np.array([2, 5, 5]),
+                              np.array([101.0, 50.0, 70.0]))
+        self.assertTrue(list(on_road) == [True, True, False])
+
+    def test_fill_acc_locations(self):
+        """
+        Only the crashes with coordinates and a missing or unmatched
+        milepost should be map matched, to a location on a road segment,
+        with the route in the type of rd_inv.
+        """
+        acc = pd.DataFrame({'rd_inv': [2, 2, 2, 2, 5, 2],
+                            'milepost': [101.0, np.nan, 130.0, np.nan, 5.0,
+                                         np.nan],
+                            'longitude': [-119.85, -119.85, -119.85, np.nan,
+                                          -119.45, -119.45],
+                            'latitude': [47.0, 47.0, 47.0, np.nan, 47.0,
+                                         47.0]})
+        road = pd.DataFrame({'road_inv': [2, 5, 9],
+                             'begmp': [100.0, 40.0, 0.0],
+                             'endmp': [120.0, 60.0, 10.0]})
+        filled = fill_acc_locations(acc, self.network, road)
+
+        self.assertTrue(list(filled.map_matched) ==
+                        [False, True, True, False, True, False])
+        self.assertTrue(filled.rd_inv.dtype == acc.rd_inv.dtype)
+        self.assertTrue(list(filled.rd_inv) == [2, 2, 2, 2, 9, 2])
+        self.assertTrue(filled.milepost[0] == 101.0)
+        self.assertTrue(np.isclose(filled.milepost[1],
+                                   100 + 0.15 * self.mile_per_lon,
+                                   rtol=1e-4))
+        self.assertTrue(np.isclose(filled.milepost[1], filled.milepost[2]))
+        self.assertTrue(np.isnan(filled.milepost[3]))
+        # route 009 is not calibrated: the crash keeps its milepost
+        self.assertTrue(filled.milepost[4] == 5.0)
+        self.assertTrue(np.isnan(filled.milepost[5]))
+
+        # text routes stay text
+        acc['rd_inv'] = ['002'] * 4 + ['005', '002']
+        road['road_inv'] = ['002', '005', '009']
+        filled = fill_acc_locations(acc, self.network, road)
+        self.assertTrue(list(filled.rd_inv) ==
+                        ['002'] * 4 + ['009', '002'])
+
+        # crash records without coordinates are left as they are
+        filled = fill_acc_locations(acc[['rd_inv', 'milepost']],
+                                    self.network, road)
+        self.assertTrue(filled[['rd_inv', 'milepost']].equals(
+            acc[['rd_inv', 'milepost']]))
+        self.assertFalse(filled.map_matched.any())
+
+    def test_read_road_network(self):
+        """
+        Only the main-line shapes of the highway shapefile should be read,
+        with their StateRoute padded like the HSIS routes, not the related
+        routes such as '002COBROWNE'.
+        """
+        try:
+            import shapefile
+        except ImportError:
+            self.skipTest('pyshp is not installed')
+        network = read_road_network('../data/highway/wgs84')
+        self.assertTrue('002' in network.route_names)
+        self.assertTrue(all(len(route) == 3 and route.isdigit()
+                            for route in network.route_names))
+
+        everything = read_road_network('../data/highway/wgs84',
+                                       related_field=None)
+        self.assertTrue(len(everything.line_route) >
+                        len(network.line_route))
+
+
+if __name__ == '__main__':
+    unittest.main()
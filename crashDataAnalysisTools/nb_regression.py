@@ -0,0 +1,408 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import patsy
+from scipy.special import digamma, gammaln, polygamma
+
+from design_compiler import get_design_compiler, get_reference_row
+
+# range of alpha searched by the maximum likelihood
+ALPHA_BOUNDS = (1e-8, 1e3)
+
+# a coefficient whose sites have an average IRLS weight below this share of
+# the average weight of all the sites is separated: the likelihood keeps
+# increasing as it goes to infinity (e.g. a level without any crash)
+SEPARATION_TOL = 1e-6
+
+
+class NBResults(object):
+    """
+    Fitted negative binomial (nb) regression model. The attributes used by
+    crash_modeling_tools are the same as those of a statsmodels GLM result:
+    params, normalized_cov_params (the covariance matrix of the
+    coefficients), scale (1/alpha, see compute_alpha()) and predict().
+    iterations and converged describe the whole fit, including the
+    alternating estimation of alpha (alpha_iterations steps). degenerate
+    flags the coefficients that are not identified (see get_covariance()),
+    whose variance is infinite.
+    """
+
+    def __init__(self, params, normalized_cov_params, alpha, llf,
+                 iterations, converged, formula=None, design_info=None,
+                 alpha_iterations=0, degenerate=None):
+        self.params = params
+        self.normalized_cov_params = normalized_cov_params
+        self.alpha = alpha
+        self.scale = 1/alpha
+        self.llf = llf
+        self.iterations = iterations
+        self.converged = converged
+        self.alpha_iterations = alpha_iterations
+        if degenerate is None:
+            degenerate = np.zeros(len(params), dtype=bool)
+        self.degenerate = degenerate
+        self.formula = formula
+        self.design_info = design_info
+        self.reference = None
+
+    @property
+    def bse(self):
+        # standard errors of the coefficients
+        return np.sqrt(np.diag(self.normalized_cov_params))
+
+    def predict(self, exog, offset=None):
+        """
+        Parameters:
+        @exog {pd dataframe} the predictors (raw variables if the model was
+        fit from a formula, else the design matrix)
+        @offset {numpy array} offset term of every row (optional)
+        Return:
+        @mu {numpy array} predicted mean of every row
+        """
+        if self.design_info is not None:
+            exog = get_design_compiler(self)(exog)
+        eta = np.asarray(exog, dtype=np.float64).dot(np.asarray(self.params))
+        if offset is not None:
+            eta = eta + np.asarray(offset, dtype=np.float64)
+        return np.exp(eta)
+
+
+def nb_loglike(y, mu, alpha):
+    """
+    Parameters:
+    @y {numpy array} observed counts
+    @mu {numpy array} predicted means
+    @alpha {float} the nb dispersion parameter
+    Return:
+    @llf {float} log-likelihood of the nb2 model (variance mu+alpha*mu^2)
+    """
+    size = 1/alpha
+    return np.sum(gammaln(y + size) - gammaln(size) - gammaln(y + 1) +
+                  size*np.log(size/(size + mu)) + y*np.log(mu/(size + mu)))
+
+
+def irls_nb(y, X, offset, alpha, start_params=None, maxiter=100,
+            tol=1e-8):
+    """
+    Parameters:
+    @y {numpy array} observed counts
+    @X {numpy array} design matrix
+    @offset {numpy array} offset term of every row
+    @alpha {float} the (fixed) nb dispersion parameter
+    @start_params {numpy array} coefficients to start from (optional)
+    @maxiter {int} maximum number of iterations
+    @tol {float} convergence tolerance on the coefficients and on the
+    log-likelihood
+    Return:
+    @params {numpy array} the fitted coefficients
+    @xtwx {numpy array} X'WX at the fitted coefficients
+    @iterations {int} number of iterations
+    @converged {bool} whether the fit converged (see has_converged())
+    Fit the coefficients of an nb2 model with a log link and a known alpha
+    by iteratively reweighted least squares. Each iteration solves the
+    weighted least squares problem with weights mu/(1+alpha*mu).
+    """
+    if start_params is None:
+        # start from the observed counts, shrunk toward their mean
+        eta = np.log((y + y.mean())/2)
+        params = None
+    else:
+        params = np.asarray(start_params, dtype=np.float64)
+        eta = X.dot(params) + offset
+    llf = None
+
+    converged = False
+    for iterations in range(1, maxiter + 1):
+        mu = np.exp(eta)
+        weights = mu/(1 + alpha*mu)
+
+        # working response of the log link, without the offset; the
+        # weighted least squares are solved by the normal equations, or on
+        # the scaled rows (minimum norm solution) if X'WX is singular
+        z = eta - offset + (y - mu)/mu
+        xtw = X.T*weights
+        try:
+            new_params = np.linalg.solve(xtw.dot(X), xtw.dot(z))
+        except np.linalg.LinAlgError:
+            root = np.sqrt(weights)
+            new_params = np.linalg.lstsq(X*root[:, None], z*root,
+                                         rcond=None)[0]
+
+        eta = X.dot(new_params) + offset
+        mu = np.exp(eta)
+        new_llf = nb_loglike(y, mu, alpha)
+        if has_converged(X, mu/(1 + alpha*mu), params, new_params, llf,
+                         new_llf, tol):
+            params = new_params
+            converged = True
+            break
+        params = new_params
+        llf = new_llf
+
+    # information matrix at the fitted coefficients
+    mu = np.exp(eta)
+    xtw = X.T*(mu/(1 + alpha*mu))
+
+    return params, xtw.dot(X), iterations, converged
+
+
+def get_separated(X, weights):
+    """
+    Parameters:
+    @X {numpy array} design matrix
+    @weights {numpy array} IRLS weights mu/(1+alpha*mu) of the sites
+    Return:
+    @separated {numpy array} whether each coefficient is separated, i.e.
+    the average weight of the sites of its column is below SEPARATION_TOL
+    times the average weight of all the sites
+    """
+    squares = X**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        column_weight = weights.dot(squares)/squares.sum(axis=0)
+    return column_weight < SEPARATION_TOL*weights.mean()
+
+
+def has_converged(X, weights, params, new_params, llf, new_llf, tol):
+    """
+    Parameters:
+    @X {numpy array} design matrix
+    @weights {numpy array} IRLS weights at the new coefficients
+    @params {numpy array} coefficients before the step (None at the start)
+    @new_params {numpy array} coefficients after the step
+    @llf {float} log-likelihood before the step (None at the start)
+    @new_llf {float} log-likelihood after the step
+    @tol {float} convergence tolerance
+    Return:
+    @converged {bool} whether the coefficients no longer change, or the
+    log-likelihood no longer changes and only separated coefficients (see
+    get_separated()) still do. A separated coefficient goes to infinity
+    without ever converging, while the log-likelihood does.
+    """
+    if params is None:
+        return False
+    change = np.abs(new_params - params)
+    bound = tol*(1 + np.max(np.abs(params)))
+    if np.max(change) < bound:
+        return True
+    if llf is None or abs(new_llf - llf) >= tol:
+        return False
+    kept = ~get_separated(X, weights)
+    return kept.any() and np.max(change[kept]) < bound
+
+
+def ml_alpha(y, mu, alpha=None, maxiter=25, tol=1e-8):
+    """
+    Parameters:
+    @y {numpy array} observed counts
+    @mu {numpy array} predicted means
+    @alpha {float} value to start from (optional)
+    @maxiter {int} maximum number of Newton steps
+    @tol {float} convergence tolerance on log(alpha)
+    Return:
+    @alpha {float} the alpha maximizing the nb log-likelihood at mu
+    Maximize the nb log-likelihood over alpha for fixed means, by Newton
+    steps on log(1/alpha) with the analytic score and information. Without
+    a start value, the moment estimate of alpha is used.
+    """
+    if alpha is None:
+        alpha = max(np.sum((y/mu - 1)**2)/len(y), ALPHA_BOUNDS[0])
+    log_bounds = -np.log(ALPHA_BOUNDS[1]), -np.log(ALPHA_BOUNDS[0])
+    t = np.clip(-np.log(alpha), *log_bounds)
+
+    # for integer counts, psi(y+size)-psi(size) is the sum of 1/(size+j)
+    # for j<y, so the sums over the sites only need the number of counts
+    # above each j
+    integer = np.all(y == np.floor(y))
+    if integer:
+        n_above = len(y) - np.cumsum(np.bincount(y.astype(np.int64)))[:-1]
+        j = np.arange(len(n_above))
+
+    for i in range(maxiter):
+        size = np.exp(t)
+
+        # derivatives of the log-likelihood with respect to size=1/alpha
+        if integer:
+            sum_digamma = np.sum(n_above/(size + j))
+            sum_trigamma = np.sum(n_above/(size + j)**2)
+        else:
+            sum_digamma = np.sum(digamma(y + size) - digamma(size))
+            sum_trigamma = np.sum(polygamma(1, size) -
+                                  polygamma(1, y + size))
+        score = sum_digamma + np.sum(np.log(size) + 1 - np.log(size + mu) -
+                                     (y + size)/(size + mu))
+        info = sum_trigamma + np.sum(2/(size + mu) - 1/size -
+                                     (y + size)/(size + mu)**2)
+
+        # newton step on t=log(size), or a unit step uphill where the
+        # log-likelihood is not concave
+        grad = size*score
+        hess = grad - size**2*info
+        step = -grad/hess if hess < 0 else np.sign(grad)
+        new_t = np.clip(t + step, *log_bounds)
+        if abs(new_t - t) < tol:
+            t = new_t
+            break
+        t = new_t
+
+    return np.exp(-t)
+
+
+def get_covariance(X, xtwx, weights):
+    """
+    Parameters:
+    @X {numpy array} design matrix
+    @xtwx {numpy array} X'WX at the fitted coefficients
+    @weights {numpy array} IRLS weights mu/(1+alpha*mu) of the sites
+    Return:
+    @cov {numpy array} covariance matrix of the coefficients (before the
+    scale), with an infinite variance and missing covariances for the
+    coefficients that are not identified
+    @degenerate {numpy array} whether each coefficient is not identified
+    A coefficient is not identified when its column is part of a linear
+    dependency among the columns of X (rank deficiency), or when its sites
+    have a vanishing weight (separation, see SEPARATION_TOL). The covariance
+    of the other coefficients is the inverse of their block of X'WX.
+    """
+    # rank deficiency: null space of the design matrix with unit columns
+    norms = np.sqrt(np.sum(X**2, axis=0))
+    degenerate = norms == 0
+    scaled = X[:, ~degenerate]/norms[~degenerate]
+    if scaled.shape[1] > 0:
+        s, vt = np.linalg.svd(scaled, full_matrices=False)[1:]
+        null = vt[s <= s.max()*max(scaled.shape)*np.finfo(float).eps]
+        degenerate[np.flatnonzero(~degenerate)[
+            np.any(np.abs(null) > np.sqrt(np.finfo(float).eps), axis=0)]] = \
+            True
+
+    # separation: the average weight of the sites of every column
+    degenerate |= get_separated(X, weights)
+
+    cov = np.full(xtwx.shape, np.nan)
+    ok = np.flatnonzero(~degenerate)
+    cov[np.ix_(ok, ok)] = np.linalg.pinv(xtwx[np.ix_(ok, ok)])
+    cov[degenerate, degenerate] = np.inf
+    return cov, degenerate
+
+
+def fit_nb_arrays(y, X, offset=None, alpha=None, start_params=None,
+                  start_alpha=None, maxiter=100, tol=1e-8):
+    """
+    Parameters:
+    @y {numpy array} observed counts
+    @X {numpy array} design matrix (with the intercept column)
+    @offset {numpy array} offset term of every row (optional)
+    @alpha {float} fixed nb dispersion parameter; if None, alpha is
+    estimated by maximum likelihood
+    @start_params {numpy array} coefficients to start from, e.g. those of a
+    previous fit (optional)
+    @start_alpha {float} alpha to start the estimation from (optional)
+    @maxiter {int} maximum number of iterations
+    @tol {float} convergence tolerance
+    Return:
+    @results {NBResults} the fitted model
+    Fit an nb2 regression model on arrays. When alpha is not given, the
+    coefficients and alpha are updated in turn (as in glm.nb of the R MASS
+    package): the coefficients by an IRLS step at the current alpha, and
+    alpha by maximizing the likelihood at the fitted means (see ml_alpha()),
+    until both converge. This is the maximum of the profile likelihood of
+    alpha. Starting from the coefficients and alpha of a previous fit (e.g.
+    for bootstrap or cross-validation refits) saves most of the iterations.
+    The iterations and convergence of the results cover both the alternating
+    steps and the final IRLS fit; a RuntimeWarning is issued if either one
+    stops at maxiter without converging; a separated coefficient does not
+    prevent convergence (see has_converged()). A RuntimeWarning is also issued
+    when some coefficients are not identified (see get_covariance()).
+    """
+    y = np.asarray(y, dtype=np.float64)
+    X = np.asarray(X, dtype=np.float64)
+    if offset is None:
+        offset = np.zeros(len(y))
+    offset = np.asarray(offset, dtype=np.float64)
+
+    alpha_iterations = 0
+    alpha_converged = True
+    if alpha is None:
+        alpha = 1.0 if start_alpha is None else start_alpha
+        params = start_params
+        alpha_converged = False
+        llf = None
+        for alpha_iterations in range(1, maxiter + 1):
+            start_params = irls_nb(y, X, offset, alpha, params, 1)[0]
+            mu = np.exp(X.dot(start_params) + offset)
+            new_alpha = ml_alpha(y, mu, alpha, 1)
+            new_llf = nb_loglike(y, mu, new_alpha)
+            done = abs(np.log(new_alpha/alpha)) < tol and \
+                has_converged(X, mu/(1 + new_alpha*mu), params,
+                              start_params, llf, new_llf, tol)
+            params = start_params
+            alpha = new_alpha
+            llf = new_llf
+            if done:
+                alpha_converged = True
+                break
+
+    params, xtwx, iterations, converged = irls_nb(y, X, offset, alpha,
+                                                  start_params, maxiter, tol)
+    mu = np.exp(X.dot(params) + offset)
+    llf = nb_loglike(y, mu, alpha)
+
+    converged = converged and alpha_converged
+    if not converged:
+        warnings.warn('the nb regression did not converge in %d iterations'
+                      % maxiter, RuntimeWarning)
+
+    cov, degenerate = get_covariance(X, xtwx, mu/(1 + alpha*mu))
+    if degenerate.any():
+        warnings.warn('the nb regression coefficients of the columns %s are '
+                      'not identified (rank deficiency or separation), their '
+                      'variance is infinite'
+                      % ', '.join(str(i) for i in np.flatnonzero(degenerate)),
+                      RuntimeWarning)
+
+    return NBResults(params, cov, alpha, llf, alpha_iterations + iterations,
+                     converged, alpha_iterations=alpha_iterations,
+                     degenerate=degenerate)
+
+
+def fit_nb(formula, data, offset=None, alpha=None, start_params=None,
+           start_alpha=None, maxiter=100, tol=1e-8):
+    """
+    Parameters:
+    @formula {string} model formula, e.g. 'tot_acc_ct~log_aadt+C(curve)'
+    @data {pd dataframe} the modeling data
+    @offset {pd series} offset term of every row (optional)
+    @alpha {float} fixed nb dispersion parameter; if None, alpha is
+    estimated by maximum likelihood
+    @start_params {numpy array} coefficients to start from (optional)
+    @start_alpha {float} alpha to start the estimation from (optional)
+    @maxiter {int} maximum number of iterations
+    @tol {float} convergence tolerance
+    Return:
+    @results {NBResults} the fitted model, with the coefficients and the
+    covariance matrix labeled by the design matrix column names
+    Fit an nb2 regression model from a formula, in place of
+    smf.glm(formula, data, offset=offset,
+    family=sm.families.NegativeBinomial()).fit(). Rows with missing values
+    are dropped. The results can be passed to compute_spf(), the eb
+    functions and the ci/pi functions of crash_modeling_tools.
+    """
+    y, X = patsy.dmatrices(formula, data, return_type='dataframe')
+    if offset is not None:
+        offset = pd.Series(np.asarray(offset, dtype=np.float64),
+                           index=data.index).loc[y.index].values
+
+    results = fit_nb_arrays(y.values[:, 0], X.values, offset, alpha,
+                            start_params, start_alpha, maxiter, tol)
+
+    # label the coefficients as statsmodels does
+    names = X.columns
+    results.params = pd.Series(results.params, index=names)
+    results.normalized_cov_params = pd.DataFrame(
+        results.normalized_cov_params, index=names, columns=names)
+    results.degenerate = pd.Series(results.degenerate, index=names)
+    results.formula = formula
+    results.design_info = X.design_info
+    results.reference = get_reference_row(X.design_info, data.loc[y.index])
+
+    return results
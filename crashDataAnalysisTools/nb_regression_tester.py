@@ -0,0 +1,152 @@
+from crash_modeling_tools import calc_var_eta_hat, compute_alpha, compute_spf
+from nb_regression import *
+import numpy as np
+import pandas as pd
+import patsy
+import statsmodels.api as sm
+import statsmodels.formula.api as smf
+import unittest
+
+
+class NBRegressionTester(unittest.TestCase):
+    """
+    The nb fitter is checked against the statsmodels fits used in the rest
+    of the project, on the I-90 test dataset.
+    """
+
+    # load in a standard dataset
+    crash_data_path = '../data/unit_test_data/crash_data_final_90_test.csv'
+    crash_data = pd.read_csv(crash_data_path)
+    crash_data = crash_data.dropna()
+    crash_data['log_aadt'] = crash_data.log_avg_aadt.astype(np.float64)
+    offset_term = np.log(crash_data['seg_lng'] * 3)
+    formula = 'tot_acc_ct~log_aadt+lanewid+avg_grad+C(curve)'
+
+    # fit the model with alpha estimated by maximum likelihood
+    mod_nb = fit_nb(formula, crash_data, offset=offset_term)
+
+    def test_fit_nb_fixed_alpha(self):
+        """
+        With alpha fixed at 1, the fit should be the same as the statsmodels
+        glm with the NegativeBinomial family (fit with a tight tolerance).
+        """
+        mod_glm = smf.glm(self.formula, data=self.crash_data,
+                          offset=self.offset_term,
+                          family=sm.families.NegativeBinomial()).fit(
+                              tol=1e-12)
+        mod_nb = fit_nb(self.formula, self.crash_data,
+                        offset=self.offset_term, alpha=1.0)
+
+        self.assertTrue(list(mod_nb.params.index) ==
+                        list(mod_glm.params.index))
+        self.assertTrue(np.allclose(mod_nb.params, mod_glm.params,
+                                    atol=1e-5))
+        self.assertTrue(np.allclose(mod_nb.normalized_cov_params,
+                                    mod_glm.normalized_cov_params,
+                                    atol=1e-5))
+        self.assertTrue(np.isclose(mod_nb.llf, mod_glm.llf))
+
+    def test_fit_nb_ml_alpha(self):
+        """
+        The estimated alpha and coefficients should be the maximum likelihood
+        estimates of the statsmodels discrete nb model.
+        """
+        mod_ml = smf.negativebinomial(self.formula, data=self.crash_data,
+                                      offset=self.offset_term).fit(
+                                          disp=0, maxiter=200)
+
+        self.assertTrue(np.isclose(self.mod_nb.alpha, mod_ml.params['alpha'],
+                                   rtol=1e-4))
+        self.assertTrue(np.allclose(self.mod_nb.params,
+                                    mod_ml.params[:-1], atol=1e-4))
+        self.assertTrue(np.isclose(self.mod_nb.llf, mod_ml.llf))
+
+        # the crash modeling functions get alpha from the scale
+        self.assertTrue(np.isclose(compute_alpha(self.mod_nb),
+                                   self.mod_nb.alpha))
+
+    def test_fit_nb_arrays_warm_start(self):
+        """
+        A fit started from the fitted coefficients and alpha should give the
+        same model in fewer iterations.
+        """
+        y, X = patsy.dmatrices(self.formula, self.crash_data)
+        cold = fit_nb_arrays(y[:, 0], X, self.offset_term.values)
+        warm = fit_nb_arrays(y[:, 0], X, self.offset_term.values,
+                             start_params=cold.params,
+                             start_alpha=cold.alpha)
+
+        self.assertTrue(np.allclose(warm.params, cold.params))
+        self.assertTrue(np.isclose(warm.alpha, cold.alpha))
+        self.assertTrue(warm.iterations <= cold.iterations)
+        self.assertTrue(warm.converged)
+        self.assertTrue(0 < warm.alpha_iterations <= cold.alpha_iterations)
+
+    def test_fit_nb_arrays_not_converged(self):
+        """
+        A fit stopped by maxiter during the estimation of alpha should be
+        reported as not converged.
+        """
+        y, X = patsy.dmatrices(self.formula, self.crash_data)
+        with self.assertWarns(RuntimeWarning):
+            capped = fit_nb_arrays(y[:, 0], X, self.offset_term.values,
+                                   maxiter=2)
+        self.assertFalse(capped.converged)
+        self.assertTrue(capped.alpha_iterations == 2)
+
+    def test_fit_nb_separation(self):
+        """
+        With the formula of the project, the only site of surface type B has
+        no crash: its coefficient is separated. The fit should converge on
+        the log-likelihood, report the coefficient as not identified with an
+        infinite variance, and give the other coefficients and alpha of the
+        statsmodels discrete nb model fit to convergence.
+        """
+        formula = self.formula + '+C(surf_typ)'
+        with self.assertWarns(RuntimeWarning):
+            mod_nb = fit_nb(formula, self.crash_data,
+                            offset=self.offset_term)
+        mod_ml = smf.negativebinomial(formula, data=self.crash_data,
+                                      offset=self.offset_term).fit(
+                                          method='newton', maxiter=300,
+                                          disp=0)
+
+        self.assertTrue(mod_nb.converged)
+        self.assertTrue(list(mod_nb.params.index[mod_nb.degenerate]) ==
+                        ['C(surf_typ)[T.B]'])
+        self.assertTrue(np.isinf(mod_nb.bse[mod_nb.degenerate]).all())
+        self.assertTrue((mod_nb.bse[~mod_nb.degenerate] > 0).all())
+        self.assertTrue(mod_nb.params['C(surf_typ)[T.B]'] < -15)
+
+        identified = ~mod_nb.degenerate.values
+        self.assertTrue(np.allclose(mod_nb.params[identified],
+                                    mod_ml.params[:-1][identified],
+                                    atol=1e-4))
+        self.assertTrue(np.isclose(mod_nb.alpha, mod_ml.params['alpha'],
+                                   rtol=1e-4))
+        self.assertTrue(np.isclose(mod_nb.llf, mod_ml.llf))
+
+        # only the variance of the site of surface type B is infinite
+        design = patsy.dmatrix(formula.split('~')[1], self.crash_data,
+                               return_type='dataframe')
+        var_eta_hat = calc_var_eta_hat(mod_nb, design)[:, 0]
+        surface_b = (self.crash_data.surf_typ == 'B').values
+        self.assertTrue(np.isinf(var_eta_hat[surface_b]).all())
+        self.assertTrue((var_eta_hat[~surface_b] > 0).all())
+        self.assertTrue(np.isfinite(var_eta_hat[~surface_b]).all())
+
+    def test_predict(self):
+        """
+        The fitted model should work with the spf and variance functions.
+        """
+        spf = compute_spf(self.mod_nb, self.crash_data)
+        self.assertTrue(len(np.where(spf > 0)[0]) == len(self.crash_data))
+
+        design = patsy.dmatrix(self.formula.split('~')[1], self.crash_data,
+                               return_type='dataframe')
+        var_eta_hat = calc_var_eta_hat(self.mod_nb, design)
+        self.assertTrue(len(np.where(var_eta_hat > 0)[0]) == len(design))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+import argparse
+import json
+import sys
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import pandas as pd
+
+from crash_modeling_tools import PREDICTION_CHUNKSIZE, \
+    compute_empirical_bayes, predict_nb
+from design_compiler import get_design_compiler
+from spf_model import load_spf_model
+
+# number of batches kept for the latency statistics
+LATENCY_LOG_SIZE = 10000
+
+
+class PredictionService(object):
+    """
+    Long-lived prediction service for new sites (Use Case 3). The model is
+    loaded once and its design matrix builder is compiled when the service
+    starts (see design_compiler); every batch of site records then goes
+    through one vectorized prediction (see crash_modeling_tools.predict_nb()).
+    """
+
+    def __init__(self, model, count_col='tot_acc_ct', length_col='seg_lng',
+                 chunksize=PREDICTION_CHUNKSIZE):
+        """
+        Parameters:
+        @model {SPFModel, NBResults, statsmodels genmod or string} the fitted
+        model, or the path of a saved model (see spf_model.save_spf_model())
+        @count_col {string} column of the observed crash counts; when the
+        records have it, the eb results are added
+        @length_col {string} column of the segment lengths used by the eb
+        weights
+        @chunksize {int} number of rows of the design matrix processed at
+        once
+        """
+        if isinstance(model, str):
+            model = load_spf_model(model)
+        self.model = model
+
+        # compile the design of the fitted model once; saved models without
+        # a reference row (older files) are compiled on the first batch
+        self.compiler = get_design_compiler(model)
+        self.count_col = count_col
+        self.length_col = length_col
+        self.chunksize = chunksize
+        self.latency = deque(maxlen=LATENCY_LOG_SIZE)
+
+    def predict(self, sites):
+        """
+        Parameters:
+        @sites {pd dataframe or list} batch of site records (dicts)
+        Return:
+        @prediction {pd dataframe} mu_hat, var_eta_hat and the ci/pi bounds
+        of every site, plus the eb results (see EB_COLUMNS) when the
+        records have observed crash counts
+        """
+        start = time.time()
+        if not isinstance(sites, pd.DataFrame):
+            sites = pd.DataFrame.from_records(sites)
+
+        prediction = predict_nb(self.model, sites, self.chunksize)
+
+        if self.count_col in sites.columns:
+            eb = compute_empirical_bayes(self.model, None,
+                                         sites[self.length_col],
+                                         sites[self.count_col],
+                                         spf=prediction['mu_hat'].values)
+            prediction = pd.concat([prediction, eb.reset_index(drop=True)],
+                                   axis=1)
+
+        self.latency.append((len(sites), time.time() - start))
+        return prediction
+
+    def get_latency_stats(self):
+        """
+        Return:
+        @stats {pd series} number of batches and sites, and the 50th, 90th
+        and 99th percentiles and maximum of the time per batch and per site
+        (milliseconds) over the recent batches
+        """
+        log = np.array(self.latency, dtype=np.float64).reshape(-1, 2)
+        stats = pd.Series({'batches': len(log), 'sites': log[:, 0].sum()})
+        per_batch = 1000 * log[:, 1]
+        per_site = per_batch / np.maximum(log[:, 0], 1)
+
+        for name, values in [('batch_ms', per_batch),
+                             ('site_ms', per_site)]:
+            if len(values) == 0:
+                values = np.array([np.nan])
+            for q in [50, 90, 99]:
+                stats['%s_p%d' % (name, q)] = np.percentile(values, q)
+            stats[name + '_max'] = np.max(values)
+        return stats
+
+
+def to_records(prediction):
+    """
+    Parameters:
+    @prediction {pd dataframe} output of PredictionService.predict()
+    Return:
+    @records {list} one dict per site, with missing values as None
+    """
+    prediction = prediction.astype(object).where(prediction.notnull(), None)
+    return prediction.to_dict(orient='records')
+
+
+def serve_stdin(service, infile=sys.stdin, outfile=sys.stdout):
+    """
+    Parameters:
+    @service {PredictionService} the prediction service
+    @infile {file} input stream, one json batch per line
+    @outfile {file} output stream, one json result per line
+    Serve predictions over a pair of streams: every input line is a json
+    list of site records (or a single record), and the matching output line
+    is the json list of results, or {"error": message}.
+    """
+    for line in infile:
+        if not line.strip():
+            continue
+        try:
+            sites = json.loads(line)
+            if isinstance(sites, dict):
+                sites = [sites]
+            result = to_records(service.predict(sites))
+        except Exception as error:
+            result = {'error': str(error)}
+        outfile.write(json.dumps(result) + '\n')
+        outfile.flush()
+
+
+def make_http_server(service, host='127.0.0.1', port=8000):
+    """
+    Parameters:
+    @service {PredictionService} the prediction service
+    @host {string} address to listen on
+    @port {int} port to listen on (0 for any free port)
+    Return:
+    @server {HTTPServer} the server; call serve_forever() to start it
+    Make a local HTTP front end: POST /predict with a json list of site
+    records returns the json list of results, and GET /stats returns the
+    latency statistics.
+    """
+    class Handler(BaseHTTPRequestHandler):
+
+        def send_json(self, code, result):
+            body = json.dumps(result).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_json(404, {'error': 'unknown path ' + self.path})
+                return
+            try:
+                size = int(self.headers.get('Content-Length', 0))
+                sites = json.loads(self.rfile.read(size).decode())
+                if isinstance(sites, dict):
+                    sites = [sites]
+                self.send_json(200, to_records(service.predict(sites)))
+            except Exception as error:
+                self.send_json(400, {'error': str(error)})
+
+        def do_GET(self):
+            if self.path != '/stats':
+                self.send_json(404, {'error': 'unknown path ' + self.path})
+                return
+            stats = service.get_latency_stats()
+            self.send_json(200, dict((name, None if np.isnan(value)
+                                      else float(value))
+                                     for name, value in stats.items()))
+
+        def log_message(self, format, *args):
+            # keep the console quiet
+            pass
+
+    return HTTPServer((host, port), Handler)
+
+
+def main(argv=None):
+    """
+    Run the prediction service from the command line, e.g.
+    python prediction_service.py spf.model --http 8000
+    """
+    parser = argparse.ArgumentParser(description='Crash prediction service')
+    parser.add_argument('model', help='path of a saved spf model')
+    parser.add_argument('--http', type=int, metavar='PORT',
+                        help='serve over HTTP on this port instead of stdin')
+    parser.add_argument('--host', default='127.0.0.1')
+    args = parser.parse_args(argv)
+
+    service = PredictionService(args.model)
+    if args.http is None:
+        serve_stdin(service)
+    else:
+        server = make_http_server(service, args.host, args.http)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+from crash_modeling_tools import *
+from prediction_service import *
+import io
+import json
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+import statsmodels.formula.api as smf
+import threading
+import unittest
+import urllib.request
+
+
+class PredictionServiceTester(unittest.TestCase):
+    """
+    The service is run on a model fit on the I-90 test dataset, with the eb
+    test dataset as the new sites.
+    """
+
+    # load in a standard dataset and fit a nb regression model
+    crash_data_path = '../data/unit_test_data/crash_data_final_90_test.csv'
+    crash_data = pd.read_csv(crash_data_path)
+    crash_data = crash_data.dropna()
+    crash_data['log_aadt'] = crash_data.log_avg_aadt.astype(np.float64)
+    offset_term = np.log(crash_data['seg_lng'] * 3)
+    mod_nb = smf.glm('tot_acc_ct~log_aadt+lanewid+avg_grad+C(curve)+\
+                     C(surf_typ)', data=crash_data, offset=offset_term,
+                     family=sm.families.NegativeBinomial()).fit()
+
+    # load the new sites
+    eb_data_path = '../data/unit_test_data/crash_data_eb_test.csv'
+    data_eb = pd.read_csv(eb_data_path)
+    data_eb = data_eb.dropna().reset_index(drop=True)
+    data_eb['log_aadt'] = data_eb.log_avg_aadt.astype(np.float64)
+
+    def test_predict(self):
+        """
+        The service should give the same predictions as the crash modeling
+        functions, for every batch.
+        """
+        service = PredictionService(self.mod_nb)
+        spf = compute_spf(self.mod_nb, self.data_eb)
+
+        # the fitted model is kept and its design compiled at start
+        self.assertTrue(service.model is self.mod_nb)
+        self.assertTrue(service.compiler is not None)
+        eb = compute_empirical_bayes(self.mod_nb, self.data_eb,
+                                     self.data_eb['seg_lng'],
+                                     self.data_eb['tot_acc_ct'])
+
+        for start in range(0, len(self.data_eb), 100):
+            batch = self.data_eb.iloc[start:start + 100]
+            prediction = service.predict(batch)
+            self.assertTrue(np.allclose(prediction['mu_hat'],
+                                        spf[start:start + 100]))
+            self.assertTrue(np.allclose(prediction[EB_COLUMNS],
+                                        eb.iloc[start:start + 100]))
+
+        # sites without crash counts only get the predictions
+        records = self.data_eb.drop('tot_acc_ct', axis=1).iloc[:5]
+        prediction = service.predict(records.to_dict(orient='records'))
+        self.assertTrue(list(prediction.columns) == PREDICTION_COLUMNS)
+
+        # check the latency statistics
+        stats = service.get_latency_stats()
+        self.assertTrue(stats['sites'] == len(self.data_eb) + 5)
+        self.assertTrue(stats['site_ms_p50'] <= stats['site_ms_max'])
+
+    def test_serve_stdin(self):
+        """
+        Every input line gets one output line, with an error message for a
+        bad batch.
+        """
+        service = PredictionService(self.mod_nb)
+        records = self.data_eb.iloc[:3].to_dict(orient='records')
+        infile = io.StringIO(json.dumps(records) + '\n' +
+                             json.dumps({'lanewid': 12}) + '\n')
+        outfile = io.StringIO()
+        serve_stdin(service, infile, outfile)
+
+        lines = outfile.getvalue().splitlines()
+        self.assertTrue(len(lines) == 2)
+        self.assertTrue(len(json.loads(lines[0])) == 3)
+        self.assertTrue('error' in json.loads(lines[1]))
+
+    def test_http_server(self):
+        """
+        Post a batch to the HTTP front end on a free local port.
+        """
+        service = PredictionService(self.mod_nb)
+        server = make_http_server(service, port=0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d' % server.server_address[1]
+            records = self.data_eb.iloc[:3].to_dict(orient='records')
+            request = urllib.request.Request(
+                url + '/predict', data=json.dumps(records).encode(),
+                headers={'Content-Type': 'application/json'})
+            result = json.loads(urllib.request.urlopen(request).read())
+            stats = json.loads(urllib.request.urlopen(url + '/stats').read())
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        self.assertTrue(len(result) == 3)
+        self.assertTrue(stats['sites'] == 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
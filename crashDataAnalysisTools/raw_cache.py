@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+# default folder (relative to the data folder) holding the cached tables
+CACHE_DIR = 'raw_cache'
+
+# one entry per table read through read_csv_cached() in this session
+CACHE_LOG = []
+
+# type of the distinct values of a dictionary encoded column
+TEXT_VALUE, NUMBER_VALUE, BOOL_VALUE = 0, 1, 2
+
+
+def hash_file(file_name):
+    '''
+    Parameters:
+    @file_name {string} path of the file
+    Return:
+    @digest {string} hex SHA-1 digest of the file content
+    '''
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def cache_paths(file_name, cache_dir):
+    '''
+    Parameters:
+    @file_name {string} path of the source .csv file
+    @cache_dir {string} folder holding the cached tables
+    Return:
+    @data_path {string} path of the .npz file holding the columns
+    @meta_path {string} path of the .json file describing the cache
+    '''
+    base = os.path.join(cache_dir, os.path.basename(file_name))
+    return base + '.npz', base + '.json'
+
+
+def write_meta(meta, meta_path):
+    '''
+    Parameters:
+    @meta {dict} description of a cached table
+    @meta_path {string} path of the .json file
+    Write the description of a cached table through a temporary file, so
+    that concurrent readers never see a partial file.
+    '''
+    tmp_path = meta_path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+
+def parse_number(text):
+    '''
+    Parameters:
+    @text {string} text of an integer or float value
+    Return:
+    @value {int or float} the parsed value
+    '''
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def save_columns(data, data_path):
+    '''
+    Parameters:
+    @data {pd dataframe} the parsed table
+    @data_path {string} path of the .npz file
+    Return:
+    @columns {list} description (name and kind) of the stored columns
+    Store every column of a table as a typed NumPy array. Numeric columns
+    keep their dtype. Other columns are dictionary encoded: the distinct
+    values are stored as text (with the type of the numbers and booleans
+    found in columns of mixed type) and the rows as integer codes, -1 for
+    missing values.
+    '''
+    arrays = {}
+    columns = []
+    for i, col in enumerate(data.columns):
+        values = data[col]
+        if values.dtype.kind in 'biuf':
+            arrays['c%d' % i] = values.values
+            columns.append({'name': col, 'kind': 'numeric'})
+        else:
+            codes, uniques = pd.factorize(values)
+            arrays['c%d' % i] = codes.astype(np.int32)
+            arrays['u%d' % i] = np.array([str(u) for u in uniques],
+                                         dtype=np.str_)
+            arrays['n%d' % i] = np.array(
+                [BOOL_VALUE if isinstance(u, (bool, np.bool_)) else
+                 TEXT_VALUE if isinstance(u, str) else NUMBER_VALUE
+                 for u in uniques], dtype=np.int8)
+            columns.append({'name': col, 'kind': 'text'})
+
+    # write to a temporary file first so that readers (e.g. the parallel
+    # workers of merge_annual_data) never see a partial cache file
+    tmp_path = data_path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, data_path)
+
+    return columns
+
+
+def load_columns(data_path, columns):
+    '''
+    Parameters:
+    @data_path {string} path of the .npz file
+    @columns {list} description (name and kind) of the stored columns
+    Return:
+    @data {pd dataframe} the cached table
+    '''
+    data = pd.DataFrame()
+    with np.load(data_path) as arrays:
+        for i, col in enumerate(columns):
+            values = arrays['c%d' % i]
+            if col['kind'] == 'text':
+                # decode the distinct values; code -1 picks the trailing NaN
+                uniques = arrays['u%d' % i].astype(object)
+                kinds = arrays['n%d' % i]
+                for j in np.flatnonzero(kinds == NUMBER_VALUE):
+                    uniques[j] = parse_number(uniques[j])
+                for j in np.flatnonzero(kinds == BOOL_VALUE):
+                    uniques[j] = uniques[j] == 'True'
+                values = np.append(uniques, np.nan)[values]
+            data[col['name']] = values
+    return data
+
+
+def read_csv_cached(file_name, cache_dir=CACHE_DIR):
+    '''
+    Parameters:
+    @file_name {string} path of the .csv file
+    @cache_dir {string} folder holding the cached tables
+    Return:
+    @data {pd dataframe} the table read from the file
+    Read a .csv file through a binary columnar cache. The first read parses
+    the text file and saves the parsed columns to an .npz file; later reads
+    load the columns directly as long as the source file is unchanged. The
+    cache is keyed on the size, modification time and SHA-1 hash of the
+    source: a file with a new size is parsed again, and a file with only a
+    new modification time is hashed to check whether its content changed.
+    The parse time, load time and number of rows of every read are recorded
+    in CACHE_LOG (see get_cache_stats()).
+    '''
+    start = time.time()
+    stat = os.stat(file_name)
+    data_path, meta_path = cache_paths(file_name, cache_dir)
+
+    # look up the cache description
+    meta = None
+    if os.path.exists(meta_path) and os.path.exists(data_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+    # decide whether the cached table is still valid
+    valid = False
+    if meta is not None and meta['size'] == stat.st_size:
+        if meta['mtime'] == stat.st_mtime:
+            valid = True
+        elif meta['sha1'] == hash_file(file_name):
+            # same content with a new modification time: keep the cache
+            meta['mtime'] = stat.st_mtime
+            write_meta(meta, meta_path)
+            valid = True
+
+    if valid:
+        data = load_columns(data_path, meta['columns'])
+        source = 'cache'
+    else:
+        # parse the text file and save the parsed columns
+        data = pd.read_csv(file_name)
+        parse_time = time.time() - start
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        meta = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                'sha1': hash_file(file_name), 'rows': len(data),
+                'parse_time': parse_time,
+                'columns': save_columns(data, data_path)}
+        write_meta(meta, meta_path)
+        source = 'csv'
+
+    CACHE_LOG.append({'file': os.path.basename(file_name),
+                      'source': source, 'rows': len(data),
+                      'seconds': time.time() - start,
+                      'csv_parse_seconds': meta['parse_time']})
+
+    return data
+
+
+def get_cache_stats():
+    '''
+    Return:
+    @stats {pd dataframe} one row per table read through read_csv_cached()
+    Summarize the reads of this session: the source of each read ('csv' or
+    'cache'), the number of rows, the time of the read and the time it took
+    to parse the .csv file when the cache was built.
+    '''
+    return pd.DataFrame(CACHE_LOG, columns=['file', 'source', 'rows',
+                                            'seconds', 'csv_parse_seconds'])
@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from raw_cache import *
+
+
+class RawCacheTest(unittest.TestCase):
+    '''
+    Test functions for the columnar cache of the raw .csv files. Each test
+    works on a small .csv file written to a scratch folder.
+    '''
+
+    def setUp(self):
+        # write a small table with numeric, text, missing and mixed values
+        self.folder = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.folder, 'cache')
+        self.csv = os.path.join(self.folder, 'wa06acc.csv')
+        with open(self.csv, 'w') as f:
+            f.write('rd_inv,milepost,caseno,weather\n'
+                    '005,1.5,1,02\n'
+                    '090,,2,\n'
+                    '005S,3.25,3,X\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_read_csv_cached(self):
+        '''
+        The second read should come from the cache and give the same table
+        as parsing the .csv file.
+        '''
+        first = read_csv_cached(self.csv, self.cache_dir)
+        second = read_csv_cached(self.csv, self.cache_dir)
+
+        # check the sources of the two reads
+        stats = get_cache_stats()
+        self.assertEqual(stats.source.tolist()[-2:], ['csv', 'cache'])
+
+        # check the cached table against the parsed table
+        parsed = pd.read_csv(self.csv)
+        self.assertEqual(list(second.columns), list(parsed.columns))
+        for col in parsed.columns:
+            same = (second[col] == parsed[col]) | \
+                (second[col].isnull() & parsed[col].isnull())
+            self.assertTrue(same.all())
+        self.assertEqual(len(first), stats.rows.tolist()[-1])
+
+    def test_read_csv_cached_invalidation(self):
+        '''
+        A file with a new content is parsed again, while a file that is only
+        touched is still read from the cache.
+        '''
+        read_csv_cached(self.csv, self.cache_dir)
+
+        # touch the file without changing its content
+        os.utime(self.csv, (1, 1))
+        read_csv_cached(self.csv, self.cache_dir)
+        self.assertEqual(get_cache_stats().source.tolist()[-1], 'cache')
+
+        # change the content of the file
+        with open(self.csv, 'a') as f:
+            f.write('005,4.0,4,01\n')
+        data = read_csv_cached(self.csv, self.cache_dir)
+        self.assertEqual(get_cache_stats().source.tolist()[-1], 'csv')
+        self.assertEqual(len(data), 4)
+
+    def test_read_csv_cached_bool(self):
+        '''
+        A column of booleans with missing values (parsed as objects) should
+        come back from the cache as booleans.
+        '''
+        with open(self.csv, 'w') as f:
+            f.write('rd_inv,map_matched\n'
+                    '005,True\n'
+                    '090,\n'
+                    '005,False\n')
+        parsed = pd.read_csv(self.csv)
+        read_csv_cached(self.csv, self.cache_dir)
+        cached = read_csv_cached(self.csv, self.cache_dir)
+        self.assertEqual(get_cache_stats().source.tolist()[-1], 'cache')
+        self.assertEqual(cached.map_matched.tolist()[::2], [True, False])
+        self.assertTrue(all(isinstance(value, bool)
+                            for value in cached.map_matched[::2]))
+        self.assertTrue(np.isnan(cached.map_matched[1]))
+        self.assertTrue(cached.rd_inv.equals(parsed.rd_inv))
+
+
+if __name__ == '__main__':
+    unittest.main()
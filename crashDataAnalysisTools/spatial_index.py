@@ -0,0 +1,183 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+# mean radius of the earth (miles)
+EARTH_RADIUS = 3958.8
+
+# average number of points per grid cell of the bounding box index
+POINTS_PER_CELL = 16
+
+
+def to_unit_sphere(lons, lats):
+    """
+    Parameters:
+    @lons {numpy array} longitudes (degrees)
+    @lats {numpy array} latitudes (degrees)
+    Return:
+    @xyz {numpy array} the points on the unit sphere (n x 3); the chord
+    between two points grows with their great circle distance
+    """
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    cos_lats = np.cos(lats)
+    return np.column_stack((cos_lats * np.cos(lons), cos_lats * np.sin(lons),
+                            np.sin(lats)))
+
+
+class SpatialIndex(object):
+    """
+    Spatial index of points given by their longitude and latitude, e.g. the
+    longitude and latitude columns of the segments built by
+    data_prep.get_annual_data(). Bounding box queries use a uniform grid:
+    the points are sorted by grid cell, so the points of a row of cells are
+    one slice of the sorted points. Nearest neighbor and radius queries use
+    a KD-tree of the points on the unit sphere, so that the distances are
+    great circle distances (miles). Points with a missing coordinate are
+    left out. The queries return positions in the arrays the index was
+    built from (e.g. for data.iloc[]).
+    """
+
+    def __init__(self, lons, lats, cell_size=None):
+        """
+        Parameters:
+        @lons {numpy array} longitudes of the points (degrees)
+        @lats {numpy array} latitudes of the points (degrees)
+        @cell_size {float} side of the grid cells (degrees); by default,
+        about POINTS_PER_CELL points per cell
+        """
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        self.positions = np.flatnonzero(~(np.isnan(lons) | np.isnan(lats)))
+        self.lons = lons[self.positions]
+        self.lats = lats[self.positions]
+        n_points = len(self.positions)
+
+        # grid of the bounding box of the points
+        if n_points > 0:
+            self.min_lon, self.min_lat = self.lons.min(), self.lats.min()
+            width = self.lons.max() - self.min_lon
+            height = self.lats.max() - self.min_lat
+        else:
+            self.min_lon = self.min_lat = width = height = 0.0
+        if cell_size is None:
+            cells = max(n_points / float(POINTS_PER_CELL), 1)
+            cell_size = np.sqrt(max(width * height, 1e-12) / cells)
+            cell_size = max(cell_size, max(width, height) / 1e6, 1e-9)
+        self.cell_size = cell_size
+        self.n_cols = int(width / cell_size) + 1
+        self.n_rows = int(height / cell_size) + 1
+
+        # sort the points by cell
+        cells = self.get_rows(self.lats) * self.n_cols + \
+            self.get_cols(self.lons)
+        self.order = np.argsort(cells, kind='stable')
+        self.cells = cells[self.order]
+
+        self.tree = cKDTree(to_unit_sphere(self.lons, self.lats))
+
+    def get_cols(self, lons):
+        # grid column of every longitude
+        return np.clip(((np.asarray(lons) - self.min_lon) /
+                        self.cell_size).astype(np.int64), 0, self.n_cols - 1)
+
+    def get_rows(self, lats):
+        # grid row of every latitude
+        return np.clip(((np.asarray(lats) - self.min_lat) /
+                        self.cell_size).astype(np.int64), 0, self.n_rows - 1)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def query_bbox(self, llon, llat, rlon, rlat):
+        """
+        Parameters:
+        @llon {float} longitude of a corner of the box
+        @llat {float} latitude of the same corner
+        @rlon {float} longitude of the opposite corner
+        @rlat {float} latitude of the opposite corner
+        Return:
+        @positions {numpy array} sorted positions of the points inside the
+        box (borders included)
+        """
+        min_lon, max_lon = min(llon, rlon), max(llon, rlon)
+        min_lat, max_lat = min(llat, rlat), max(llat, rlat)
+        if len(self) == 0 or max_lon < self.min_lon or \
+                max_lat < self.min_lat:
+            return np.array([], dtype=np.int64)
+
+        # slices of the sorted points in the rows of cells of the box
+        col_start = self.get_cols(min_lon)
+        col_stop = self.get_cols(max_lon)
+        rows = np.arange(self.get_rows(min_lat), self.get_rows(max_lat) + 1)
+        starts = np.searchsorted(self.cells, rows * self.n_cols + col_start,
+                                 side='left')
+        stops = np.searchsorted(self.cells, rows * self.n_cols + col_stop,
+                                side='right')
+
+        # points of the slices, then those inside the box
+        sizes = stops - starts
+        candidates = np.repeat(starts - np.cumsum(sizes) + sizes, sizes) + \
+            np.arange(sizes.sum())
+        candidates = self.order[candidates]
+        lons = self.lons[candidates]
+        lats = self.lats[candidates]
+        inside = (lons >= min_lon) & (lons <= max_lon) & \
+            (lats >= min_lat) & (lats <= max_lat)
+
+        return np.sort(self.positions[candidates[inside]])
+
+    def query_knn(self, lons, lats, k=1):
+        """
+        Parameters:
+        @lons {numpy array} longitudes of the query points
+        @lats {numpy array} latitudes of the query points
+        @k {int} number of neighbors
+        Return:
+        @distances {numpy array} great circle distances (miles) of the k
+        nearest points of every query point (n x k), nearest first
+        @positions {numpy array} positions of the k nearest points (n x k);
+        missing neighbors (fewer than k points) have an infinite distance
+        and position -1
+        """
+        xyz = to_unit_sphere(np.atleast_1d(lons), np.atleast_1d(lats))
+        chords, neighbors = self.tree.query(xyz, k=[i + 1 for i in range(k)])
+        missing = neighbors >= len(self)
+        positions = np.where(missing, -1,
+                             self.positions[np.minimum(neighbors,
+                                                       len(self) - 1)])
+        distances = 2 * EARTH_RADIUS * np.arcsin(np.minimum(chords / 2, 1))
+        distances[missing] = np.inf
+        return distances, positions
+
+    def query_radius(self, lon, lat, radius):
+        """
+        Parameters:
+        @lon {float} longitude of the query point
+        @lat {float} latitude of the query point
+        @radius {float} great circle distance (miles)
+        Return:
+        @positions {numpy array} sorted positions of the points within the
+        distance of the query point
+        """
+        chord = 2 * np.sin(min(radius / (2 * EARTH_RADIUS), np.pi / 2))
+        neighbors = self.tree.query_ball_point(to_unit_sphere(lon, lat)[0],
+                                               chord * (1 + 1e-12))
+        return np.sort(self.positions[np.asarray(neighbors,
+                                                 dtype=np.int64)])
+
+
+def build_spatial_index(data, lon_col='longitude', lat_col='latitude',
+                        cell_size=None):
+    """
+    Parameters:
+    @data {pd dataframe} the sites, e.g. the output of
+    data_prep.get_annual_data()
+    @lon_col {string} column of the longitudes
+    @lat_col {string} column of the latitudes
+    @cell_size {float} side of the grid cells (degrees, optional)
+    Return:
+    @index {SpatialIndex} the spatial index of the sites; the queries
+    return row positions of data
+    """
+    return SpatialIndex(data[lon_col].values, data[lat_col].values,
+                        cell_size)
@@ -0,0 +1,70 @@
+from spatial_index import *
+import numpy as np
+import pandas as pd
+import unittest
+
+
+class SpatialIndexTester(unittest.TestCase):
+    """
+    The queries are checked against brute force searches, on random sites
+    spread over Washington State.
+    """
+
+    # random sites, some of them without coordinates
+    rng = np.random.default_rng(0)
+    sites = pd.DataFrame({'longitude': rng.uniform(-124.7, -116.9, 20000),
+                          'latitude': rng.uniform(45.5, 49.0, 20000)})
+    sites.iloc[::97] = np.nan
+    index = build_spatial_index(sites)
+
+    def great_circle(self, lon, lat):
+        # great circle distance (miles) of every site to a point
+        lons = np.radians(self.sites.longitude.values)
+        lats = np.radians(self.sites.latitude.values)
+        lon, lat = np.radians(lon), np.radians(lat)
+        h = np.sin((lats - lat) / 2)**2 + \
+            np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2)**2
+        return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(h))
+
+    def test_query_bbox(self):
+        """
+        The box query should return the sites inside the box, whatever the
+        order of the corners.
+        """
+        lons = self.sites.longitude.values
+        lats = self.sites.latitude.values
+        for box in [(-123.0, 48.0, -122.0, 47.0),
+                    (-125.0, 50.0, -116.0, 45.0),
+                    (-120.5, 46.0, -120.4, 46.1),
+                    (-110.0, 46.0, -100.0, 47.0)]:
+            expected = np.flatnonzero((lons >= min(box[0], box[2])) &
+                                      (lons <= max(box[0], box[2])) &
+                                      (lats >= min(box[1], box[3])) &
+                                      (lats <= max(box[1], box[3])))
+            self.assertTrue(np.array_equal(self.index.query_bbox(*box),
+                                           expected))
+        self.assertTrue(len(self.index) ==
+                        self.sites.longitude.notnull().sum())
+
+    def test_query_knn_and_radius(self):
+        """
+        The nearest sites and the sites within a distance should be those
+        found by computing all the distances.
+        """
+        distances, positions = self.index.query_knn([-122.3, -117.4],
+                                                    [47.6, 47.7], k=5)
+        for i, (lon, lat) in enumerate([(-122.3, 47.6), (-117.4, 47.7)]):
+            all_distances = self.great_circle(lon, lat)
+            expected = np.argsort(np.nan_to_num(all_distances,
+                                                nan=np.inf))[:5]
+            self.assertTrue(np.array_equal(positions[i], expected))
+            self.assertTrue(np.allclose(distances[i],
+                                        all_distances[expected]))
+
+            within = self.index.query_radius(lon, lat, 3.0)
+            self.assertTrue(np.array_equal(
+                within, np.flatnonzero(all_distances <= 3.0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
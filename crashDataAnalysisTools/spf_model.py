@@ -0,0 +1,191 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from design_compiler import get_design_compiler, get_design_info, \
+    get_reference_row, get_transform_states
+
+# first bytes of a saved model file
+MAGIC = b'SPFMODEL1\n'
+
+
+class SPFModel(object):
+    """
+    Fitted safety performance function (spf) loaded from a model file (see
+    save_spf_model()). It holds only the coefficients, the covariance matrix
+    of the coefficients, the scale and alpha, the formula, the levels of
+    the categorical variables, the state of the stateful transforms (e.g.
+    center()) and a reference row of the raw variables, from which the
+    design of the fitted model is rebuilt (see
+    design_compiler.get_design_info()). It provides the attributes used by the
+    crash_modeling_tools functions in place of a statsmodels result: params,
+    normalized_cov_params, scale and predict().
+    """
+
+    def __init__(self, formula, names, params, normalized_cov_params, scale,
+                 alpha, levels, transforms=None, reference=None):
+        self.formula = formula
+        self.names = names
+        self.params = params
+        self.normalized_cov_params = normalized_cov_params
+        self.scale = scale
+        self.alpha = alpha
+        self.levels = levels
+        self.transforms = transforms
+        self.reference = reference
+
+    def design_matrix(self, data):
+        """
+        Parameters:
+        @data {pd dataframe} the raw predictor variables
+        Return:
+        @design {pd dataframe} the design matrix, one column per coefficient
+        Build the design matrix of new data from the formula. The levels of
+        the categorical variables are those of the fitted model, so the
+        dummy columns are the same whatever levels appear in the data. The
+        formula is compiled once (see design_compiler).
+        """
+        design = get_design_compiler(self, data)(data)
+        return pd.DataFrame(design, index=data.index, columns=self.names)
+
+    def predict(self, exog, offset=None):
+        """
+        Parameters:
+        @exog {pd dataframe} the raw predictor variables
+        @offset {numpy array} offset term of every row (optional)
+        Return:
+        @mu {numpy array} predicted mean of every row
+        """
+        eta = get_design_compiler(self, exog)(exog).dot(self.params)
+        if offset is not None:
+            eta = eta + np.asarray(offset, dtype=np.float64)
+        return np.exp(eta)
+
+
+def get_model_info(model):
+    """
+    Parameters:
+    @model {statsmodels genmod or NBResults} fitted model with a formula
+    Return:
+    @formula {string} the model formula
+    @design_info {patsy DesignInfo} description of the design matrix
+    @reference {dict} values of the raw variables in one row of the fit
+    data (see design_compiler.get_reference_row()), or None if the data
+    is not kept by the model
+    """
+    formula = getattr(model, 'formula', None)
+    reference = getattr(model, 'reference', None)
+    if formula is None:
+        # statsmodels results keep the formula and the data in the model
+        formula = model.model.formula
+    design_info = get_design_info(model)
+    frame = getattr(getattr(getattr(model, 'model', None), 'data', None),
+                    'frame', None)
+    if reference is None and frame is not None:
+        reference = get_reference_row(design_info, frame)
+    return formula, design_info, reference
+
+
+def to_spf_model(model):
+    """
+    Parameters:
+    @model {statsmodels genmod or NBResults} fitted model with a formula
+    Return:
+    @spf_model {SPFModel} the parts of the model needed for prediction; it
+    keeps the design of the fitted model as long as it is in memory
+    """
+    formula, design_info, reference = get_model_info(model)
+    names = [str(name) for name in getattr(model.params, 'index',
+                                           design_info.column_names)]
+
+    # levels of the categorical variables
+    levels = {}
+    for factor, info in design_info.factor_infos.items():
+        if info.type == 'categorical':
+            levels[factor.code] = [level.item()
+                                   if isinstance(level, np.generic)
+                                   else level for level in info.categories]
+
+    # the nb alpha is a family parameter in statsmodels
+    alpha = getattr(model, 'alpha', None)
+    if alpha is None:
+        alpha = getattr(model.model.family, 'alpha', 1/model.scale)
+
+    spf_model = SPFModel(formula, names,
+                         np.array(model.params, dtype=np.float64),
+                         np.array(model.normalized_cov_params,
+                                  dtype=np.float64),
+                         float(model.scale), float(alpha), levels,
+                         get_transform_states(design_info), reference)
+    spf_model.design_info = design_info
+
+    return spf_model
+
+
+def save_spf_model(model, file_name):
+    """
+    Parameters:
+    @model {statsmodels genmod, NBResults or SPFModel} fitted model with a
+    formula
+    @file_name {string} path of the model file
+    Save the parts of a fitted model needed for prediction: a small json
+    header (formula, coefficient names, scale, alpha, the levels of the
+    categorical variables, the transform states and the reference row)
+    followed by the coefficients and the covariance
+    matrix as raw float64 values, aligned so that they can be memory mapped.
+    """
+    if not isinstance(model, SPFModel):
+        model = to_spf_model(model)
+
+    header = json.dumps({'formula': model.formula, 'names': model.names,
+                         'scale': model.scale, 'alpha': model.alpha,
+                         'levels': model.levels,
+                         'transforms': model.transforms,
+                         'reference': model.reference}).encode()
+
+    # the values start at the first multiple of 8 bytes after the header
+    offset = len(MAGIC) + 8 + len(header)
+    offset += -offset % 8
+    values = np.concatenate((np.asarray(model.params, dtype=np.float64),
+                             np.asarray(model.normalized_cov_params,
+                                        dtype=np.float64).ravel()))
+
+    with open(file_name, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        f.write(b'\0' * (offset - len(MAGIC) - 8 - len(header)))
+        f.write(values.tobytes())
+
+
+def load_spf_model(file_name, mmap=True):
+    """
+    Parameters:
+    @file_name {string} path of the model file (see save_spf_model())
+    @mmap {bool} whether to memory map the coefficients and covariance
+    matrix instead of reading them
+    Return:
+    @model {SPFModel} the loaded model
+    """
+    with open(file_name, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(file_name + ' is not a saved spf model')
+        size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(size).decode())
+        offset = len(MAGIC) + 8 + size
+        offset += -offset % 8
+
+        n_params = len(header['names'])
+        n_values = n_params + n_params**2
+        if mmap:
+            values = np.memmap(file_name, dtype=np.float64, mode='r',
+                               offset=offset, shape=(n_values,))
+        else:
+            f.seek(offset)
+            values = np.fromfile(f, dtype=np.float64, count=n_values)
+
+    return SPFModel(header['formula'], header['names'], values[:n_params],
+                    values[n_params:].reshape(n_params, n_params),
+                    header['scale'], header['alpha'], header['levels'],
+                    header.get('transforms'), header.get('reference'))
@@ -0,0 +1,128 @@
+from crash_modeling_tools import *
+from design_compiler import get_design_compiler
+from nb_regression import fit_nb
+from spf_model import *
+import numpy as np
+import os
+import pandas as pd
+import shutil
+import statsmodels.api as sm
+import statsmodels.formula.api as smf
+import tempfile
+import unittest
+
+
+class SPFModelTester(unittest.TestCase):
+    """
+    A model fit on the I-90 test dataset is saved, loaded back and used in
+    place of the fitted statsmodels result.
+    """
+
+    # load in a standard dataset and fit a nb regression model
+    crash_data_path = '../data/unit_test_data/crash_data_final_90_test.csv'
+    crash_data = pd.read_csv(crash_data_path)
+    crash_data = crash_data.dropna()
+    crash_data['log_aadt'] = crash_data.log_avg_aadt.astype(np.float64)
+    offset_term = np.log(crash_data['seg_lng'] * 3)
+    mod_nb = smf.glm('tot_acc_ct~log_aadt+lanewid+avg_grad+C(curve)+\
+                     C(surf_typ)', data=crash_data, offset=offset_term,
+                     family=sm.families.NegativeBinomial()).fit()
+
+    # load a new dataset on which to apply the eb method
+    eb_data_path = '../data/unit_test_data/crash_data_eb_test.csv'
+    data_eb = pd.read_csv(eb_data_path)
+    data_eb = data_eb.dropna()
+    data_eb['log_aadt'] = data_eb.log_avg_aadt.astype(np.float64)
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.folder, 'spf.model')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_save_and_load(self):
+        """
+        The loaded model should give the same spf, eb results and intervals
+        as the fitted model, with and without memory mapping.
+        """
+        save_spf_model(self.mod_nb, self.file_name)
+
+        for mmap in [True, False]:
+            model = load_spf_model(self.file_name, mmap=mmap)
+            self.assertTrue(model.names == list(self.mod_nb.params.index))
+            self.assertTrue(compute_alpha(model) ==
+                            compute_alpha(self.mod_nb))
+
+            # spf and eb results
+            spf = compute_spf(self.mod_nb, self.data_eb)
+            self.assertTrue(np.allclose(compute_spf(model, self.data_eb),
+                                        spf))
+            eb = compute_empirical_bayes(model, self.data_eb,
+                                         self.data_eb['seg_lng'],
+                                         self.data_eb['tot_acc_ct'])
+            self.assertTrue(np.allclose(eb['SPF'], spf))
+
+            # intervals on the design matrix built by the model
+            design = model.design_matrix(self.data_eb)
+            expected = predict_nb(self.mod_nb, design)
+            self.assertTrue(np.allclose(predict_nb(model, design),
+                                        expected))
+
+    def test_design_matrix_levels(self):
+        """
+        The dummy columns should not depend on the levels found in the data.
+        """
+        save_spf_model(self.mod_nb, self.file_name)
+        model = load_spf_model(self.file_name, mmap=False)
+
+        # a dataset with a single surface type
+        data = self.data_eb[self.data_eb.surf_typ == 'P']
+        design = model.design_matrix(data)
+        self.assertTrue(list(design.columns) == model.names)
+        self.assertTrue((design['C(surf_typ)[T.P]'] == 1).all())
+
+    def test_save_nb_results(self):
+        """
+        Models fit with nb_regression can be saved too, with their alpha.
+        """
+        mod_nb = fit_nb('tot_acc_ct~log_aadt+lanewid+C(curve)',
+                        self.crash_data, offset=self.offset_term)
+        save_spf_model(mod_nb, self.file_name)
+        model = load_spf_model(self.file_name, mmap=False)
+
+        self.assertTrue(np.isclose(compute_alpha(model), mod_nb.alpha))
+        self.assertTrue(np.allclose(model.predict(self.data_eb),
+                                    mod_nb.predict(self.data_eb)))
+
+    def test_stateful_transforms(self):
+        """
+        The state of center() and standardize() should be the one learned
+        on the fit data, whatever the new data.
+        """
+        mod_nb = smf.glm('tot_acc_ct~center(log_aadt)+standardize(lanewid)+'
+                         'C(curve)', data=self.crash_data,
+                         offset=self.offset_term,
+                         family=sm.families.NegativeBinomial()).fit()
+        save_spf_model(mod_nb, self.file_name)
+        model = load_spf_model(self.file_name, mmap=False)
+
+        # the design is compiled from the saved state, before any new data
+        self.assertTrue(get_design_compiler(model) is not None)
+        for data in [self.data_eb.iloc[:1], self.data_eb.iloc[5:8],
+                     self.data_eb]:
+            self.assertTrue(np.allclose(compute_spf(model, data),
+                                        mod_nb.predict(data)))
+
+        # so does a model fit with nb_regression
+        mod_nb = fit_nb('tot_acc_ct~center(log_aadt)+C(curve)',
+                        self.crash_data, offset=self.offset_term)
+        save_spf_model(mod_nb, self.file_name)
+        model = load_spf_model(self.file_name, mmap=False)
+        data = self.data_eb.iloc[:2]
+        self.assertTrue(np.allclose(model.predict(data),
+                                    mod_nb.predict(data)))
+
+
+if __name__ == '__main__':
+    unittest.main()